@@ -0,0 +1,375 @@
+"""Dump throughput benchmark
+
+   DumpBench times each stage of a DumpFaster dump of synthetic data to a
+simulated library (see paper_sim), so we know where the hours of a real dump
+go and can see when a change makes a stage slower:
+
+    generate            write the zen.*.uv directories and their File rows
+    batch_files         select and claim the files in batches
+    gen_final_catalog   write the tape catalog
+    load_tapes          load the tape pair and write the catalog to it
+    archive_from_list   build each archive and write it to both tapes
+    write_positions     end each tape with the archive positions
+    dump_pair_verify    verify both tapes (in verify_mode)
+    unload_tapes        return the tapes to their slots
+
+   Each stage reports its wall time, the MB of dump data it handled and the
+MB/s. The results of a run are appended as one json line to a results file,
+so runs of different versions can be compared with compare_results().
+
+   The synthetic files are written under /papertape (where the Changer reads
+the data from) and added to the File table of the test database; both are
+removed again when the run is done, even if the dump fails. The tape labels
+are taken from the ids table of the test mtx database and are not dated, so
+the next run can use them again. A run refuses to start against any other
+database.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import socket
+import time
+
+from contextlib import contextmanager
+from datetime import datetime
+from random import randint
+
+from paper_debug import Debug
+from paper_db import PaperDB
+from paper_dump import DumpFaster
+from paper_mtx import MtxDB
+from paper_sim import SimLibrary
+from paper_status_code import StatusCode
+
+## Changer.archive_from_list() reads each source from /papertape/$source
+data_dir = '/papertape'
+
+## the File table is only filled on a test database
+test_database = b'paperdatatest'
+
+## and tape labels are only taken (or added) on a test mtx database
+test_mtx_database = b'mtxtest'
+
+
+def generate_zen(zen_path, file_mb, chunk_size=1024 * 1024):
+    """write a synthetic miriad directory; visdata is file_mb MB of random (uncompressible) data
+
+    :rtype: tuple of (md5sum of visdata, bytes written)
+    """
+    os.makedirs(zen_path, exist_ok=True)
+    visdata_hash = hashlib.md5()
+    visdata_size = int(file_mb * 1000 * 1000)
+    written = 0
+
+    with open(os.path.join(zen_path, 'visdata'), mode='wb') as visdata_file:
+        while written < visdata_size:
+            chunk = os.urandom(min(chunk_size, visdata_size - written))
+            visdata_hash.update(chunk)
+            visdata_file.write(chunk)
+            written += len(chunk)
+
+    ## the small files that go with visdata
+    small_files = {
+        'flags': os.urandom(visdata_size // 64),
+        'header': os.urandom(4096),
+        'vartable': b'a obstype\nd inttime\ni nchan\ni nants\nr freqs\n',
+        'history': 'synthetic data written by paper_bench on {}\n'.format(datetime.now().isoformat()).encode(),
+    }
+    for file_name, contents in small_files.items():
+        with open(os.path.join(zen_path, file_name), mode='wb') as small_file:
+            small_file.write(contents)
+        written += len(contents)
+
+    return visdata_hash.hexdigest(), written
+
+
+def directory_size(dir_path):
+    """bytes in all of the files under dir_path"""
+    return sum(os.path.getsize(os.path.join(walk_dir, file_name))
+               for walk_dir, dir_names, file_names in os.walk(dir_path) for file_name in file_names)
+
+
+def read_results(results_file):
+    """return the list of runs in a results file"""
+    with open(results_file, mode='r') as open_results:
+        return [json.loads(line) for line in open_results if line.strip()]
+
+
+def compare_results(baseline, results):
+    """compare the stages of two runs
+
+    :rtype: dict of the ratio of the results seconds to the baseline seconds by stage
+    """
+    baseline_seconds = dict((stage['stage'], stage['seconds']) for stage in baseline['stages'])
+    return dict((stage['stage'], stage['seconds'] / baseline_seconds[stage['stage']])
+                for stage in results['stages'] if baseline_seconds.get(stage['stage']))
+
+
+class DumpBench(object):
+    """time the stages of a dump of synthetic data"""
+
+    def __init__(self, version, pid=None, files=8, file_mb=64, batch_mb=256, verify_mode='sample',
+                 library_root='/papertape/bench/library', drive_mb_per_second=None, move_seconds=0.0,
+                 credentials='/papertape/etc/my.papertape-test.cnf', mtx_credentials='/papertape/etc/my.mtx-test.cnf',
+                 debug=False, debug_threshold=255):
+        """describe the run; run() does it
+        :type files: int
+        :param files: number of zen.*.uv directories to dump
+        :type file_mb: float
+        :param file_mb: size of each visdata file in MB
+        :type batch_mb: float
+        :param batch_mb: size of each archive in MB (DumpFaster.batch_size_mb)
+        :type verify_mode: str
+        :param verify_mode: sample, stratified or full (see Changer.tape_archive_md5)
+        :type library_root: str
+        :param library_root: directory of the simulated library, rebuilt by each run
+        :type drive_mb_per_second: float
+        :param drive_mb_per_second: rate of the simulated drives (None for as fast as the disk)
+        :type move_seconds: float
+        :param move_seconds: time the simulated robot takes to load or unload a tape
+        """
+        self.version = version
+        self.pid = "%0.6d%0.3d" % (os.getpid(), randint(1, 999)) if pid is None else pid
+        self.debug = Debug(self.pid, debug=debug, debug_threshold=debug_threshold)
+        self.debug_state = debug
+        self.debug_threshold = debug_threshold
+        self.status_code = StatusCode
+
+        self.files = files
+        self.file_mb = file_mb
+        self.batch_mb = batch_mb
+        self.verify_mode = verify_mode
+        self.library_root = library_root
+        self.drive_mb_per_second = drive_mb_per_second
+        self.move_seconds = move_seconds
+        self.credentials = credentials
+        self.mtx_credentials = mtx_credentials
+
+        ## sources look like paperbench:/bench/$pid/zen.2456000.10000.uv
+        self.host = 'paperbench'
+        self.base_path = '/bench/{}'.format(self.pid)
+        self.source_dir = '/'.join([data_dir, '{}:{}'.format(self.host, self.base_path)])
+
+        self.stages = []
+        self.data_mb = 0.0
+
+    @contextmanager
+    def stage(self, stage_name):
+        """time a stage; set 'mb' in the yielded report to the MB it handled"""
+        stage_report = {'stage': stage_name, 'mb': 0.0}
+        self.debug.output('starting {}'.format(stage_name))
+        start_time = time.time()
+        yield stage_report
+        stage_report['seconds'] = time.time() - start_time
+        stage_report['mb_per_second'] = stage_report['mb'] / stage_report['seconds'] if stage_report['mb'] and stage_report['seconds'] else None
+        self.debug.output('{stage}: {seconds:.2f}s, {mb:.1f} MB'.format(**stage_report))
+        self.stages.append(stage_report)
+
+    def generate_sources(self):
+        """write the synthetic directories
+
+        :rtype: list of File rows (host, base_path, filename, source, obsnum, filesize, md5sum)
+        """
+        rows = []
+        for file_int in range(self.files):
+            ## two minute integrations on one julian day
+            filename = 'zen.2456000.{:05d}.uv'.format(10000 + 139 * file_int)
+            source = '{}:{}/{}'.format(self.host, self.base_path, filename)
+            md5sum, written = generate_zen('/'.join([data_dir, source]), self.file_mb)
+            rows.append((self.host, self.base_path, filename, source, 2456000 * 100000 + file_int, self.file_mb, md5sum))
+            self.debug.output('generated {} ({} bytes)'.format(source, written), debug_level=250)
+        return rows
+
+    def load_file_table(self, paperdb, rows):
+        """add the synthetic files to the File table as ready to tape"""
+        insert_sql = """insert into File (host, base_path, filename, filetype, source, obsnum, filesize, md5sum,
+                tape_index, is_tapeable, is_deletable, timestamp, init_host)
+            values (%s, %s, %s, 'uv', %s, %s, %s, %s, null, 1, 0, now(), %s)
+        """
+        paperdb.db_connect()
+        paperdb.cur.executemany(insert_sql, [row + (self.host,) for row in rows])
+        paperdb.connect.commit()
+
+    def clear_file_table(self, paperdb):
+        """remove the synthetic files from the File table"""
+        paperdb.db_connect()
+        paperdb.cur.execute("delete from File where source like %s", ('{}:{}/%'.format(self.host, self.base_path),))
+        paperdb.connect.commit()
+
+    def check_paperdb(self):
+        """check that credentials are for the test paper database, before any dump runs against it
+
+        Dump.__init__ already updates File (reclaim_expired_claims()), so this
+        is checked on a bare PaperDB.
+
+        :rtype: bool
+        """
+        paperdb = PaperDB(self.version, self.credentials, self.pid, debug=self.debug_state, debug_threshold=self.debug_threshold)
+        try:
+            paperdb.db_connect()
+            if paperdb.connect.db != test_database:
+                self.debug.output('refusing to add synthetic files to {}'.format(paperdb.connect.db))
+                return False
+        finally:
+            paperdb.db_release()
+        return True
+
+    def select_labels(self):
+        """the tape pair the dump will pick (see MtxDB.select_ids()), adding a pair if there is none
+
+        :rtype: list of labels, or None if mtx_credentials are not for the test mtx database
+        """
+        labeldb = MtxDB(self.version, self.mtx_credentials, self.pid, debug=self.debug_state, debug_threshold=self.debug_threshold)
+        try:
+            labeldb.db_connect()
+            if labeldb.connect.db != test_mtx_database:
+                self.debug.output('refusing to take tape labels from {}'.format(labeldb.connect.db))
+                return None
+
+            try:
+                labels = labeldb.select_ids()
+            except TypeError:
+                ## select_ids() fails on an empty fetchone() when a series has no free tape
+                labeldb.insert_ids(['H0C19999', 'H0C29999'])
+                labels = labeldb.select_ids()
+        finally:
+            labeldb.close_mtxdb()
+        return labels
+
+    def build_library(self, labels):
+        """rebuild the simulated library with the tape pair in slots 1 and 2"""
+        shutil.rmtree(self.library_root, ignore_errors=True)
+        library = SimLibrary(self.library_root, drives=2, move_seconds=self.move_seconds,
+                             drive_mb_per_second=self.drive_mb_per_second)
+        library.create(labels)
+        library.activate()
+        return library
+
+    def run_stages(self, dump, rows):
+        """run the dump one stage at a time
+
+        :rtype: StatusCode of dump_pair_verify()
+        """
+        with self.stage('batch_files') as stage_report:
+            dump.batch_files(regex='{}:{}/%'.format(self.host, self.base_path))
+            stage_report['mb'] = self.data_mb = dump.tape_used_size
+        self.debug.output('batched {} of {} files'.format(len(dump.files.tape_list), len(rows)))
+
+        with self.stage('gen_final_catalog') as stage_report:
+            dump.files.gen_final_catalog(dump.files.catalog_name, dump.files.tape_list, dump.paperdb.file_md5_dict)
+            stage_report['mb'] = self.data_mb
+
+        tape_label_ids = dump.labeldb.select_ids()
+        with self.stage('load_tapes') as stage_report:
+            dump.tape.load_tape_pair(tape_label_ids)
+            dump.tape.prep_tape(dump.files.catalog_name)
+            stage_report['mb'] = os.path.getsize(dump.files.catalog_name) / 1000 / 1000
+
+        with self.stage('archive_from_list') as stage_report:
+            dump.tape.archive_from_list(dump.files.tape_list, md5_dict=dump.paperdb.file_md5_dict)
+            stage_report['mb'] = self.data_mb
+
+        with self.stage('write_positions'):
+            dump.write_positions()
+
+        with self.stage('dump_pair_verify') as stage_report:
+            verify_status = dump.dump_pair_verify(tape_label_ids)
+            stage_report['mb'] = self.data_mb
+
+        with self.stage('unload_tapes'):
+            dump.tape.unload_tape_pair()
+
+        return verify_status
+
+    def run(self, results_file='/papertape/bench/paper.bench.jsonl', keep_data=False):
+        """generate the data, dump it, and append the results to results_file
+
+        :type keep_data: bool
+        :param keep_data: leave the synthetic directories and the library in place
+        :rtype: StatusCode
+        """
+        bench_status = self.status_code.OK
+        bench_error = None
+        start_time = time.time()
+        self.stages = []
+
+        if not self.check_paperdb():
+            return self.status_code.db_credentials
+        labels = self.select_labels()
+        if labels is None:
+            return self.status_code.db_credentials
+        library = self.build_library(labels)
+
+        dump = None
+        files_added = False
+        try:
+            dump = DumpFaster(credentials=self.credentials, mtx_credentials=self.mtx_credentials, pid=self.pid,
+                              debug=self.debug_state, drive_select=2, debug_threshold=self.debug_threshold)
+            library.attach(dump.tape)
+
+            ## every file fits on the tape, one batch_mb archive at a time
+            dump.batch_size_mb = self.batch_mb
+            dump.tape_size = self.files * self.file_mb + 2 * self.batch_mb
+            dump.verify_mode = self.verify_mode
+
+            with self.stage('generate') as stage_report:
+                rows = self.generate_sources()
+                files_added = True
+                self.load_file_table(dump.paperdb, rows)
+                stage_report['mb'] = directory_size(self.source_dir) / 1000 / 1000
+
+            bench_status = self.run_stages(dump, rows)
+        except SystemExit as dump_exit:
+            ## close_dump() exits on a failed dump; clean up and report it like any other error
+            self.debug.output('bench dump exited with {}'.format(dump_exit.code))
+            bench_error = 'dump exited with {}'.format(dump_exit.code)
+            bench_status = self.status_code.ERROR
+        except Exception as error:
+            self.debug.output('bench error {}'.format(error))
+            bench_error = str(error)
+            bench_status = self.status_code.ERROR
+        finally:
+            tape_mb = sum(directory_size(library.tape_dir(label)) for label in labels) / 1000 / 1000
+            if dump is not None:
+                if files_added:
+                    self.clear_file_table(dump.paperdb)
+                    dump.paperdb.release_lease()
+                dump.paperdb.db_release()
+                dump.labeldb.close_mtxdb()
+                dump.tape.close_changer()
+            if not keep_data:
+                shutil.rmtree(self.source_dir, ignore_errors=True)
+                shutil.rmtree(self.library_root, ignore_errors=True)
+
+        results = {
+            'version': self.version,
+            'pid': self.pid,
+            'host': socket.gethostname(),
+            'date': datetime.now().strftime('%Y%m%d-%H%M'),
+            'settings': {
+                'files': self.files,
+                'file_mb': self.file_mb,
+                'batch_mb': self.batch_mb,
+                'verify_mode': self.verify_mode,
+                'drive_mb_per_second': self.drive_mb_per_second,
+                'move_seconds': self.move_seconds,
+            },
+            'labels': labels,
+            'data_mb': self.data_mb,
+            'tape_mb': tape_mb,
+            'stages': self.stages,
+            'seconds': time.time() - start_time,
+            'status': bench_status.name,
+            'error': bench_error,
+        }
+        self.write_results(results_file, results)
+        return bench_status
+
+    def write_results(self, results_file, results):
+        """append the results of a run to results_file as one json line"""
+        os.makedirs(os.path.dirname(os.path.abspath(results_file)), exist_ok=True)
+        with open(results_file, mode='a') as open_results:
+            open_results.write(json.dumps(results, sort_keys=True) + '\n')
+        self.debug.output('results appended to {}'.format(results_file))
@@ -0,0 +1,302 @@
+"""Local tape catalog index
+
+   CatalogIndex keeps a local sqlite index of where every file was written to
+tape, so "which tape is this file on" can be answered without touching the
+production database or parsing tape_index strings. The index is built from
+final catalogs written by Archive.gen_final_catalog() and from the tape_index
+values already in paperdata.File, and it is updated after each dump.
+
+   The block positions of each archive on each tape are written at the end of
+the tape (see Changer.write_positions()) and kept in the position table, so an
+archive can be read with a seek instead of spacing over every earlier file.
+"""
+
+import os
+import re
+import sqlite3
+
+from paper_debug import Debug
+
+## tape_index: 20150103[PAPR1007,PAPR2007]-0:1
+tape_index_regex = re.compile(r'^(\d+)\[([A-Z0-9,]+)\]-(\d+):(\d+)$')
+
+## catalog header and lines written by Archive.gen_final_catalog()
+## "## Paper dump catalog:$pid (version: $version on $date)"
+header_regex = re.compile(r'## Paper dump catalog:([0-9]+) \(version: ([0-9]+) on ([0-9-]+)\)')
+catalog_regex = re.compile(r'([0-9]+):([0-9]+):([0-9]+):([a-f0-9]{32}):(.*)')
+
+## positions tape file written by Changer.write_positions()
+## "## Paper dump positions:$pid (block size: $block_size)"
+positions_header_regex = re.compile(r'## Paper dump positions:([0-9]+) \(block size: ([0-9]+)\)')
+positions_regex = re.compile(r'([0-9]+):([0-9]+):([0-9]+):([0-9]+)$')
+
+## zen.2455933.55758.uv -> 2455933
+night_regex = re.compile(r'zen\.(\d+)\.')
+
+
+def parse_tape_index(tape_index):
+    """split a tape_index like 20150103[PAPR1007,PAPR2007]-0:1 into its parts
+
+    :rtype: dict with version, labels, tape_index and archive_index, or None if the string doesn't parse
+    """
+    tape_index_match = tape_index_regex.match(tape_index or '')
+    if not tape_index_match:
+        return None
+
+    version, labels, archive_number, archive_index = tape_index_match.groups()
+    return {
+        'version': int(version),
+        'labels': labels.split(','),
+        'tape_index': int(archive_number),
+        'archive_index': int(archive_index),
+    }
+
+
+def positions_lines(pid, positions, block_size):
+    """lines of a positions tape file
+
+    :param positions: dict of (tape_file, start_block, end_block) by tape_index
+    :rtype: list of str
+    """
+    lines = [
+        '## Paper dump positions:{} (block size: {})'.format(pid, block_size),
+        '## This tape file lists where each archive on this tape starts and ends:',
+        '## tape_index:tape_file:start_block:end_block',
+    ]
+    for tape_index in sorted(positions, key=int):
+        lines.append('{}:{}:{}:{}'.format(tape_index, *positions[tape_index]))
+    return lines
+
+
+def parse_positions(lines):
+    """read a positions tape file
+
+    :rtype: tuple of (dump pid, block_size, dict of (tape_file, start_block, end_block) by tape_index),
+        or None if the lines aren't a positions file
+    """
+    header_match = positions_header_regex.match(lines[0]) if lines else None
+    if not header_match:
+        return None
+
+    positions = {}
+    for line in lines[1:]:
+        position_match = positions_regex.match(line.strip())
+        if position_match:
+            tape_index, tape_file, start_block, end_block = [int(value) for value in position_match.groups()]
+            positions[tape_index] = (tape_file, start_block, end_block)
+
+    return header_match.group(1), int(header_match.group(2)), positions
+
+
+def night_key(source):
+    """return the julian date of the night in a zen.* source, or None"""
+    night_match = night_regex.search(source)
+    return int(night_match.group(1)) if night_match else None
+
+
+class CatalogIndex(object):
+    """sqlite index of file locations on tape"""
+
+    def __init__(self, pid, catalog_db='/papertape/catalog/paper.catalog.sqlite', debug=False, debug_threshold=255):
+        """open (and create if necessary) the index
+        :type pid: basestring
+        :type catalog_db: str
+        :param catalog_db: path of the sqlite file
+        """
+        self.pid = pid
+        self.debug = Debug(self.pid, debug=debug, debug_threshold=debug_threshold)
+
+        catalog_dir = os.path.dirname(catalog_db)
+        if catalog_dir and not os.path.exists(catalog_dir):
+            os.makedirs(catalog_dir)
+
+        self.catalog_db = catalog_db
+        self.connect = sqlite3.connect(catalog_db)
+        self.create_tables()
+
+    def create_tables(self):
+        """one row per copy of a file: (source, label) is unique"""
+        self.connect.executescript("""
+            create table if not exists location (
+                source text not null,
+                label text not null,
+                obsnum integer,
+                night integer,
+                md5 text,
+                version integer,
+                tape_index integer,
+                archive_index integer,
+                dump_pid text,
+                dump_date text,
+                primary key (source, label)
+            );
+            create index if not exists location_obsnum on location (obsnum);
+            create index if not exists location_night on location (night);
+            create index if not exists location_md5 on location (md5);
+            create index if not exists location_label on location (label, tape_index, archive_index);
+            create table if not exists position (
+                label text not null,
+                tape_index integer not null,
+                tape_file integer,
+                start_block integer,
+                end_block integer,
+                block_size integer,
+                dump_pid text,
+                primary key (label, tape_index)
+            );
+        """)
+        self.connect.commit()
+
+    def add_locations(self, locations):
+        """insert or replace rows of location dictionaries
+        :rtype: int number of rows written
+        """
+        insert_sql = """insert or replace into location
+            (source, label, obsnum, night, md5, version, tape_index, archive_index, dump_pid, dump_date)
+            values (:source, :label, :obsnum, :night, :md5, :version, :tape_index, :archive_index, :dump_pid, :dump_date)
+        """
+        rows = [dict({'obsnum': None, 'md5': None, 'dump_pid': None, 'dump_date': None}, **location) for location in locations]
+        for row in rows:
+            row['night'] = night_key(row['source'])
+
+        with self.connect:
+            self.connect.executemany(insert_sql, rows)
+
+        self.debug.output('indexed {} locations'.format(len(rows)))
+        return len(rows)
+
+    def add_tape_list(self, tape_list, md5_dict, tape_ids, version, dump_pid=None, dump_date=None, obsnum_dict=None):
+        """index the tape_list of a completed dump
+
+        :param tape_list: list of [tape_index, archive_index, source]
+        :param md5_dict: dict of md5 by source
+        :param tape_ids: list of tape labels holding a copy of the tape_list
+        :param obsnum_dict: dict of obsnum by source
+        """
+        obsnum_dict = obsnum_dict if obsnum_dict is not None else {}
+        return self.add_locations({
+            'source': item[2],
+            'label': label,
+            'obsnum': obsnum_dict.get(item[2]),
+            'md5': md5_dict.get(item[2]),
+            'version': int(version),
+            'tape_index': int(item[0]),
+            'archive_index': int(item[1]),
+            'dump_pid': dump_pid,
+            'dump_date': dump_date,
+        } for item in tape_list for label in tape_ids)
+
+    def add_catalog(self, catalog_lines, tape_ids, obsnum_dict=None):
+        """index a final catalog as written by Archive.gen_final_catalog()
+
+        :param catalog_lines: lines of the catalog file
+        :param tape_ids: list of tape labels holding a copy of the catalog
+        """
+        dump_pid, version, dump_date = None, 0, None
+        tape_list = []
+        md5_dict = {}
+
+        for line in catalog_lines:
+            catalog_match = catalog_regex.match(line)
+            header_match = header_regex.match(line)
+            if catalog_match:
+                item_index, tape_index, archive_index, md5, source = catalog_match.groups()
+                tape_list.append([tape_index, archive_index, source.strip()])
+                md5_dict[source.strip()] = md5
+            elif header_match:
+                dump_pid, version, dump_date = header_match.groups()
+
+        return self.add_tape_list(tape_list, md5_dict, tape_ids, version, dump_pid=dump_pid, dump_date=dump_date, obsnum_dict=obsnum_dict)
+
+    def add_catalog_file(self, catalog_file, tape_ids, obsnum_dict=None):
+        """index a final catalog file"""
+        with open(catalog_file, mode='r') as open_catalog:
+            return self.add_catalog(open_catalog.readlines(), tape_ids, obsnum_dict=obsnum_dict)
+
+    def add_file_rows(self, file_rows):
+        """index (source, obsnum, md5sum, tape_index) rows from paperdata.File
+
+        rows whose tape_index doesn't parse (unwritten files or claims) are skipped
+        """
+        def _locations():
+            for source, obsnum, md5, tape_index in file_rows:
+                tape_info = parse_tape_index(tape_index)
+                if tape_info is None:
+                    continue
+                for label in tape_info['labels']:
+                    yield {
+                        'source': source,
+                        'label': label,
+                        'obsnum': obsnum,
+                        'md5': md5,
+                        'version': tape_info['version'],
+                        'tape_index': tape_info['tape_index'],
+                        'archive_index': tape_info['archive_index'],
+                    }
+
+        return self.add_locations(_locations())
+
+    def add_positions(self, label, positions, block_size, dump_pid=None):
+        """insert or replace the archive positions of a tape
+
+        :param positions: dict of (tape_file, start_block, end_block) by tape_index
+        :rtype: int number of rows written
+        """
+        insert_sql = """insert or replace into position
+            (label, tape_index, tape_file, start_block, end_block, block_size, dump_pid)
+            values (?, ?, ?, ?, ?, ?, ?)
+        """
+        rows = [(label, int(tape_index), tape_file, start_block, end_block, block_size, dump_pid)
+                for tape_index, (tape_file, start_block, end_block) in positions.items()]
+
+        with self.connect:
+            self.connect.executemany(insert_sql, rows)
+
+        self.debug.output('indexed {} positions on {}'.format(len(rows), label))
+        return len(rows)
+
+    def position(self, label, tape_index):
+        """where an archive starts and ends on a tape
+
+        :rtype: dict with tape_file, start_block, end_block and block_size, or None if not indexed
+        """
+        cursor = self.connect.execute("""select tape_file, start_block, end_block, block_size
+            from position where label = ? and tape_index = ?""", (label, int(tape_index)))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip(['tape_file', 'start_block', 'end_block', 'block_size'], row))
+
+    def _select(self, where_sql, args):
+        """return location dictionaries matching the where clause"""
+        select_sql = """select source, label, obsnum, night, md5, version, tape_index, archive_index, dump_pid, dump_date
+            from location where {} order by label, tape_index, archive_index""".format(where_sql)
+        cursor = self.connect.execute(select_sql, args)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def locate(self, source):
+        """every copy of the given source"""
+        return self._select('source = ?', (source,))
+
+    def by_obsnum(self, first_obsnum, last_obsnum=None):
+        """copies of files with first_obsnum <= obsnum <= last_obsnum"""
+        return self._select('obsnum between ? and ?', (first_obsnum, first_obsnum if last_obsnum is None else last_obsnum))
+
+    def by_night(self, first_night, last_night=None):
+        """copies of files observed on nights (julian dates) first_night to last_night"""
+        return self._select('night between ? and ?', (first_night, first_night if last_night is None else last_night))
+
+    def by_md5(self, md5):
+        """copies of files with the given md5sum"""
+        return self._select('md5 = ?', (md5,))
+
+    def by_label(self, label, tape_index=None):
+        """files on the given tape label, optionally only in one archive"""
+        if tape_index is None:
+            return self._select('label = ?', (label,))
+        return self._select('label = ? and tape_index = ?', (label, tape_index))
+
+    def close_catalog(self):
+        """close the sqlite connection"""
+        self.connect.close()
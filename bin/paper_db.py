@@ -8,15 +8,18 @@ are written to tape.
 
 from datetime import datetime, timedelta
 
-import pymysql, subprocess, re
+import subprocess, socket
 from enum import Enum, unique
 from os import path
+from threading import Thread, Event
+from time import sleep
 
 from paper_debug import Debug
+from paper_pool import PooledDB
 from paper_status_code import StatusCode
 
 
-class PaperDB(object):
+class PaperDB(PooledDB):
     """Paper database contains information on file locations"""
 
     def __init__(self, version, credentials, pid, debug=False, debug_threshold=255):
@@ -40,14 +43,23 @@ class PaperDB(object):
 
         self.check_credentials_file(credentials)
         self.credentials = credentials
-        self.connect = ''
-        self.cur = ''
         self.db_connect('init', credentials)
 
         self.file_list = []
         self.file_md5_dict = {}
+        self.file_size_dict = {}
         self.claimed_files = []
         self.claimed_state = 0
+        self.claim_chunk_size = 1000 ## sources per claim/unclaim update
+        self.claim_count = 0         ## rows updated by the last claim/unclaim
+        self.claim_page_rows = 100   ## candidate rows locked per page by claim_next_batch
+        self.claim_retries = 5       ## claim_next_batch retries while other dumps hold every candidate
+        self.claim_retry_seconds = 2
+        self.lease_seconds = 600     ## claims expire unless renewed within this time
+        self.lease_thread = None
+        self.tape_index_chunk_size = 5000 ## rows per staged tape_index insert
+        self.tape_index_report = {}
+        self.batch_cursor = ('', '')
 
     def __setattr__(self, attr_name, attr_value):
         """debug.output() when a state variable is updated"""
@@ -71,38 +83,15 @@ class PaperDB(object):
         ## return true if the credentials file exists and is not zero size
         path.isfile(credentials) and path.getsize(credentials) > 0
 
-    def update_connection_time(self):
-        """refresh database connection time"""
-        self.debug.output('updating connection_time')
-        self.connection_time = datetime.now()
-
-    def connection_time_delta(self):
-        """return connection age"""
-        self.debug.output('connection_time:%s' % self.connection_time)
-        delta = datetime.now() - self.connection_time
-        return delta.total_seconds()
-
-    def db_connect(self, command=None, credentials=None):
-        """connect to the database or reconnect an old session"""
-        self.debug.output('input:%s %s' % (command, credentials))
-        self.credentials = credentials if credentials is not None else self.credentials
-        time_delta = self.connection_timeout + 1 if command == 'init' else self.connection_time_delta()
-
-        self.debug.output("time_delta:%s, timeout:%s" % (time_delta, self.connection_timeout))
-        if time_delta > self.connection_timeout:
-            self.debug.output("setting connection %s %s" % (credentials, self.connection_timeout))
-            self.connect = pymysql.connect(read_default_file=self.credentials, connect_timeout=self.connection_timeout)
-            self.cur = self.connect.cursor()
-
-        self.update_connection_time()
-        self.debug.output("connection_time:%s" % self.connection_time)
-
     def get_new(self, size_limit, regex=False, pid=False):
         """Retrieve a file_list of available files.
 
         Outputs files that are "write_to_tape"
         Optionally, limit search by file_path regex or pid in tape_index
 
+        Without a regex or pid the batch is selected on the server with
+        get_next_batch(), so only the rows for this batch are transferred.
+
         Arguments:
         :param size_limit: int
         :param regex: str
@@ -122,22 +111,12 @@ class PaperDB(object):
                 where tape_index = 1{0:s}
             """.format(pid)
         else:
-            ready_sql = """select source, filesize, md5sum from File
-                where source is not null 
-                and filetype like 'uv%'
-                and is_tapeable = 1 
-                and tape_index is null
-                group by source order by filename;
-            """
-
-        self.db_connect()
-        self.cur.execute(ready_sql)
-        self.update_connection_time()
+            return self.get_next_batch(size_limit)
 
         self.file_list = []
         total = 0
 
-        for file_info in self.cur.fetchall():
+        for file_info in self.stream_rows(ready_sql):
             self.debug.output('found file - %s' % file_info[0], debug_level=254)
             file_size = float(file_info[1])
 
@@ -158,29 +137,105 @@ class PaperDB(object):
 
         return self.file_list, total
 
-    def enumerate_paths(self):
-        ## run query with no size limit
-        ## remove "is_tapeable=1"
-        ready_sql = """select source from File
-                        where source is not null
-                        and filetype like 'uv%'
-                        /* and is_tapeable = 1 */
-                        and tape_index is null
-                        group by source order by filename;
-                    """
+    def reset_batch_cursor(self):
+        """start the next get_next_batch() from the beginning of the File table"""
+        self.batch_cursor = ('', '')
+
+    def get_next_batch(self, size_limit, row_limit=None):
+        """Retrieve the next file_list of available files smaller than size_limit.
+
+        The running size of the candidate files is summed on the server, so only
+        the rows that fit in the batch are returned. The (filename, source) of the
+        last row is kept in self.batch_cursor, so repeated calls page forward
+        through the table instead of rescanning the whole backlog.
+
+        Files that are larger than the size_limit on their own can never be
+        batched and are skipped. Unlike get_new() before it, the batch ends at the
+        first file that doesn't fit instead of skipping it to look for smaller
+        ones, so a batch can come back a little less full; the file that didn't
+        fit starts the next batch. Use BatchPlanner (plan_batch_files()) to pack
+        batches full.
+
+        A source with more than one File row is batched once, at its largest
+        filesize.
+
+        :param size_limit: int (MB); 0 returns every remaining file
+        :param row_limit: int; only sum the first row_limit candidates (None for no limit)
+        :rtype: (list, float)
+        """
+
+        ## keyset on (filename, source) since filename alone is not unique
+        last_filename, last_source = self.batch_cursor
+
+        ## the window orders the running total itself, so it doesn't depend on
+        ## the order rows come out of the candidate table (mysql 8.0+)
+        candidate_limit = 'order by filename, source limit %(row_limit)s' if row_limit else ''
+        ready_sql = """select source, filesize, md5sum, filename, running_total from (
+                select source, filesize, md5sum, filename,
+                    sum(filesize) over (order by filename, source) as running_total
+                from (
+                    select source, max(filesize) as filesize, any_value(md5sum) as md5sum, any_value(filename) as filename
+                    from File
+                    where source is not null
+                    and filetype like 'uv%%'
+                    and is_tapeable = 1
+                    and tape_index is null
+                    and (filename > %(filename)s or (filename = %(filename)s and source > %(source)s))
+                    and (%(size_limit)s = 0 or filesize < %(size_limit)s)
+                    group by source
+                    {}
+                ) as candidate
+            ) as batch
+            where %(size_limit)s = 0 or running_total < %(size_limit)s
+            order by filename, source
+        """.format(candidate_limit)
+        ready_args = {'filename': last_filename, 'source': last_source,
+                      'size_limit': size_limit, 'row_limit': row_limit}
 
         self.db_connect()
-        self.cur.execute(ready_sql)
+        self.debug.output('batch_cursor:{}, size_limit:{}'.format(self.batch_cursor, size_limit))
+        self.cur.execute(ready_sql, ready_args)
         self.update_connection_time()
 
-        dir_list = {}
+        self.file_list = []
+        total = 0
+
         for file_info in self.cur.fetchall():
-            ## parse paths
-            ## like $host:/{mnt/,}$base/$subpath/$file
-            path_regex = re.compile(r'(.*:)(/mnt/|/)(\w+)/')
-            path_info = path_regex.match(file_info[0]).groups()
-            base_path = path_info[0] + path_info[1] + path_info[2]
-            dir_list[base_path] = dir_list[base_path] + 1 if base_path in dir_list else 0
+            self.debug.output('file:', file_info[0], debug_level=254)
+            self.file_list.append(file_info[0])
+            self.file_md5_dict[file_info[0]] = file_info[2]
+            self.file_size_dict[file_info[0]] = float(file_info[1])
+            total += float(file_info[1])
+            self.batch_cursor = (file_info[3], file_info[0])
+
+        self.debug.output('batch of {} files, {} MB'.format(len(self.file_list), total))
+        return self.file_list, total
+
+    def enumerate_paths(self):
+        """Return the file count and total size (MB) of untaped files under each base path.
+
+        Paths look like $host:/{mnt/,}$base/$subpath/$file and are grouped by
+        $host:/{mnt/,}$base on the server.
+
+        :rtype: dict of [file_count, total_mb] by base_path
+        """
+        ## run query with no size limit
+        ## remove "is_tapeable=1"
+        ready_sql = """select
+                case when source like '%:/mnt/%' then substring_index(source, '/', 3)
+                    else substring_index(source, '/', 2) end as base_path,
+                count(*), sum(filesize)
+            from File
+            where source is not null
+            and filetype like 'uv%'
+            /* and is_tapeable = 1 */
+            and tape_index is null
+            group by base_path
+        """
+
+        dir_list = {}
+        for base_path, file_count, total_mb in self.stream_rows(ready_sql):
+            dir_list[base_path] = [int(file_count), float(total_mb or 0)]
 
         ## return array
         return dir_list
@@ -188,83 +243,485 @@ class PaperDB(object):
     def claim_files(self, file_list=None, unclaim=False):
         """Mark files in the database that are "claimed" by a dump process."""
 
+        claim_files_status, claim_count = self.bulk_claim_files(file_list, unclaim=unclaim)
+        return claim_files_status
+
+    def bulk_claim_files(self, file_list=None, unclaim=False):
+        """Claim (or unclaim) a whole file_list with one update per claim_chunk_size files.
+
+        :param file_list: list of sources; defaults to self.claimed_files
+        :param unclaim: bool
+        :rtype: (StatusCode, int) status and the number of rows actually updated
+        """
+
         status_type = self.paperdb_state.value
         ## if no file_list is passed assume we are updating existing file_list
         if file_list is None:
-            file_list = self.claimed_files
+            file_list = list(self.claimed_files)
+
+        ## TODO(dconover): allow claim to use current state
+        if unclaim is not True:
+            status_type = self.paperdb_state_code.claim.value
 
-        claim_files_status = self.status_code.OK
         self.db_connect()
+        claim_files_status, claim_count = self.update_claims(file_list, '{}{}'.format(status_type, self.pid), unclaim=unclaim)
+
+        ## commit the claim for the whole file_list
+        try:
+            self.connect.commit()
+            self.claimed_state = status_type
+            if unclaim is True:
+                unclaimed_files = set(file_list)
+                self.claimed_files = [source for source in self.claimed_files if source not in unclaimed_files]
+            else:
+                self.claimed_files.extend(file_list)
+        except Exception as mysql_error:
+            self.debug.output('mysql_error {}'.format(mysql_error))
+            claim_files_status = self.status_code.unclaim_files_sql_commit if unclaim else self.status_code.claim_files_sql_commit
+
+        ## keep the claims alive while this process runs
+        if unclaim is not True and claim_count:
+            self.start_lease()
 
-        ## build an sql to unclaim the given files
-        for file_name in file_list:
+        self.debug.output('claim_files - {} of {} rows updated'.format(claim_count, len(file_list)))
+        if claim_count != len(file_list):
+            self.debug.output('claim_files - row count mismatch, unclaim={}'.format(unclaim))
+
+        self.claim_count = claim_count
+        self.paperdb_state = self.paperdb_state_code.claim
+        return claim_files_status, claim_count
+
+    def update_claims(self, file_list, claim_value, unclaim=False):
+        """Run the chunked claim (or unclaim) updates for file_list without committing.
+
+        :param file_list: list of sources
+        :param claim_value: str, the tape_index value of the claim, like 1$pid
+        :param unclaim: bool
+        :rtype: (StatusCode, int) status and the number of rows updated
+        """
+
+        update_claims_status = self.status_code.OK
+        claim_count = 0
+
+        for chunk_start in range(0, len(file_list), self.claim_chunk_size):
+            chunk = file_list[chunk_start:chunk_start + self.claim_chunk_size]
+            source_list = ','.join(['%s'] * len(chunk))
 
             if unclaim is True:
-                update_sql = "update File set tape_index=null where source='%s' and tape_index='%s%s'" % (file_name, status_type, self.pid)
+                update_sql = "update File set tape_index=null where tape_index=%s and source in ({})".format(source_list)
+                update_args = [claim_value] + chunk
             else:
-                ## TODO(dconover): allow claim to use current state
-                status_type = self.paperdb_state_code.claim.value
-                update_sql = "update File set tape_index='%s%s' where source='%s'" % (status_type, self.pid, file_name)
+                ## never take over a file another dump claimed or wrote
+                update_sql = "update File set tape_index=%s where (tape_index is null or tape_index=%s) and source in ({})".format(source_list)
+                update_args = [claim_value, claim_value] + chunk
 
-            self.debug.output('claim_files - %s' % update_sql)
+            self.debug.output('claim_files - {} files at {}'.format(len(chunk), chunk_start))
             try:
-                self.cur.execute(update_sql)
+                claim_count += self.cur.execute(update_sql, update_args)
             except Exception as mysql_error:
                 self.debug.output('mysql_error {}'.format(mysql_error))
-                claim_files_status = self.status_code.claim_files_sql_build
+                update_claims_status = self.status_code.unclaim_files_sql_build if unclaim else self.status_code.claim_files_sql_build
+
+        return update_claims_status, claim_count
+
+    def claim_next_batch(self, size_limit):
+        """Select and claim the next batch of available files in one transaction.
+
+        Candidate rows are read claim_page_rows at a time with
+        "select ... for update skip locked", so rows that another dump process is
+        claiming at the same moment are skipped instead of claimed twice. The
+        batch is marked with this process' claim before the transaction commits,
+        which lets several dumps pull disjoint work concurrently (mysql 8.0+).
+
+        An empty batch doesn't mean the backlog is empty while another dump holds
+        the candidate rows, so the claim is retried until no unclaimed file is left
+        or claim_retries runs out.
+
+        :param size_limit: int (MB); 0 claims every remaining file
+        :rtype: (list, float)
+        """
+
+        for attempt in range(self.claim_retries + 1):
+            claim_status, total, claim_count = self.select_and_claim(size_limit)
+            if claim_status is not self.status_code.OK or self.file_list or not self.unclaimed_count(size_limit):
+                break
+
+            self.debug.output('candidate files are locked by another dump, retry {}'.format(attempt + 1))
+            sleep(self.claim_retry_seconds)
+
+        if claim_status is not self.status_code.OK:
+            self.debug.output('claim_next_batch failed: {}'.format(claim_status))
+            self.file_list = []
+            return self.file_list, 0
+
+        if not self.file_list:
+            self.debug.output('no unclaimed files left')
+            return self.file_list, 0
+
+        self.claim_count = claim_count
+        self.claimed_state = self.paperdb_state_code.claim.value
+        self.claimed_files.extend(self.file_list)
+        self.start_lease()
+        self.paperdb_state = self.paperdb_state_code.claim
+
+        self.debug.output('claimed batch of {} files, {} MB'.format(claim_count, total))
+        return self.file_list, total
+
+    def select_and_claim(self, size_limit):
+        """one claim_next_batch() transaction; the batch is left in self.file_list
+
+        The transaction runs at read committed, so the locking reads only lock the
+        rows they return instead of every row the scan passes over (which would
+        hide them from the skip locked reads of other dumps).
+
+        :rtype: (StatusCode, float, int) status, batch size and number of rows claimed
+        """
+
+        select_sql = """select source, filesize, md5sum, filename from File
+            where source is not null
+            and filetype like 'uv%%'
+            and is_tapeable = 1
+            and tape_index is null
+            and (filename > %(filename)s or (filename = %(filename)s and source > %(source)s))
+            and (%(size_limit)s = 0 or filesize < %(size_limit)s)
+            order by filename, source
+            limit %(row_limit)s
+            for update skip locked
+        """
+
+        self.db_connect()
+        self.file_list = []
+        total = 0
+        claim_status = self.status_code.OK
+        claim_count = 0
+        page_cursor = ('', '')
 
-        ## run the actual sql to unclaim the files
         try:
+            ## the isolation level can only be set between transactions
             self.connect.commit()
-            self.claimed_state = status_type
-            self.claimed_files.extend(file_list)
+            self.cur.execute('set transaction isolation level read committed')
+            self.connect.begin()
+
+            ## page forward through unlocked candidates until the batch is full
+            batch_full = False
+            while not batch_full:
+                select_args = {'filename': page_cursor[0], 'source': page_cursor[1],
+                               'size_limit': size_limit, 'row_limit': self.claim_page_rows}
+                self.cur.execute(select_sql, select_args)
+                page = self.cur.fetchall()
+                if not page:
+                    break
+
+                for file_info in page:
+                    file_size = float(file_info[1])
+                    if size_limit != 0 and total + file_size >= size_limit:
+                        batch_full = True
+                        break
+
+                    self.file_list.append(file_info[0])
+                    self.file_md5_dict[file_info[0]] = file_info[2]
+                    self.file_size_dict[file_info[0]] = file_size
+                    total += file_size
+                    page_cursor = (file_info[3], file_info[0])
+
+            ## mark the batch while the rows are still locked
+            claim_value = '{}{}'.format(self.paperdb_state_code.claim.value, self.pid)
+            claim_status, claim_count = self.update_claims(self.file_list, claim_value)
+
+            if claim_status is self.status_code.OK:
+                self.connect.commit()
+            else:
+                self.connect.rollback()
+
         except Exception as mysql_error:
             self.debug.output('mysql_error {}'.format(mysql_error))
-            claim_files_status = self.status_code.claim_files_sql_commit
+            claim_status = self.status_code.claim_files_sql_commit
+            try:
+                self.connect.rollback()
+            except Exception as mysql_error:
+                self.debug.output('rollback error {}'.format(mysql_error))
 
-        self.paperdb_state = self.paperdb_state_code.claim
-        return claim_files_status
+        self.update_connection_time()
+        return claim_status, total, claim_count
+
+    def claim_listed_files(self, file_list):
+        """Claim the given files in one transaction, leaving out files another dump holds.
+
+        The rows are locked with "select ... for update skip locked" and only rows
+        that are still unclaimed are marked, so two dumps that picked the same
+        files (planned from the same candidates) never both claim them.
+
+        :param file_list: list of sources
+        :rtype: (StatusCode, list) status and the sources claimed by this dump
+        """
+
+        select_sql = """select source from File
+            where tape_index is null and source in ({})
+            for update skip locked
+        """
+        claim_value = '{}{}'.format(self.paperdb_state_code.claim.value, self.pid)
+        claim_status = self.status_code.OK
+        claimed = []
+
+        self.db_connect()
+        try:
+            ## the isolation level can only be set between transactions
+            self.connect.commit()
+            self.cur.execute('set transaction isolation level read committed')
+            self.connect.begin()
+
+            for chunk_start in range(0, len(file_list), self.claim_chunk_size):
+                chunk = file_list[chunk_start:chunk_start + self.claim_chunk_size]
+                self.cur.execute(select_sql.format(','.join(['%s'] * len(chunk))), chunk)
+                claimed.extend(row[0] for row in self.cur.fetchall())
+
+            ## mark the files while the rows are still locked
+            claim_status, claim_count = self.update_claims(claimed, claim_value)
+            if claim_status is self.status_code.OK:
+                self.connect.commit()
+            else:
+                self.connect.rollback()
+                claimed = []
+
+        except Exception as mysql_error:
+            self.debug.output('mysql_error {}'.format(mysql_error))
+            claim_status = self.status_code.claim_files_sql_commit
+            claimed = []
+            try:
+                self.connect.rollback()
+            except Exception as mysql_error:
+                self.debug.output('rollback error {}'.format(mysql_error))
+
+        self.update_connection_time()
+        self.debug.output('claim_listed_files - {} of {} files claimed'.format(len(claimed), len(file_list)))
+
+        if claimed:
+            self.claim_count = len(claimed)
+            self.claimed_state = self.paperdb_state_code.claim.value
+            self.claimed_files.extend(claimed)
+            self.start_lease()
+            self.paperdb_state = self.paperdb_state_code.claim
+
+        return claim_status, claimed
+
+    def unclaimed_count(self, size_limit):
+        """count the files that could still be batched, including rows locked by other dumps (a non-locking read)"""
+        count_sql = """select count(*) from File
+            where source is not null
+            and filetype like 'uv%%'
+            and is_tapeable = 1
+            and tape_index is null
+            and (%(size_limit)s = 0 or filesize < %(size_limit)s)
+        """
+        self.db_connect()
+        self.cur.execute(count_sql, {'size_limit': size_limit})
+        unclaimed = self.cur.fetchone()[0]
+
+        ## end the read so the next count sees claims committed since
+        self.connect.commit()
+        return unclaimed
 
     def unclaim_files(self, file_list=None):
         """Release claimed files from database
         :rtype : bool
         """
 
-        self.claim_files(file_list, unclaim=True)
+        return self.claim_files(file_list, unclaim=True)
+
+    def ensure_lease_table(self):
+        """create the ClaimLease table if it doesn't exist yet
+
+        A one-off setup step (see etc/paperdata-ClaimLease.schema.md); dumps
+        expect the table to be there and don't run DDL themselves.
+        """
+        lease_sql = """create table if not exists ClaimLease (
+                pid varchar(20) not null primary key,
+                host varchar(100),
+                expires datetime not null,
+                key (expires)
+            )"""
+        self.db_connect()
+        self.cur.execute(lease_sql)
+        self.connect.commit()
+
+    def renew_lease(self):
+        """extend the lease on this process' claims by lease_seconds"""
+        renew_sql = """insert into ClaimLease (pid, host, expires)
+            values (%(pid)s, %(host)s, now() + interval %(lease_seconds)s second)
+            on duplicate key update expires=values(expires)
+        """
+        self.db_connect()
+        self.cur.execute(renew_sql, {'pid': str(self.pid), 'host': socket.gethostname(), 'lease_seconds': self.lease_seconds})
+        self.connect.commit()
+        self.debug.output('renewed lease for {} seconds'.format(self.lease_seconds), debug_level=250)
+
+    def start_lease(self):
+        """take out a lease on our claims and start a LeaseThread to keep renewing it"""
+        if self.lease_thread is not None and self.lease_thread.is_alive():
+            return
+
+        self.renew_lease()
+        self.lease_thread = LeaseThread(self, self.lease_seconds / 4)
+        self.lease_thread.start()
+
+    def release_lease(self):
+        """stop renewing the lease and remove it"""
+        if self.lease_thread is not None:
+            self.lease_thread.stop()
+            self.lease_thread = None
+
+            self.db_connect()
+            self.cur.execute("delete from ClaimLease where pid=%s", (str(self.pid),))
+            self.connect.commit()
+            self.debug.output('released lease')
+
+    def reclaim_expired_claims(self):
+        """return files claimed by dumps whose lease has expired to the pool of tapeable files
+
+        A dump that crashes or is killed stops renewing its lease, so once the
+        lease expires its claims (tape_index='1$pid') are reset to null. Claims
+        made before leases existed have no ClaimLease row and are left alone.
+
+        :rtype: int number of files reclaimed
+        """
+        reclaim_sql = """update File join ClaimLease on File.tape_index = concat(%(claim)s, ClaimLease.pid)
+            set File.tape_index=null
+            where ClaimLease.expires < now()
+        """
+        self.db_connect()
+
+        reclaim_count = 0
+        try:
+            self.connect.begin()
+            self.cur.execute("select pid, host, expires from ClaimLease where expires < now() for update")
+            for lease in self.cur.fetchall():
+                self.debug.output('expired lease pid:{} host:{} expires:{}'.format(*lease))
+
+            reclaim_count = self.cur.execute(reclaim_sql, {'claim': str(self.paperdb_state_code.claim.value)})
+            self.cur.execute("delete from ClaimLease where expires < now()")
+            self.connect.commit()
+        except Exception as mysql_error:
+            self.debug.output('mysql_error {}'.format(mysql_error))
+            try:
+                self.connect.rollback()
+            except Exception as mysql_error:
+                self.debug.output('rollback error {}'.format(mysql_error))
+
+        self.update_connection_time()
+        self.debug.output('reclaimed {} files from expired leases'.format(reclaim_count))
+        return reclaim_count
 
     def write_tape_index(self, tape_list, tape_id):
         """Take a dictionary of files and labels and update the database
 
         record the barcode of tape in the tape_index field, but not
         setting the is_deletable field to 1 for all files just written to tape.
+
+        The tape_index values are loaded into a temporary staging table in
+        chunks of tape_index_chunk_size rows and applied to File with a single
+        joined update, all inside one transaction.
+
+        A claim can be lost while the dump runs (its lease expires during a long
+        database outage and another dump reclaims the files), so the staged rows
+        are locked and checked first: if any of them is claimed by another dump or
+        already on tape nothing is updated and claim_lost is returned.
+
         :param tape_list: dict
         :param tape_id: str
         """
 
         write_tape_index_status = self.status_code.OK
         self.debug.output("tape_list contains %s files, and with ids: %s" % (len(tape_list), tape_id))
+        start_time = datetime.now()
         self.db_connect()
 
         ## item file_list is set in paper_io.py: self.tape_list.append([queue_pass, int, file])
-        for item in tape_list:
-            ## tape_index: 20150103[PAPR2001,PAPR2001]-132:3
-            tape_index = "%s[%s]-%s:%s" % (self.version, tape_id, item[0], item[1])
-            source = item[2]
-            self.debug.output("writing tape_index: %s for %s" % (tape_index, source))
+        ## tape_index: 20150103[PAPR2001,PAPR2001]-132:3
+        stage_rows = [["%s[%s]-%s:%s" % (self.version, tape_id, item[0], item[1]), item[2]] for item in tape_list]
+
+        ## a source listed twice (it was written twice) is staged once, with its last tape_index
+        duplicate_count = len(stage_rows) - len(set(row[1] for row in stage_rows))
+        if duplicate_count:
+            self.debug.output('write_tape_index - {} sources are listed more than once'.format(duplicate_count))
+
+        ## source is sized like File.source
+        stage_sql = """create temporary table if not exists tape_index_stage (
+                source varchar(200) not null primary key,
+                tape_index varchar(100)
+            )"""
+        insert_sql = """insert into tape_index_stage (tape_index, source) values (%s, %s)
+            on duplicate key update tape_index=values(tape_index)"""
+        owner_sql = "select source, File.tape_index from File join tape_index_stage using (source) for update"
+        update_sql = """update File join tape_index_stage using (source)
+                set File.tape_index=tape_index_stage.tape_index, File.is_deletable=1"""
+
+        update_count = 0
+        try:
+            self.connect.begin()
+            self.cur.execute(stage_sql)
+            self.cur.execute("delete from tape_index_stage")
+
+            ## executemany sends each chunk as a single multi-row insert
+            for chunk_start in range(0, len(stage_rows), self.tape_index_chunk_size):
+                chunk = stage_rows[chunk_start:chunk_start + self.tape_index_chunk_size]
+                self.debug.output('staging {} tape_index rows at {}'.format(len(chunk), chunk_start))
+                self.cur.executemany(insert_sql, chunk)
+
+            ## lock the rows, then make sure they are still ours (or unclaimed)
+            self.cur.execute(owner_sql)
+            claim_value = '{}{}'.format(self.paperdb_state_code.claim.value, self.pid)
+            lost_claims = [source for source, tape_index in self.cur.fetchall() if tape_index not in (None, claim_value)]
+
+            if lost_claims:
+                self.debug.output('write_tape_index - {} files are no longer claimed by {}: {}'.format(len(lost_claims), self.pid, lost_claims[:10]))
+                write_tape_index_status = self.status_code.claim_lost
+                self.connect.rollback()
+            else:
+                update_count = self.cur.execute(update_sql)
+                self.connect.commit()
+        except Exception as mysql_error:
+            self.debug.output('error {}'.format(mysql_error))
+            write_tape_index_status = self.status_code.write_tape_index_mysql
             try:
-                self.cur.execute('update File set tape_index="%s", is_deletable=1 where source="%s"' % (tape_index, source))
+                self.connect.rollback()
             except Exception as mysql_error:
-                self.debug.output('error {}'.format(mysql_error))
-                write_tape_index_status = self.status_code.write_tape_index_mysql
+                self.debug.output('rollback error {}'.format(mysql_error))
 
         try:
-            self.connect.commit()
+            self.cur.execute("drop temporary table if exists tape_index_stage")
         except Exception as mysql_error:
             self.debug.output('error {}'.format(mysql_error))
-            write_tape_index_status = self.status_code.write_tape_index_mysql
 
+        self.update_connection_time()
+        elapsed = (datetime.now() - start_time).total_seconds()
+        self.debug.output('write_tape_index - {} rows staged, {} rows updated in {:.2f}s'.format(len(stage_rows), update_count, elapsed))
+        if update_count != len(stage_rows):
+            self.debug.output('write_tape_index - row count mismatch {} != {}'.format(update_count, len(stage_rows)))
+
+        self.tape_index_report = {'rows': len(stage_rows), 'updated': update_count, 'seconds': elapsed}
         return write_tape_index_status
 
+    def file_obsnums(self, file_list):
+        """return a dictionary of obsnum by source for the given file_list"""
+        obsnum_dict = {}
+        self.db_connect()
+
+        for chunk_start in range(0, len(file_list), self.claim_chunk_size):
+            chunk = file_list[chunk_start:chunk_start + self.claim_chunk_size]
+            select_sql = "select source, obsnum from File where source in ({})".format(','.join(['%s'] * len(chunk)))
+            self.cur.execute(select_sql, chunk)
+            obsnum_dict.update(self.cur.fetchall())
+
+        self.update_connection_time()
+        return obsnum_dict
+
+    def tape_index_rows(self):
+        """generator of (source, obsnum, md5sum, tape_index) for every file written to tape"""
+        select_sql = """select source, obsnum, md5sum, tape_index from File
+            where tape_index like '%[%'
+        """
+        return self.stream_rows(select_sql)
+
     def check_tape_locations(self, catalog_list, tape_id):
         """Take a dictionary of files and labels and confirm existence of files on tape.
 
@@ -285,8 +742,11 @@ class PaperDB(object):
 
             _close_status = True
             try:
-                ## close database connections
-                self.cur.close()
+                ## any claims left are resumed by pid, so they no longer need a lease
+                self.release_lease()
+
+                ## return the database connection to the pool
+                self.db_release()
             except Exception as mysql_error:
                 self.debug.output('mysql error {}'.format(mysql_error))
                 _close_status = False
@@ -322,6 +782,31 @@ class PaperDB(object):
         pass
 
 
+## thread to renew the lease on a dump's claims
+## until stop() is called or the process dies
+class LeaseThread(Thread):
+    ## init object with the paperdb whose lease we renew
+    ## and the number of seconds between renewals
+    def __init__(self, paperdb, interval):
+        Thread.__init__(self, daemon=True)
+        self.paperdb = paperdb
+        self.interval = interval
+        self.stopped = Event()
+
+    ## custom run() to renew the lease every interval
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.paperdb.renew_lease()
+            except Exception as mysql_error:
+                self.paperdb.debug.output('lease renewal error {}'.format(mysql_error))
+        self.paperdb.db_release()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
 # noinspection PyClassHasNoInit
 @unique
 class PaperDBStateCode(Enum):
@@ -7,11 +7,12 @@ be dumped to tape using this class.
 __author__ = 'dconover@sas.upenn.edu'
 __version__ = 20170221
 
-from threading import Thread
+from threading import Thread, Event, Lock
 from random import randint
 from os import statvfs, makedirs, getpid, path
 from sys import exit
 from functools import reduce
+from datetime import datetime
 
 from enum import Enum, unique
 
@@ -19,6 +20,9 @@ from paper_mtx import Changer, MtxDB
 from paper_io import Archive
 from paper_db import PaperDB
 #from paper_db import TestPaperDB
+from paper_plan import BatchPlanner
+from paper_pipeline import Pipeline, PipelineStage
+from paper_catalog import CatalogIndex
 from paper_debug import Debug
 from paper_status_code import StatusCode
 
@@ -50,6 +54,9 @@ class Dump(object):
         ## setup PaperDB connection
         self.paperdb = PaperDB(self.version, self.paper_creds, self.pid, debug=True, debug_threshold=debug_threshold)
 
+        ## return claims from crashed dumps to the pool
+        self.paperdb.reclaim_expired_claims()
+
         ## setup tape library
         self.labeldb = MtxDB(self.version, self.mtx_creds, self.pid, debug=debug, debug_threshold=debug_threshold)
 
@@ -63,6 +70,12 @@ class Dump(object):
         self.dump_list = []
         self.tape_index = 0
         self.tape_used_size = 0 ## each dump process should write one tape worth of data
+        self.atomic_claim = True ## claim with locking reads that skip other dumps' rows (mysql 8.0+)
+        self.catalog_db = '/papertape/catalog/paper.catalog.sqlite' ## local index of tape locations
+        self.verify_mode = 'sample' ## sample, stratified or full (see Changer.tape_archive_md5)
+        self.verify_confidence = 0.95 ## stratified: chance of finding a bad file
+        self.verify_defect_rate = 0.05 ## stratified: when this fraction of an archive is bad
+        self.label_positions = {} ## archive positions on each tape written, by label
         self.dump_state_code = DumpStateCode
         self.dump_state = self.dump_state_code.initialize
 
@@ -81,7 +94,7 @@ class Dump(object):
                     self.files.build_archive(archive_list)
 
                     ## files to tar on disk with catalog
-                    self.files.queue_archive(self.tape_index, archive_list)
+                    self.files.queue_archive(self.tape_index, archive_list, md5_dict=self.paperdb.file_md5_dict)
 
                     ## mark where we are
                     self.dump_state = self.dump_state_code.dump_queue
@@ -130,13 +143,25 @@ class Dump(object):
     def get_list(self, limit=7500, regex=False, pid=False, claim=True):
         """get a file_list less than limit size"""
 
+        ## several dumps can run at once if each batch is selected and claimed atomically
+        if self.atomic_claim and claim and not regex and not pid:
+            self.dump_list, list_size = self.paperdb.claim_next_batch(limit)
+            return self.dump_list, list_size
+
         ## get a 7.5 gb file_list of files to transfer
         self.dump_list, list_size = self.paperdb.get_new(limit, regex=regex, pid=pid)
 
         ## claim the files so other jobs can request different files
         if self.dump_list and claim:
             self.debug.output(str(list_size))
-            self.paperdb.claim_files(self.dump_list)
+            if self.atomic_claim and not pid:
+                ## keep only the files this dump won
+                claim_status, claimed = self.paperdb.claim_listed_files(self.dump_list)
+                claimed = set(claimed)
+                self.dump_list = [source for source in self.dump_list if source in claimed]
+                list_size = sum(self.paperdb.file_size_dict.get(source, 0) for source in self.dump_list)
+            else:
+                self.paperdb.claim_files(self.dump_list)
         return self.dump_list, list_size
 
     def tar_archive_single(self, catalog_file):
@@ -167,6 +192,7 @@ class Dump(object):
                     self.debug.output('tape write fail {}'.format(error))
                     self.close_dump()
                     break
+            self.write_positions()
 
             ## we have written two copies
             if tape_copy == 2:
@@ -213,12 +239,88 @@ class Dump(object):
         if log_label_ids_status is not self.status_code.OK:
             self.debug.output('problem dating labels: {}'.format(log_label_ids_status))
 
+        ## the positions and the local index are copies, so they don't fail the dump
+        log_positions_status = self.log_positions()
+        if log_positions_status is not self.status_code.OK:
+            self.debug.output('problem logging positions: {}'.format(log_positions_status))
+
+        update_catalog_index_status = self.update_catalog_index(tape_label_ids)
+        if update_catalog_index_status is not self.status_code.OK:
+            self.debug.output('problem updating catalog index: {}'.format(update_catalog_index_status))
+
         return log_label_ids_status
 
-    def dump_verify(self, tape_id, drive=0):
+    def write_positions(self):
+        """end each tape with the positions of its archives
+
+        The tapes can still be read without the positions, so a failure here
+        doesn't stop the dump; it is logged and returned.
+
+        :rtype: StatusCode
+        """
+        write_positions_status = self.status_code.OK
+        try:
+            self.label_positions.update(self.tape.write_positions())
+        except Exception as error:
+            self.debug.output('positions write error {}'.format(error))
+            write_positions_status = self.status_code.write_positions
+
+        return write_positions_status
+
+    def log_positions(self):
+        """send the archive positions of each tape to the mtx db
+
+        :rtype: StatusCode
+        """
+        log_positions_status = self.status_code.OK
+        for label, positions in self.label_positions.items():
+            try:
+                self.labeldb.insert_positions(label, positions, self.tape.tape_drives.record_size)
+            except Exception as mysql_error:
+                self.debug.output('problem writing positions for {}: {}'.format(label, mysql_error))
+                log_positions_status = self.status_code.log_positions_mysql
+
+        return log_positions_status
+
+    def select_positions(self, tape_id, tape_pid):
+        """the archive positions of a tape recorded in the mtx db by the dump that wrote it
+
+        :rtype: dict of (tape_file, start_block, end_block, block_size) by tape_index, empty if there are none
+        """
+        try:
+            return self.labeldb.select_positions(tape_id, pid=tape_pid)
+        except Exception as mysql_error:
+            self.debug.output('problem reading positions for {}: {}'.format(tape_id, mysql_error))
+            return {}
+
+    def update_catalog_index(self, tape_label_ids):
+        """add the files of this dump to the local catalog index
+
+        The index is a convenience copy of the tape locations, so a failure here
+        doesn't stop the dump; it is logged and returned.
+
+        :rtype: StatusCode
+        """
+        update_catalog_index_status = self.status_code.OK
+        try:
+            catalog = CatalogIndex(self.pid, catalog_db=self.catalog_db, debug=self.debug.debug_state, debug_threshold=self.debug.debug_threshold)
+            obsnum_dict = self.paperdb.file_obsnums([item[2] for item in self.files.tape_list])
+            catalog.add_tape_list(self.files.tape_list, self.paperdb.file_md5_dict, tape_label_ids, self.version,
+                                  dump_pid=self.pid, dump_date=datetime.now().strftime('%Y%m%d-%H%M'), obsnum_dict=obsnum_dict)
+            for label, positions in self.label_positions.items():
+                catalog.add_positions(label, positions, self.tape.tape_drives.record_size, dump_pid=self.pid)
+            catalog.close_catalog()
+        except Exception as error:
+            self.debug.output('catalog index error {}'.format(error))
+            update_catalog_index_status = self.status_code.update_catalog_index
+
+        return update_catalog_index_status
+
+    def dump_verify(self, tape_id, drive=0, verify_mode=None):
         """take the tape_id and run a self check,
         then confirm the tape_list matches
 
+        :param verify_mode: sample, stratified or full; defaults to self.verify_mode
         """
         dump_verify_status = self.status_code.OK
 
@@ -226,7 +328,7 @@ class Dump(object):
         self.dump_state = self.dump_state_code.dump_verify
 
         ## run a tape_self_check
-        self_check_status, item_index, catalog_list, md5_dict, tape_pid = self.tape_self_check(tape_id, drive)
+        self_check_status, item_index, catalog_list, md5_dict, tape_pid = self.tape_self_check(tape_id, drive, verify_mode=verify_mode)
 
         ## take output from tape_self_check and compare against current dump
         if self_check_status is self.status_code.OK:
@@ -258,11 +360,12 @@ class Dump(object):
         self.debug.output('final {}'.format(dump_verify_status))
         return dump_verify_status
 
-    def tape_self_check(self, tape_id, drive=0):
+    def tape_self_check(self, tape_id, drive=0, verify_mode=None):
         """process to take a tape and run integrity check without reference to external database
 
         :rtype : bool
         """
+        verify_mode = self.verify_mode if verify_mode is None else verify_mode
         tape_self_check_status = self.status_code.OK
 
         ## load the tape if necessary
@@ -277,7 +380,17 @@ class Dump(object):
         ## build an file_md5_dict
         item_index, catalog_list, md5_dict, tape_pid = self.files.final_from_file(catalog=first_block)
 
-        tape_archive_md5_status, reference = self.tape.tape_archive_md5(tape_id, tape_pid, catalog_list, md5_dict, drive)
+        ## seek straight to the archives if their positions are known; the
+        ## positions only decide where to read, the files are still checked
+        ## against the catalog on the tape
+        positions = self.tape.archive_start_blocks(tape_id, tape_pid, [item[0] for item in catalog_list],
+                                                   stored_positions=self.select_positions(tape_id, tape_pid))
+
+        tape_archive_md5_status, reference = self.tape.tape_archive_md5(tape_id, tape_pid, catalog_list, md5_dict, drive,
+                                                                        verify_mode=verify_mode,
+                                                                        confidence=self.verify_confidence,
+                                                                        defect_rate=self.verify_defect_rate,
+                                                                        positions=positions)
         if tape_archive_md5_status is not self.status_code.OK:
             self.debug.output("tape failed md5 inspection at index: %s, status: %s" % (reference, tape_archive_md5_status))
             tape_self_check_status = tape_archive_md5_status
@@ -303,6 +416,7 @@ class Dump(object):
             except Exception as error:
                 self.debug.output('tape writing exception {}'.format(error))
                 break
+        self.write_positions()
 
         self.tape.unload_tape_pair()
 
@@ -386,7 +500,12 @@ class DumpFast(Dump):
         self.tape.prep_tape(catalog_file)
 
         self.debug.output('got list - {}'.format(self.files.tape_list))
-        self.tape.archive_from_list(self.files.tape_list)
+        try:
+            self.tape.archive_from_list(self.files.tape_list, md5_dict=self.paperdb.file_md5_dict)
+        except Exception as error:
+            self.debug.output('archive write error {}'.format(error))
+            self.close_dump()
+        self.write_positions()
 
         ## unloading the tape pair allows for the tape to be loaded back from the library
         ## for verification later
@@ -442,7 +561,7 @@ class DumpFast(Dump):
 
                     ## archives to tar from disk with catalog file
                     ## also write the self.files.archive_list
-                    self.files.queue_archive(self.tape_index, archive_list)
+                    self.files.queue_archive(self.tape_index, archive_list, md5_dict=self.paperdb.file_md5_dict)
 
                     ## mark where we are
                     self.dump_state = self.dump_state_code.dump_queue
@@ -476,60 +595,92 @@ class DumpFast(Dump):
         self.debug.output("complete:%s:%s:%s:%s" % (queue, regex, pid, claim))
         return True if self.tape_used_size != 0 else False
 
+    def plan_batch_files(self, claim=True):
+        """populate self.catalog_list from a packed plan of one tape
 
-# noinspection PyMissingConstructor
-class DumpFaster(DumpFast):
+        Instead of greedily filling batches in filename order, take a window of
+        candidate files and pack them into batches and one tape with BatchPlanner.
+        The tape_size slack reserved for greedy batching is not needed, so the plan
+        fills tape_size + batch_size_mb. Files left out of the plan are not claimed,
+        and batches that another dump took files from are dropped.
+        """
+        tape_capacity = self.tape_size + self.batch_size_mb
+        planner = BatchPlanner(self.pid, self.batch_size_mb, tape_capacity, debug=self.debug.debug_state, debug_threshold=self.debug.debug_threshold)
 
-    """Queless archiving means that the data is never transferred to our disk queues
+        ## candidate window of a little more than one tape, sized in MB rather than rows
+        candidate_list, candidate_size = self.paperdb.get_next_batch(tape_capacity * planner.plan_window)
+        candidate_sizes = [self.paperdb.file_size_dict[source] for source in candidate_list]
+        self.debug.output('planning {} candidate files, {} MB'.format(len(candidate_list), candidate_size))
 
-    Disk queues are still used to maintain state in the event of a partial dump failure
-    Tape verification is rewritten to make use of python threading.
+        ## report the plan before anything is claimed
+        tape_plan = planner.plan_tape(candidate_list, candidate_sizes)
 
-    """
+        ## unplanned candidates are still unclaimed, so start the next search from the top
+        self.paperdb.reset_batch_cursor()
 
-    def  __init__(self, credentials='/papertape/etc/my.papertape-test.cnf', mtx_credentials='/home2/obs/.my.mtx.cnf', debug=False, pid=None, disk_queue=True, drive_select=2, debug_threshold=255):
-        """initialize"""
+        planned_batches = [[candidate_list[file_index] for file_index in batch] for batch in tape_plan['batches']]
+        if claim:
+            planned_batches = self.claim_planned_batches(planned_batches)
 
-        self.version = __version__
-        self.pid = "%0.6d%0.3d" % (getpid(), randint(1, 999)) if pid is None else pid
-        self.debug = Debug(self.pid, debug=debug, debug_threshold=debug_threshold)
+        for archive_list in planned_batches:
+            list_size = sum(self.paperdb.file_size_dict[source] for source in archive_list)
 
-        self.status_code = StatusCode
-        self.check_credentials_file(mtx_credentials)
-        self.mtx_creds = mtx_credentials
+            ## we must perform the cataloging task otherwise done by queue_archive()
+            arcname = "%s.%s.%s" % ('paper', self.pid, self.tape_index)
+            catalog_name = "%s/%s.file_list" %(self.files.queue_dir, arcname)
+            self.files.gen_catalog(catalog_name, archive_list, self.tape_index)
 
-        self.debug.output(credentials)
-        self.check_credentials_file(credentials)
-        self.paper_creds = credentials
+            self.tape_used_size += list_size
+            self.tape_index += 1
+            self.files.tape_list.extend(self.files.archive_list)
 
-        self.tape_ids = ''
+        self.debug.output("planned:%s:%s:%s" % (self.tape_index, self.tape_used_size, tape_plan['fill_ratio']))
+        return True if self.tape_used_size != 0 else False
 
-        ## each dump process 12GB to /dev/shm (two at a time)
-        self.batch_size_mb = 12000
 
-        ## (1.5Tb -1 batch)
-        self.tape_size = (1.5 * 1000 * 1000) - self.batch_size_mb
-        #self.tape_size = 13000
+    def claim_planned_batches(self, planned_batches):
+        """claim the files of every planned batch, keeping only the batches claimed whole
 
-        ## setup PaperDB connection
-        self.paperdb = PaperDB(self.version, self.paper_creds, self.pid, debug=True, debug_threshold=debug_threshold)
+        Another dump planning from the same candidates may win some of the files;
+        a batch missing files is dropped and the files we did claim are released.
 
-        ## setup tape library
-        self.labeldb = MtxDB(self.version, self.mtx_creds, self.pid, debug=debug, debug_threshold=debug_threshold)
+        :param planned_batches: list of lists of sources
+        :rtype: list of the batches that were claimed
+        """
+        claim_status, claimed = self.paperdb.claim_listed_files([source for batch in planned_batches for source in batch])
+        claimed = set(claimed)
+
+        claimed_batches = []
+        released = []
+        for archive_list in planned_batches:
+            if all(source in claimed for source in archive_list):
+                claimed_batches.append(archive_list)
+            else:
+                released.extend(source for source in archive_list if source in claimed)
 
-        ## setup file access
-        self.files = Archive(self.version, self.pid, debug=debug, debug_threshold=debug_threshold)
+        if released:
+            self.debug.output('dropping {} partly claimed batches'.format(len(planned_batches) - len(claimed_batches)))
+            self.paperdb.unclaim_files(released)
 
-        ## use the pid here to lock changer
-        self.drive_select = drive_select
-        self.tape = Changer(self.version, self.pid, self.tape_size, debug=True, drive_select=drive_select, disk_queue=disk_queue, debug_threshold=debug_threshold)
+        return claimed_batches
 
-        self.dump_list = []
-        self.tape_index = 0
-        self.tape_used_size = 0 ## each dump process should write one tape worth of data
-        self.dump_state_code = DumpStateCode
-        self.dump_state = self.dump_state_code.initialize
 
+class DumpFaster(DumpFast):
+
+    """Queless archiving means that the data is never transferred to our disk queues
+
+    Disk queues are still used to maintain state in the event of a partial dump failure
+    Tape verification is rewritten to make use of python threading.
+
+    """
+
+    def  __init__(self, credentials='/papertape/etc/my.papertape-test.cnf', mtx_credentials='/home2/obs/.my.mtx.cnf', debug=False, pid=None, disk_queue=True, drive_select=2, debug_threshold=255):
+        """initialize; check the credentials files, then set up as Dump does"""
+
+        self.check_credentials_file(mtx_credentials)
+        self.check_credentials_file(credentials)
+        Dump.__init__(self, credentials=credentials, mtx_credentials=mtx_credentials, debug=debug, pid=pid,
+                      disk_queue=disk_queue, drive_select=drive_select, debug_threshold=debug_threshold)
 
     def check_credentials_file(self, credentials):
         """Run checks on a credentials file; currently just check that it exists and is not empty.
@@ -571,15 +722,18 @@ class DumpFaster(DumpFast):
         ## foreach status code, check if either is not "OK"
         return reduce(_check_thread_status, return_codes)
 
-    def fast_batch(self):
+    def fast_batch(self, plan=False):
         """skip tar of local archive on disk
-           send files to two tapes using a single drive."""
+           send files to two tapes using a single drive.
+
+        :param plan: pack the tape with plan_batch_files() instead of batch_files()
+        """
 
         ## batch_files() does the job of making the lists that queue_archive does
         ## it also updates self.tape_index which is used by Changer.write()
         self.debug.output('reloading sample data into paperdatatest database')
 
-        if self.batch_files():
+        if self.plan_batch_files() if plan else self.batch_files():
             self.debug.output('found %s files' % len(self.files.tape_list))
             self.files.gen_final_catalog(self.files.catalog_name, self.files.tape_list, self.paperdb.file_md5_dict)
             self.tar_archive_fast(self.files.catalog_name)
@@ -608,7 +762,12 @@ class DumpFaster(DumpFast):
 
         ## actually write the files in the catalog to a tape pair
         self.debug.output('got list - {}'.format(self.files.tape_list))
-        self.tape.archive_from_list(self.files.tape_list)
+        try:
+            self.tape.archive_from_list(self.files.tape_list, md5_dict=self.paperdb.file_md5_dict)
+        except Exception as error:
+            self.debug.output('archive write error {}'.format(error))
+            self.close_dump()
+        self.write_positions()
 
         ## check the status of the dumps
         tar_archive_fast_status = self.dump_pair_verify(tape_label_ids)
@@ -627,6 +786,141 @@ class DumpFaster(DumpFast):
 
 
 
+class DumpPipeline(DumpFaster):
+
+    """Pipelined dumps keep the drives writing while the next batches are staged
+
+    The tape is planned and claimed first, because the catalog at the start of
+    the tape must list every batch. The batches then run through the stage,
+    archive and write stages of a Pipeline, and the tape pair is verified once
+    the last batch is written. self.dump_state only moves on once every batch
+    has passed a stage, so close_dump() cleans up for the least advanced batch.
+    """
+
+    def  __init__(self, credentials='/papertape/etc/my.papertape-test.cnf', mtx_credentials='/home2/obs/.my.mtx.cnf', debug=False, pid=None, disk_queue=True, drive_select=2, debug_threshold=255):
+        """initialize"""
+        DumpFaster.__init__(self, credentials=credentials, mtx_credentials=mtx_credentials, debug=debug, pid=pid,
+                            disk_queue=disk_queue, drive_select=drive_select, debug_threshold=debug_threshold)
+
+        ## workers per stage and batches waiting between stages
+        self.stage_workers = 2
+        self.archive_workers = 1
+        self.pipeline_queue_size = 1
+
+        self.tapes_ready = Event()
+        self.load_error = None
+        self.batch_lock = Lock()
+        self.batch_count = 0
+        self.batches_done = {}
+
+    def batch_done(self, dump_state):
+        """count a batch through a stage; once every batch is through, move the dump state on"""
+        with self.batch_lock:
+            self.batches_done[dump_state] = self.batches_done.get(dump_state, 0) + 1
+            if self.batches_done[dump_state] == self.batch_count:
+                self.dump_state = dump_state
+
+    def stage_batch(self, batch):
+        """pipeline stage: copy the files of a batch to the staging directory"""
+        tape_index, archive_list = batch
+        self.files.build_batch(tape_index, archive_list)
+        return batch
+
+    def archive_batch(self, batch):
+        """pipeline stage: tar a staged batch into the queue directory, checking md5s"""
+        tape_index, archive_list = batch
+        self.files.queue_batch(tape_index, archive_list, md5_dict=self.paperdb.file_md5_dict)
+        self.batch_done(self.dump_state_code.dump_queue)
+        return batch
+
+    def write_batch(self, batch):
+        """pipeline stage: write a queued batch to the tape pair, in tape order"""
+        tape_index, archive_list = batch
+        self.tapes_ready.wait()
+        if self.load_error is not None:
+            raise Exception('tape pair not ready - {}'.format(self.load_error))
+        self.tape.write(tape_index)
+        self.batch_done(self.dump_state_code.dump_write)
+        return batch
+
+    def load_tapes(self, tape_label_ids):
+        """load the tape pair and write the catalog while the first batch is staged
+
+        A failure is kept in self.load_error for write_batch(), which would
+        otherwise write to tapes that aren't loaded or have no catalog.
+        """
+        try:
+            if not self.tape.load_tape_pair(tape_label_ids):
+                raise Exception('failed to load tape pair {}'.format(tape_label_ids))
+            self.tape.prep_tape(self.files.catalog_name)
+        except Exception as load_error:
+            self.debug.output('tape load error {}'.format(load_error))
+            self.load_error = load_error
+        finally:
+            self.tapes_ready.set()
+
+    def pipeline_batch(self, plan=True):
+        """plan and claim a tape, then stage, archive and write its batches in a pipeline
+
+        The files are claimed by plan_batch_files() or batch_files(), which take
+        locking claims that skip other dumps' files while atomic_claim is set.
+
+        :param plan: pack the tape with plan_batch_files() instead of batch_files()
+        :rtype: bool true if a tape was dumped and verified
+        """
+        if not (self.plan_batch_files() if plan else self.batch_files()):
+            self.debug.output("no files batched")
+            return False
+
+        self.dump_state = self.dump_state_code.dump_list
+        self.debug.output('found %s files' % len(self.files.tape_list))
+        self.files.gen_final_catalog(self.files.catalog_name, self.files.tape_list, self.paperdb.file_md5_dict)
+
+        ## the batches of the tape in tape_index order
+        archive_dict = {}
+        for tape_index, archive_index, file_name in self.files.tape_list:
+            archive_dict.setdefault(tape_index, []).append(file_name)
+        batches = sorted(archive_dict.items())
+        self.batch_count = len(batches)
+
+        tape_label_ids = self.labeldb.select_ids()
+        self.labeldb.claim_ids(tape_label_ids)
+        tape_loader = Thread(target=self.load_tapes, args=(tape_label_ids,))
+        tape_loader.start()
+
+        pipeline = Pipeline(self.pid, [
+            PipelineStage('stage', self.stage_batch, workers=self.stage_workers),
+            PipelineStage('archive', self.archive_batch, workers=self.archive_workers),
+            PipelineStage('write', self.write_batch, ordered=True),
+        ], queue_size=self.pipeline_queue_size, debug=self.debug.debug_state, debug_threshold=self.debug.debug_threshold)
+
+        try:
+            pipeline.run(batches)
+        except Exception as error:
+            self.debug.output('pipeline error {}'.format(error))
+            tape_loader.join()
+            self.close_dump()
+            return False
+        tape_loader.join()
+        self.write_positions()
+
+        ## check the status of the dumps
+        pipeline_status = self.dump_pair_verify(tape_label_ids)
+        self.tape.unload_tape_pair()
+
+        ## update the db if the current dump status is OK
+        if pipeline_status is self.status_code.OK:
+            log_label_ids_status = self.log_label_ids(tape_label_ids)
+            if log_label_ids_status is not self.status_code.OK:
+                self.debug.output('problem writing labels out: {}'.format(log_label_ids_status))
+        else:
+            self.debug.output("Abort dump: {}".format(pipeline_status))
+            self.close_dump()
+            return False
+
+        return True
+
+
 # noinspection PyClassHasNoInit
 @unique
 class DumpStateCode(Enum):
@@ -6,22 +6,550 @@
    Transfers are completed using scp
 """
 
+import io
 import os
+import errno
+import queue
+import fcntl
 import shutil
 import tarfile
 import re
 import datetime
+import time
+import threading
 
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
 #from paper_paramiko import Transfer
 from paper_debug import Debug
 
 
-def get(src_dir, local_path='/dev/null', recursive=True):
+def get(src_dir, local_path='/dev/null', recursive=True, copy_function=shutil.copy2):
     """Get the given file"""
-    shutil.copytree(src_dir, local_path)
+    shutil.copytree(src_dir, local_path, copy_function=copy_function)
 
 
+## FICLONE from linux/fs.h: share the source extents with the destination
+FICLONE = 0x40049409
+
+## errors meaning a copy strategy isn't supported between two filesystems
+unsupported_errnos = set(getattr(errno, name) for name in
+                         ('EXDEV', 'EOPNOTSUPP', 'ENOTSUP', 'EINVAL', 'ENOSYS', 'ENOTTY', 'EPERM', 'EBADF')
+                         if hasattr(errno, name))
+
+
+def copy_reflink(source_path, destination_path):
+    """clone the file extents (btrfs, xfs); no data is copied"""
+    with open(source_path, mode='rb') as source_file, open(destination_path, mode='wb') as destination_file:
+        fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+    shutil.copystat(source_path, destination_path)
+
+
+def copy_hardlink(source_path, destination_path):
+    """link the destination to the source inode; no data is copied"""
+    os.link(source_path, destination_path)
+
+
+def copy_range(source_path, destination_path, chunk_size=64 * 1024 * 1024):
+    """copy in the kernel with copy_file_range"""
+    with open(source_path, mode='rb') as source_file, open(destination_path, mode='wb') as destination_file:
+        while os.copy_file_range(source_file.fileno(), destination_file.fileno(), chunk_size):
+            pass
+    shutil.copystat(source_path, destination_path)
+
+
+def copy_sendfile(source_path, destination_path, chunk_size=64 * 1024 * 1024):
+    """copy in the kernel with sendfile"""
+    with open(source_path, mode='rb') as source_file, open(destination_path, mode='wb') as destination_file:
+        offset = 0
+        while True:
+            sent = os.sendfile(destination_file.fileno(), source_file.fileno(), offset, chunk_size)
+            if not sent:
+                break
+            offset += sent
+    shutil.copystat(source_path, destination_path)
+
+
+def copy_buffered(source_path, destination_path, chunk_size=4 * 1024 * 1024):
+    """copy through a userspace buffer; works everywhere"""
+    with open(source_path, mode='rb') as source_file, open(destination_path, mode='wb') as destination_file:
+        shutil.copyfileobj(source_file, destination_file, chunk_size)
+    shutil.copystat(source_path, destination_path)
+
+
+## fastest first; reflinks and hardlinks only work inside one filesystem
+copy_strategies = [
+    ('reflink', copy_reflink, True),
+    ('hardlink', copy_hardlink, True),
+    ('copy_file_range', copy_range, False),
+    ('sendfile', copy_sendfile, False),
+    ('buffered', copy_buffered, False),
+]
+
+
+class CopySelector(object):
+    """pick the fastest copy strategy that works for each source mount
+
+    The first file copied from a mount tries each strategy in turn, fastest first;
+    the first one that works is remembered for the rest of that mount's files. A
+    strategy that later fails as unsupported is dropped for the mount.
+    """
+
+    def __init__(self, pid, strategies=None, debug=False, debug_threshold=255):
+        """initialize the strategy cache
+        :type strategies: list
+        :param strategies: names of the strategies to allow, defaults to every strategy in copy_strategies
+        """
+        self.pid = pid
+        self.debug = Debug(self.pid, debug=debug, debug_threshold=debug_threshold)
+
+        self.strategies = [strategy for strategy in copy_strategies if strategies is None or strategy[0] in strategies]
+        self.select_lock = threading.Lock()
+        self.mount_strategy = {}   ## index into self.strategies by (source device, destination device)
+
+    def mount_key(self, source_path, destination_path):
+        """(source device, destination device) for a copy"""
+        return os.stat(source_path).st_dev, os.stat(os.path.dirname(destination_path)).st_dev
+
+    def strategy_report(self):
+        """return the strategy used by each (source device, destination device) pair"""
+        with self.select_lock:
+            return dict((key, self.strategies[index][0]) for key, index in self.mount_strategy.items())
+
+    def copy(self, source_path, destination_path):
+        """copy one file with the selected strategy for its mount"""
+        mount_key = self.mount_key(source_path, destination_path)
+        with self.select_lock:
+            strategy_index = self.mount_strategy.get(mount_key, 0)
+
+        same_filesystem = mount_key[0] == mount_key[1]
+        for index in range(strategy_index, len(self.strategies)):
+            strategy_name, strategy_copy, same_filesystem_only = self.strategies[index]
+            if same_filesystem_only and not same_filesystem:
+                continue
+
+            try:
+                strategy_copy(source_path, destination_path)
+            except OSError as copy_error:
+                if copy_error.errno not in unsupported_errnos:
+                    raise
+                self.debug.output('{} unsupported for {} - {}'.format(strategy_name, mount_key, copy_error), debug_level=250)
+                if os.path.lexists(destination_path):
+                    os.remove(destination_path)
+                continue
+
+            with self.select_lock:
+                if self.mount_strategy.get(mount_key) != index:
+                    self.debug.output('copy strategy for {}: {}'.format(mount_key, strategy_name))
+                    self.mount_strategy[mount_key] = index
+            return destination_path
+
+        raise Exception('no copy strategy worked for {}'.format(source_path))
+
+
+
+def md5_file(file_path, chunk_size=4 * 1024 * 1024):
+    """return the md5 hexdigest of a file, read chunk_size bytes at a time
+
+    The read buffer is reused, so memory use stays at chunk_size whatever the
+    size of the file. hashlib releases the GIL while hashing, so several files
+    can be hashed at once from threads.
+    """
+    hasher = hashlib.md5()
+    read_buffer = bytearray(chunk_size)
+    read_view = memoryview(read_buffer)
+
+    with open(file_path, mode='rb', buffering=0) as open_file:
+        while True:
+            read_size = open_file.readinto(read_buffer)
+            if not read_size:
+                break
+            hasher.update(read_view[:read_size])
+
+    return hasher.hexdigest()
+
+
+def md5_files(file_paths, workers=4, chunk_size=4 * 1024 * 1024):
+    """return a dictionary of md5 hexdigests by path, hashing up to workers files at once"""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        digests = executor.map(lambda file_path: md5_file(file_path, chunk_size=chunk_size), file_paths)
+        return dict(zip(file_paths, digests))
+
+
+class ParallelHasher(object):
+    """md5 streams of data on a pool of threads while the caller keeps reading
+
+    Chunks of each stream (key) are queued to the same worker, so every stream is
+    hashed in order while different streams are hashed at the same time. The
+    queues are bounded, so the reader is held back when hashing falls behind.
+    """
+
+    def __init__(self, workers=4, queue_chunks=16):
+        """start the workers
+        :type workers: int
+        :type queue_chunks: int
+        :param queue_chunks: chunks waiting per worker
+        """
+        self.hashes = {}
+        self.worker_by_key = {}
+        self.closed = False
+        self.queues = [queue.Queue(maxsize=queue_chunks) for _ in range(workers)]
+        self.workers = [threading.Thread(target=self._hash, args=(chunk_queue,), daemon=True) for chunk_queue in self.queues]
+        for worker in self.workers:
+            worker.start()
+
+    def _hash(self, chunk_queue):
+        """worker loop"""
+        while True:
+            key, chunk = chunk_queue.get()
+            if key is None:
+                return
+            self.hashes[key].update(chunk)
+
+    def update(self, key, chunk):
+        """queue a chunk of the given stream"""
+        if key not in self.hashes:
+            self.hashes[key] = hashlib.md5()
+            self.worker_by_key[key] = len(self.worker_by_key) % len(self.queues)
+        self.queues[self.worker_by_key[key]].put((key, chunk))
+
+    def close(self):
+        """wait for every queued chunk and stop the workers; safe to call more than once
+
+        :rtype: dict of md5 hexdigests by key
+        """
+        if not self.closed:
+            self.closed = True
+            for chunk_queue in self.queues:
+                chunk_queue.put((None, None))
+            for worker in self.workers:
+                worker.join()
+        return dict((key, key_hash.hexdigest()) for key, key_hash in self.hashes.items())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class HashingReader(object):
+    """file object wrapper that hashes every byte read through it"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hasher = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hasher.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+def walk_tarinfo(archive_tar, file_path, arcname):
+    """generator of (member_path, tarinfo, relative_path) for file_path and everything
+    under it, in the order add_hashed() archives them"""
+    tarinfo = archive_tar.gettarinfo(file_path, arcname=arcname)
+    if tarinfo is None:
+        return
+
+    yield file_path, tarinfo, ''
+    if tarinfo.isdir():
+        for member_name in sorted(os.listdir(file_path)):
+            for member_path, member_tarinfo, relative_path in walk_tarinfo(
+                    archive_tar, os.path.join(file_path, member_name), os.path.join(arcname, member_name)):
+                yield member_path, member_tarinfo, os.path.join(member_name, relative_path) if relative_path else member_name
+
+
+def add_hashed(archive_tar, file_path, arcname, hash_name='visdata'):
+    """add file_path to archive_tar like tarfile.add(), hashing every file named
+    hash_name in the same read that feeds the archive
+
+    :rtype: dict of md5 hexdigests by the path of each hashed file relative to file_path
+    """
+    digests = {}
+
+    for member_path, tarinfo, relative_path in walk_tarinfo(archive_tar, file_path, arcname):
+        if tarinfo.isreg():
+            with open(member_path, mode='rb') as member_file:
+                if os.path.basename(member_path) == hash_name:
+                    member_reader = HashingReader(member_file)
+                    archive_tar.addfile(tarinfo, member_reader)
+                    digests[relative_path] = member_reader.hexdigest()
+                else:
+                    archive_tar.addfile(tarinfo, member_file)
+        else:
+            archive_tar.addfile(tarinfo)
+
+    return digests
+
+
+def tar_stream_size(members, tar_format=tarfile.DEFAULT_FORMAT):
+    """return the size in bytes of an uncompressed tar of the given (file_path, arcname)
+    members as written by add_hashed(), without reading any data
+
+    The size has to be known before a tar can be streamed into another tar.
+    """
+    scratch_tar = tarfile.open(fileobj=io.BytesIO(), mode='w', format=tar_format)
+    size = 0
+    for file_path, arcname in members:
+        for member_path, tarinfo, relative_path in walk_tarinfo(scratch_tar, file_path, arcname):
+            size += len(tarinfo.tobuf(scratch_tar.format, scratch_tar.encoding, scratch_tar.errors))
+            if tarinfo.isreg():
+                size += -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+    ## two empty end of archive blocks, then padding to a whole record
+    size += 2 * tarfile.BLOCKSIZE
+    return -(-size // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+
+
+class RingBuffer(object):
+    """fixed size byte buffer between one writer thread and one reader thread
+
+    write() blocks while the buffer is full and read() blocks until the requested
+    bytes (or the end of the stream) are there, so the two sides run at the same
+    time in bounded memory.
+    """
+
+    def __init__(self, capacity):
+        """allocate the buffer
+        :type capacity: int
+        :param capacity: buffer size in bytes
+        """
+        self.capacity = capacity
+        self.buffer = bytearray(capacity)
+        self.start = 0           ## offset of the first unread byte
+        self.length = 0          ## unread bytes
+        self.bytes_written = 0
+        self.closed = False
+        self.error = None
+        self.ring_lock = threading.Condition()
+
+    def write(self, data):
+        """copy data into the buffer, waiting for room as needed"""
+        data_view = memoryview(data).cast('B')
+        while len(data_view):
+            with self.ring_lock:
+                while self.length == self.capacity and self.error is None:
+                    self.ring_lock.wait()
+                if self.error is not None:
+                    raise Exception('ring buffer aborted - {}'.format(self.error))
+
+                count = min(len(data_view), self.capacity - self.length)
+                end = (self.start + self.length) % self.capacity
+                first = min(count, self.capacity - end)
+                self.buffer[end:end + first] = data_view[:first]
+                self.buffer[:count - first] = data_view[first:count]
+                self.length += count
+                self.bytes_written += count
+                self.ring_lock.notify_all()
+
+            data_view = data_view[count:]
+        return len(data)
+
+    def read(self, size=-1):
+        """return size bytes (fewer only at the end of the stream)"""
+        with self.ring_lock:
+            wanted = self.capacity if size < 0 else min(size, self.capacity)
+            while self.length < wanted and not self.closed and self.error is None:
+                self.ring_lock.wait()
+            if self.error is not None:
+                raise Exception('ring buffer aborted - {}'.format(self.error))
+
+            count = min(wanted, self.length)
+            first = min(count, self.capacity - self.start)
+            data = bytes(self.buffer[self.start:self.start + first]) + bytes(self.buffer[:count - first])
+            self.start = (self.start + count) % self.capacity
+            self.length -= count
+            self.ring_lock.notify_all()
+            return data
+
+    def close(self):
+        """mark the end of the stream"""
+        with self.ring_lock:
+            self.closed = True
+            self.ring_lock.notify_all()
+
+    def abort(self, error):
+        """fail both sides of the stream"""
+        with self.ring_lock:
+            self.error = error
+            self.ring_lock.notify_all()
+
+
+def check_hashed(dir_path, digest, md5_dict, debug):
+    """raise if the md5 of dir_path/visdata hashed while archiving doesn't match md5_dict"""
+    expected = md5_dict.get(dir_path)
+    if expected is None:
+        debug.output('no md5 to check for {}'.format(dir_path))
+    elif digest != expected:
+        debug.output('md5 mismatch while archiving {}: {} != {}'.format(dir_path, digest, expected))
+        raise Exception('archive md5 mismatch {}'.format(dir_path))
+    else:
+        debug.output('md5 match: {}|{}'.format(digest, expected), debug_level=250)
+
+
+def tree_size(dir_path):
+    """return the total size in bytes of the regular files under dir_path"""
+    if os.path.isfile(dir_path):
+        return os.path.getsize(dir_path)
+
+    total = 0
+    for root, dirs, files in os.walk(dir_path):
+        for file_name in files:
+            file_path = os.path.join(root, file_name)
+            if not os.path.islink(file_path):
+                total += os.path.getsize(file_path)
+    return total
+
+
+class Stager(object):
+    """copy the directories of a batch into a staging directory in parallel
+
+    Copies run on a pool of workers, at most filesystem_workers at a time from
+    any one source filesystem. Staged bytes are counted against a byte budget
+    until release() is called for them, so the staging directory can't be
+    overfilled; each call to stage() reserves its whole batch before copying.
+    Files are copied with the fastest strategy CopySelector finds for their
+    source mount.
+    """
+
+    def __init__(self, pid, workers=4, filesystem_workers=2, budget_mb=None, copy_strategies=None, debug=False, debug_threshold=255):
+        """initialize the staging limits
+        :type pid: basestring
+        :type workers: int
+        :param workers: number of copies to run at once
+        :type filesystem_workers: int
+        :param filesystem_workers: number of copies to run at once from one source filesystem
+        :type budget_mb: float
+        :param budget_mb: most MB staged at once; defaults to the free space of the staging directory
+        :type copy_strategies: list
+        :param copy_strategies: names of the copy strategies to allow, defaults to all of them
+        """
+        self.pid = pid
+        self.debug = Debug(self.pid, debug=debug, debug_threshold=debug_threshold)
+
+        self.workers = workers
+        self.filesystem_workers = filesystem_workers
+        self.budget_mb = budget_mb
+
+        self.filesystem_locks = {}
+        self.stage_lock = threading.Condition()
+        self.staged_bytes = {}   ## bytes staged (or being staged) by destination path
+        self.copying = 0         ## copies in flight
+        self.reserve_timeout = 3600 ## seconds stage(wait=True) waits for staging room before giving up
+        self.stage_report = {}
+        self.selector = CopySelector(self.pid, strategies=copy_strategies, debug=debug, debug_threshold=debug_threshold)
+
+    def filesystem_semaphore(self, source_path):
+        """return the semaphore limiting copies from the filesystem of source_path"""
+        try:
+            filesystem = os.stat(source_path).st_dev
+        except OSError:
+            filesystem = source_path.split('/')[1] if '/' in source_path else source_path
+
+        with self.stage_lock:
+            if filesystem not in self.filesystem_locks:
+                self.filesystem_locks[filesystem] = threading.Semaphore(self.filesystem_workers)
+            return self.filesystem_locks[filesystem]
+
+    def reserve(self, reservations, budget_bytes, wait=False):
+        """count every (destination_path, size) in reservations as staged, all at once
+
+        A batch is reserved whole before any of it is copied, so batches staged
+        side by side never each hold part of the budget while waiting for the
+        rest. A full budget fails at once, unless wait is set (a pipeline releases
+        each batch once it is archived); then it is waited on for up to
+        reserve_timeout seconds. A batch larger than the whole budget always fails
+        at once.
+        """
+        size = sum(reservation[1] for reservation in reservations)
+        if size > budget_bytes:
+            raise Exception('staging budget of {} bytes is smaller than {} files ({} bytes)'.format(budget_bytes, len(reservations), size))
+
+        with self.stage_lock:
+            while sum(self.staged_bytes.values()) + size > budget_bytes:
+                if not wait:
+                    raise Exception('staging budget of {} bytes exceeded by {} files ({} bytes)'.format(budget_bytes, len(reservations), size))
+                if not self.stage_lock.wait(timeout=self.reserve_timeout):
+                    raise Exception('no staging room for {} files ({} bytes) after {}s'.format(len(reservations), size, self.reserve_timeout))
+
+            self.staged_bytes.update(reservations)
+
+    def copy_done(self):
+        """mark a copy as finished"""
+        with self.stage_lock:
+            self.copying -= 1
+            self.stage_lock.notify_all()
+
+    def release(self, destination_path):
+        """stop counting a staged path against the budget"""
+        with self.stage_lock:
+            self.staged_bytes.pop(destination_path, None)
+            self.stage_lock.notify_all()
+
+    def stage_one(self, source_path, destination_path, size):
+        """copy a single file or directory tree, already reserved with reserve()
+        :rtype: (str, float, float) destination_path, MB copied, seconds
+        """
+        with self.stage_lock:
+            self.copying += 1
+
+        try:
+            with self.filesystem_semaphore(source_path):
+                start_time = time.time()
+                get(source_path, local_path=destination_path, recursive=True, copy_function=self.selector.copy)
+                elapsed = time.time() - start_time
+        except Exception:
+            self.release(destination_path)
+            raise
+        finally:
+            self.copy_done()
+
+        size_mb = size / 1000 / 1000
+        self.debug.output('staged {} - {:.2f} MB in {:.2f}s ({:.2f} MB/s)'.format(
+            source_path, size_mb, elapsed, size_mb / elapsed if elapsed else 0))
+        return destination_path, size_mb, elapsed
+
+    def stage(self, copy_list, stage_dir, wait=False):
+        """copy every (source_path, destination_path) pair in copy_list
+
+        :param stage_dir: staging directory that holds the destination paths
+        :param wait: wait for other batches to be released if the budget is full
+        :rtype: dict with the per file (path, MB, seconds), the aggregate MB, seconds and MB/s, and the
+            copy strategy used for each (source device, destination device)
+        """
+        budget_bytes = self.budget_mb * 1000 * 1000 if self.budget_mb is not None else None
+        if budget_bytes is None:
+            destination_stat = os.statvfs(stage_dir)
+            budget_bytes = destination_stat.f_bavail * destination_stat.f_frsize + sum(self.staged_bytes.values())
+
+        sizes = [tree_size(source_path) for source_path, destination_path in copy_list]
+        self.reserve([(destination_path, size) for (source_path, destination_path), size in zip(copy_list, sizes)],
+                     budget_bytes, wait=wait)
+
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self.stage_one, source_path, destination_path, size)
+                       for (source_path, destination_path), size in zip(copy_list, sizes)]
+            file_reports = [future.result() for future in futures]
+        elapsed = time.time() - start_time
+
+        total_mb = sum(file_report[1] for file_report in file_reports)
+        self.stage_report = {
+            'files': file_reports,
+            'mb': total_mb,
+            'seconds': elapsed,
+            'mb_per_s': total_mb / elapsed if elapsed else 0,
+            'strategies': self.selector.strategy_report(),
+        }
+        self.debug.output('staged {} files - {:.2f} MB in {:.2f}s ({:.2f} MB/s) using {}'.format(
+            len(file_reports), total_mb, elapsed, self.stage_report['mb_per_s'], self.stage_report['strategies']))
+        return self.stage_report
+
 
 class LocalScp:
     """special class to redefine scp when transfers are only local"""
@@ -74,6 +602,13 @@ class Archive(object):
         self.item_index = 0       ## number of file path index (human readable line numbers in catalog)
         self.archive_state = 0    ## current archive state
 
+        ## chunked, threaded checksums
+        self.md5_workers = 4
+        self.md5_chunk_size = 4 * 1024 * 1024
+
+        ## parallel copies into archive_copy_dir
+        self.stager = Stager(self.pid, workers=4, filesystem_workers=2, debug=debug, debug_threshold=debug_threshold)
+
 
     def __setattr__(self, attr_name, attr_value):
         """debug.output() when a state variable is updated"""
@@ -103,11 +638,53 @@ class Archive(object):
         return ensure_dir_status, dir_path
 
     def build_archive(self, file_list, source_select=None):
-        """Copy files to /dev/shm/$PID, create md5sum data for all files"""
+        """Copy files to /dev/shm/$PID, create md5sum data for all files
+
+        Copies run in parallel; see Stager for the worker and byte budget limits.
+        """
+        copy_list = []
         for file_name in file_list:
             transfer_path = '%s/%s' % (self.archive_copy_dir, file_name)
             self.debug.output("build_archive - %s" % file_name)
-            get("/papertape/" + file_name, local_path=transfer_path, recursive=True)
+            copy_list.append(("/papertape/" + file_name, transfer_path))
+
+        return self.stager.stage(copy_list, self.archive_copy_dir)
+
+    def batch_copy_dir(self, tape_index):
+        """staging directory of a single batch, so batches can be staged side by side"""
+        return '%s/batch.%s' % (self.archive_copy_dir, tape_index)
+
+    def build_batch(self, tape_index, file_list):
+        """copy the files of one batch into its own staging directory
+
+        Like build_archive(), but safe to run for several batches at once: a batch
+        waits for earlier batches to be released if the staging budget is full.
+        """
+        batch_dir = self.batch_copy_dir(tape_index)
+        if not os.path.exists(batch_dir):
+            os.makedirs(batch_dir)
+
+        copy_list = [("/papertape/" + file_name, '%s/%s' % (batch_dir, file_name)) for file_name in file_list]
+        return self.stager.stage(copy_list, batch_dir, wait=True)
+
+    def queue_batch(self, tape_index, file_list, md5_dict=None):
+        """tar a staged batch into the queue directory and free its staging directory
+
+        Like queue_archive(), but the batch catalog must already exist (see gen_catalog()).
+        :rtype: str path of the queued tar
+        """
+        batch_dir = self.batch_copy_dir(tape_index)
+        arcname = "%s.%s.%s" % ('paper', self.pid, tape_index)
+        tar_name = "%s/%s.tar" % (self.queue_dir, arcname)
+
+        try:
+            self.tar_archive(batch_dir, arcname, tar_name, md5_dict=md5_dict)
+        finally:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+            for file_name in file_list:
+                self.stager.release('%s/%s' % (batch_dir, file_name))
+
+        return tar_name
 
     def gen_catalog(self, archive_catalog_file, file_list, tape_index):
         """create a catalog file_name"""
@@ -221,7 +798,7 @@ class Archive(object):
 
         return item_index, self.archive_list, md5_dict, pid
 
-    def queue_archive(self, tape_index, file_list):
+    def queue_archive(self, tape_index, file_list, md5_dict=None):
         """move the archive from /dev/shm to a tar file in the queue directory
            once we have 1.5tb of data we will create a catalog and write all the queued
            archives to tape.
@@ -231,7 +808,7 @@ class Archive(object):
         catalog_name = "%s/%s.file_list" %(self.queue_dir, arcname)
 
         ## make the tar in the queue_directory
-        self.tar_archive(self.archive_copy_dir, arcname, tar_name)
+        self.tar_archive(self.archive_copy_dir, arcname, tar_name, md5_dict=md5_dict)
 
         ## make room for additional transfers
         self.rm_archive_copy_dir_list(file_list)
@@ -261,24 +838,47 @@ class Archive(object):
         """
         for dir_path in file_list:
             shutil.rmtree('%s/%s' % (self.archive_copy_dir, dir_path))
+            self.stager.release('%s/%s' % (self.archive_copy_dir, dir_path))
+
+    def tar_archive(self, source, arcname, destination, md5_dict=None):
+        """create the queued tar for the archive file
 
-    def tar_archive(self, source, arcname, destination):
-        """create the queued tar for the archive file"""
+        Every visdata file is hashed as it is read into the tar; if md5_dict is
+        given, a mismatch with it fails the archive before it reaches tape.
+        """
         archive_file = tarfile.open(destination, mode='w')
-        archive_file.add(source, arcname=arcname)
-        archive_file.close()
+        try:
+            digests = add_hashed(archive_file, source, arcname)
+        finally:
+            archive_file.close()
+
+        if md5_dict is not None:
+            for relative_path, digest in digests.items():
+                check_hashed(os.path.dirname(relative_path), digest, md5_dict, self.debug)
+
+        return digests
 
     def md5(self, directory_prefix, file_path):
         """return an md5sum for a file"""
         full_path = '%s/%s' % (directory_prefix, file_path)
-        hasher = hashlib.md5()
+        hexdigest = md5_file(full_path, chunk_size=self.md5_chunk_size)
         with open('{}.md5sum'.format(full_path), mode='w') as hash_file:
-            with open(full_path, mode='rb') as open_file:
-                file_buffer = open_file.read()
-                hasher.update(file_buffer)
+            hash_file.write('%s\n' % hexdigest)
+
+        return hexdigest
+
+    def md5_archive_list(self, archive_list, directory_prefix=None, data_file='visdata'):
+        """return a dictionary of md5sums by dir_path for every item in archive_list
+
+        :param archive_list: list of [tape_index, archive_index, dir_path]
+        :param directory_prefix: str, defaults to archive_copy_dir
+        :param data_file: str, file under each dir_path to hash
+        """
+        directory_prefix = self.archive_copy_dir if directory_prefix is None else directory_prefix
+        path_dict = {'%s/%s/%s' % (directory_prefix, item[-1], data_file): item[-1] for item in archive_list}
 
-            hash_file.write('%s\n' % hasher.hexdigest())
-        return hasher.hexdigest
+        digests = md5_files(list(path_dict), workers=self.md5_workers, chunk_size=self.md5_chunk_size)
+        return {path_dict[full_path]: digest for full_path, digest in digests.items()}
 
     def save_tape_ids(self, tape_ids):
         """open a file and write the tape ids in case writing to the db fails"""
@@ -3,18 +3,29 @@
     Changer: access mtx features
     MtxDB: a mysql database to manage tape usage
     Drives: access to mt functions and writing data to tape
+    FanOutWriter: write one stream to several tape drives
 """
 
+import math
+import os
 import re
 import datetime
+import hashlib
+import selectors
+import signal
 import random
 import time
 from subprocess import *
+from queue import Queue, Empty
+from threading import Thread, RLock, Event
 
-import pymysql
 from collections import defaultdict
 
 from paper_debug import Debug
+from paper_io import add_hashed, check_hashed, tar_stream_size, RingBuffer, ParallelHasher
+from paper_pool import PooledDB
+from paper_tape import open_tape, tape_device_format, tape_files, TapeFileReader
+from paper_catalog import positions_lines, parse_positions
 from paper_status_code import StatusCode
 from io import StringIO
 from io import BytesIO 
@@ -22,6 +33,44 @@ import tarfile
 from enum import Enum, unique
 
 
+## Data Transfer Element 1:Full (Storage Element 1 Loaded):VolumeTag = PAPR1001
+drive_line_regex = re.compile(r'^Data Transfer Element (\d):Full \(Storage Element (\d+) Loaded\):VolumeTag = ([A-Z0-9]{8})')
+## Storage Element 10:Full :VolumeTag=PAPR1010
+storage_line_regex = re.compile(r'\s+Storage Element (\d+):Full :VolumeTag=([A-Z0-9]{8})')
+
+
+def stratified_sample_size(population, confidence=0.95, defect_rate=0.05):
+    """number of files to check in an archive of population files so that, if
+    defect_rate of them are bad, at least one bad file is found with the given confidence"""
+    if population <= 0:
+        return 0
+    if defect_rate >= 1:
+        return 1
+    return min(population, int(math.ceil(math.log(1 - confidence) / math.log(1 - defect_rate))))
+
+
+def add_positions(archive_positions, tape_index, drive_positions):
+    """add the (start_block, end_block) by drive_int of an archive to archive_positions
+
+    The catalog is the first tape file, so the archives follow as tape files 1, 2, ...
+
+    :param archive_positions: {drive_int: {tape_index: (tape_file, start_block, end_block)}}
+    """
+    for drive_int, (start_block, end_block) in drive_positions.items():
+        drive_archives = archive_positions.setdefault(drive_int, {})
+        drive_archives[int(tape_index)] = (len(drive_archives) + 1, start_block, end_block)
+
+
+def complete_positions(drive_report):
+    """(start_block, end_block) by drive_int of the drives that wrote a whole tape file
+
+    A drive that failed, or was stopped by an aborted stream, still closed its
+    tape file with a filemark; that file is partial and gets no position.
+    """
+    return dict((drive_int, (report['start_block'], report['end_block']))
+                for drive_int, report in drive_report.items() if not report['partial'])
+
+
 def split_mtx_output(mtx_output):
     """Return dictionaries of tape_ids in drives and slots."""
     drive_ids = {}
@@ -29,20 +78,18 @@ def split_mtx_output(mtx_output):
     label_in_drive = {}
 
     for line in mtx_output.split('\n'):
-        drive_line = re.compile('^Data Transfer Element (\d):Full \(Storage Element (\d+) Loaded\):VolumeTag = ([A-Z0-9]{8})')
-        storage_line = re.compile('\s+Storage Element (\d+):Full :VolumeTag=([A-Z0-9]{8})')
+        drive_match = drive_line_regex.match(line)
+        storage_match = drive_match is None and storage_line_regex.match(line)
 
-        if drive_line.match(line):
-            """Data Transfer Element 1:Full (Storage Element 1 Loaded):VolumeTag = PAPR1001"""
-            drive_info = drive_line.match(line).groups()
+        if drive_match:
+            drive_info = drive_match.groups()
             ## dict of storage_slots by tape_id
             drive_ids[drive_info[2]] = drive_info[0:2]
             ## dict of tape_ids by drive_int
             label_in_drive[drive_info[0]] = drive_info[2]
 
-        elif storage_line.match(line):
-            """Storage Element 10:Full :VolumeTag=PAPR1010"""
-            storage_info = storage_line.match(line).groups()
+        elif storage_match:
+            storage_info = storage_match.groups()
             ## dict of tapes slots by tape_id
             tape_slot[storage_info[1]] = storage_info[0]
 
@@ -73,9 +120,21 @@ class Changer(object):
         self.tape_ids = []
         self.label_in_drive = [] ## return label in given drive
 
+        ## the inventory is read with mtx status once, then kept up to date from our
+        ## own load and unload commands; it is read again only when invalidated
+        self.inventory_valid = False
+        self.inventory_stats = {'mtx_status': 0, 'mtx_status_avoided': 0, 'mismatch_refresh': 0}
+
+        ## verify threads load and unload tapes at the same time, so the inventory
+        ## is only read or changed while holding this lock
+        self.inventory_lock = RLock()
+
         self.check_inventory()
         self.tape_drives = Drives(self.pid, drive_select=drive_select, debug=debug, debug_threshold=debug_threshold)
 
+        ## where each archive was written: {drive_int: {tape_index: (tape_file, start_block, end_block)}}
+        self.archive_positions = {}
+
         self.disk_queue = disk_queue
         if not self.disk_queue:
             ## we need to use Ramtar
@@ -83,13 +142,43 @@ class Changer(object):
         ## TODO(dconover): implement a lock on the changer to prevent overlapping requests
         self.changer_state = 0
 
-    def check_inventory(self):
-        """check the current inventory of the library with mtx"""
-        output = check_output(['mtx', 'status']).decode("utf-8")
-        self.debug.output(output, debug_level=251)
-        self.drive_ids, self.tape_ids, self.label_in_drive = split_mtx_output(output)
-        for drive_id in self.drive_ids:
-            self.debug.output('- %s, %s num_tapes: %d' % (id, self.drive_ids[drive_id], len(self.tape_ids)))
+    def check_inventory(self, refresh=False):
+        """check the current inventory of the library with mtx
+
+        The cached inventory is used unless it has been invalidated or refresh is set.
+        """
+        with self.inventory_lock:
+            if self.inventory_valid and not refresh:
+                self.inventory_stats['mtx_status_avoided'] += 1
+                return
+
+            output = check_output(['mtx', 'status']).decode("utf-8")
+            self.inventory_stats['mtx_status'] += 1
+            self.debug.output(output, debug_level=251)
+            self.drive_ids, self.tape_ids, self.label_in_drive = split_mtx_output(output)
+            self.inventory_valid = True
+            for drive_id in self.drive_ids:
+                self.debug.output('- %s, %s num_tapes: %d' % (id, self.drive_ids[drive_id], len(self.tape_ids)))
+
+    def invalidate_inventory(self, reason=None):
+        """force the next check_inventory() to run mtx status (after a failed mtx command
+        the library may not be in the state we expect)"""
+        if reason is not None:
+            self.debug.output('inventory invalidated - {}'.format(reason))
+        with self.inventory_lock:
+            self.inventory_valid = False
+
+    def refresh_on_mismatch(self, reason):
+        """reread the inventory after it disagreed with the library"""
+        self.debug.output('inventory mismatch, refreshing - {}'.format(reason))
+        with self.inventory_lock:
+            self.inventory_stats['mismatch_refresh'] += 1
+            self.check_inventory(refresh=True)
+
+    def inventory_report(self):
+        """return the inventory counters"""
+        self.debug.output('inventory: {}'.format(self.inventory_stats))
+        return dict(self.inventory_stats)
 
     def print_inventory(self):
         """print out the current tape library inventory"""
@@ -126,36 +215,43 @@ class Changer(object):
         :type  tape_id: label of tape to load
         :param tape_id: label of tape to load"""
         status = False
+        rewind = False
 
         self.debug.output('check then load - {}, {}'.format(tape_id, drive))
 
-        for attempt in range(3):
-            if self.drives_empty(drive_int=drive):
-                self.debug.output('calling load_tape - ', str(tape_id), str(drive), debug_level=128)
-                self.load_tape(tape_id, drive)
-                status = True
-                break
-
-            ## return if the drive already contains the tape we want
-            ## just rewind
-            elif str(drive) in self.label_in_drive and self.label_in_drive[str(drive)] == tape_id:
-                ## if we call this function we probably need a rewind
-                self.debug.output('tape loaded; rewinding tape - {}:{}'.format(str(drive), tape_id))
-                self.rewind_tape(tape_id)
-                status = True
-                break
+        ## check and load in one step, so another thread can't take the drive in between
+        with self.inventory_lock:
+            for attempt in range(3):
+                if self.drives_empty(drive_int=drive):
+                    self.debug.output('calling load_tape - ', str(tape_id), str(drive), debug_level=128)
+                    self.load_tape(tape_id, drive)
+                    status = True
+                    break
+
+                ## return if the drive already contains the tape we want
+                ## just rewind
+                elif str(drive) in self.label_in_drive and self.label_in_drive[str(drive)] == tape_id:
+                    ## if we call this function we probably need a rewind
+                    self.debug.output('tape loaded; rewinding tape - {}:{}'.format(str(drive), tape_id))
+                    rewind = True
+                    status = True
+                    break
+
+                ## if the drive is full attempt to unload, then retry
+                else:
+                    self.debug.output('different tape loaded, unloading - {}:{}'.format(str(self.label_in_drive), str(drive)), debug_level=128)
+                    self.unload_tape_drive(drive)
 
-            ## if the drive is full attempt to unload, then retry
-            else:
-                self.debug.output('different tape loaded, unloading - {}:{}'.format(str(self.label_in_drive), str(drive)), debug_level=128)
-                self.unload_tape_drive(drive)
+        ## the drive is ours now; rewinding doesn't need the inventory
+        if rewind:
+            self.rewind_tape(tape_id)
 
         return status
 
     def unload_tape_pair(self):
         """unload the tapes in the current drives"""
         if not self.drives_empty():
-            for tape_id in self.drive_ids:
+            for tape_id in list(self.drive_ids):
                 self.debug.output('unloading', tape_id)
                 self.unload_tape(tape_id)
 
@@ -203,26 +299,52 @@ class Changer(object):
     def load_tape(self, tape_id, tape_drive):
         """Load a tape into a free drive slot"""
         load_tape_status = True
-        try:
-            if self.tape_ids[tape_id]:
-                self.debug.output('Loading - %s' % tape_id)
-                output = check_output(['mtx', 'load', str(self.tape_ids[tape_id]), str(tape_drive)])
-                self.check_inventory()
-        except KeyError:
-            self.debug.output('tape not in storage - {}'.format(tape_id))
-            load_tape_status = False
+        with self.inventory_lock:
+            if tape_id not in self.tape_ids:
+                self.refresh_on_mismatch('{} not in storage'.format(tape_id))
+
+            try:
+                if self.tape_ids[tape_id]:
+                    self.debug.output('Loading - %s' % tape_id)
+                    slot = self.tape_ids[tape_id]
+                    try:
+                        output = check_output(['mtx', 'load', str(slot), str(tape_drive)])
+                    except CalledProcessError:
+                        self.invalidate_inventory('mtx load {} {} failed'.format(slot, tape_drive))
+                        raise
+
+                    ## update the inventory from the load instead of rereading it
+                    del self.tape_ids[tape_id]
+                    self.drive_ids[tape_id] = (str(tape_drive), str(slot))
+                    self.label_in_drive[str(tape_drive)] = tape_id
+            except KeyError:
+                self.debug.output('tape not in storage - {}'.format(tape_id))
+                load_tape_status = False
 
         return load_tape_status
 
     def unload_tape(self, tape_id):
         """Unload a tape from a drive and put in the original slot"""
-        if self.drive_ids[tape_id]:
-            command = ['mtx', 'unload', self.drive_ids[tape_id][1], self.drive_ids[tape_id][0]]
-            self.debug.output('%s' % command)
-            output = check_output(command)
-            self.check_inventory()
-        else:
-            self.debug.output('tape_id({}) not in drive'.format(tape_id))
+        with self.inventory_lock:
+            if tape_id not in self.drive_ids:
+                self.refresh_on_mismatch('{} not in a drive'.format(tape_id))
+
+            if self.drive_ids.get(tape_id):
+                drive, slot = self.drive_ids[tape_id]
+                command = ['mtx', 'unload', slot, drive]
+                self.debug.output('%s' % command)
+                try:
+                    output = check_output(command)
+                except CalledProcessError:
+                    self.invalidate_inventory('mtx unload {} {} failed'.format(slot, drive))
+                    raise
+
+                ## update the inventory from the unload instead of rereading it
+                del self.drive_ids[tape_id]
+                self.label_in_drive.pop(drive, None)
+                self.tape_ids[tape_id] = slot
+            else:
+                self.debug.output('tape_id({}) not in drive'.format(tape_id))
 
     def rewind_tape(self, tape_id):
         """rewind the tape in the given drive"""
@@ -232,11 +354,12 @@ class Changer(object):
         try: 
             if self.drive_ids[tape_id]:
                 self.debug.output('rewinding tape %s' % tape_id)
-                output = check_output('mt -f /dev/nst%s rewi' % (self.drive_ids[tape_id][0]), shell=True)
+                with self.tape_drives.open_drive(self.drive_ids[tape_id][0]) as tape:
+                    tape.rewind()
                 status = True
 
-        except CalledProcessError:
-            self.debug.output('rewind error')
+        except OSError as rewind_error:
+            self.debug.output('rewind error {}'.format(rewind_error))
 
         except KeyError:
             self.debug.output('tape (%s) not loaded: %s' % (tape_id, self.drive_ids))
@@ -253,6 +376,7 @@ class Changer(object):
         if self.disk_queue:
             self.debug.output("writing", catalog_name, tar_name)
             self.tape_drives.tar_files([catalog_name, tar_name])
+            self.record_positions(tape_index)
         elif self.disk_queue and tape_list:
             ## what should we do with a disk queue and a tape_list?
             self.debug.output('disk queue with tape_list given')
@@ -272,9 +396,82 @@ class Changer(object):
         ## write catalog
         self.debug.output("writing catalog to tape", catalog_file)
         self.tape_drives.dd(catalog_file)
+        self.archive_positions = {}
+        if not self.disk_queue:
+            self.ramtar.archive_positions = {}
         ## write source code
         #self.tape_drives.tar('/root/git/papertape')
 
+    def record_positions(self, tape_index):
+        """remember where the archive just written starts and ends on each drive"""
+        self.debug.output('archive {} positions {}'.format(tape_index, self.tape_drives.drive_positions), debug_level=250)
+        add_positions(self.archive_positions, tape_index, self.tape_drives.drive_positions)
+
+    def write_positions(self):
+        """write the archive positions as the last tape file of each tape
+
+        :rtype: dict of the positions written by tape label
+        """
+        ## archives written through the RamTar are positioned by it
+        archive_positions = dict((drive_int, dict(drive_positions)) for drive_int, drive_positions in self.archive_positions.items())
+        if not self.disk_queue:
+            for drive_int, drive_positions in self.ramtar.archive_positions.items():
+                archive_positions.setdefault(drive_int, {}).update(drive_positions)
+
+        label_positions = {}
+        for drive_int, drive_positions in archive_positions.items():
+            ## positions are unknown on drives that can't report them
+            known_positions = dict((tape_index, position) for tape_index, position in drive_positions.items()
+                                   if None not in position)
+            if not known_positions:
+                self.debug.output('no positions for drive {}'.format(drive_int))
+                continue
+
+            lines = positions_lines(self.pid, known_positions, self.tape_drives.record_size)
+            self.debug.output('writing {} positions to drive {}'.format(len(known_positions), drive_int))
+            self.tape_drives.write_text(drive_int, '\n'.join(lines) + '\n')
+
+            label = self.label_in_drive.get(str(drive_int))
+            if label is not None:
+                label_positions[label] = known_positions
+
+        return label_positions
+
+    def read_tape_positions(self, tape_id):
+        """read the archive positions from the last tape file of a loaded tape
+
+        :rtype: tuple of (dump pid, block_size, dict of (tape_file, start_block, end_block) by tape_index),
+            or None if the tape has no positions file
+        """
+        drive_int = self.drive_ids[tape_id][0]
+        return parse_positions(self.tape_drives.read_last_file(drive_int))
+
+    def archive_start_blocks(self, tape_id, job_pid, tape_indexes, stored_positions=None):
+        """return the start block of every archive of a loaded tape, so it can be verified by seeking
+
+        The positions file at the end of the tape is used if it was written by
+        job_pid, otherwise stored_positions (see MtxDB.select_positions()).
+
+        :param tape_indexes: the archives that must have a position
+        :param stored_positions: dict of (tape_file, start_block, end_block, block_size) by tape_index
+        :rtype: dict of start_block by tape_index, or None if any archive has no usable position
+        """
+        block_size = self.tape_drives.record_size
+        start_blocks = {}
+
+        tape_positions = self.read_tape_positions(tape_id)
+        if tape_positions is not None and str(tape_positions[0]) == str(job_pid) and tape_positions[1] == block_size:
+            start_blocks = dict((int(tape_index), position[1]) for tape_index, position in tape_positions[2].items())
+        elif stored_positions:
+            start_blocks = dict((int(tape_index), position[1]) for tape_index, position in stored_positions.items()
+                                if position[3] == block_size and position[1] is not None)
+
+        missing = set(int(tape_index) for tape_index in tape_indexes) - set(start_blocks)
+        if missing:
+            self.debug.output('no positions for {} archives on {}'.format(len(missing), tape_id))
+            return None
+        return start_blocks
+
     def read_tape_catalog(self, tape_id):
         """read and return first block of tape"""
 
@@ -290,9 +487,13 @@ class Changer(object):
 
         return self.tape_drives.count_files(drive_int)
 
-    def tape_archive_md5(self, tape_id, job_pid, catalog_list, md5_dict, drive=0):
-        """loop through each archive on tape and check a random file md5 from each
+    def tape_archive_md5(self, tape_id, job_pid, catalog_list, md5_dict, drive=0, verify_mode='sample', confidence=0.95, defect_rate=0.05, hash_workers=4, positions=None):
+        """check file md5s from each archive on tape in one pass over the tape
 
+        :param verify_mode: 'sample' checks one random file per archive, 'stratified'
+            checks stratified_sample_size(confidence, defect_rate) random files per archive,
+            'full' checks every file
+        :param positions: dict of archive start_block by tape_index, to seek to each archive (see Drives.verify_tape)
         :rtype : bool"""
 
         ## default to True
@@ -304,9 +505,7 @@ class Changer(object):
         self.load_tape_drive(tape_id, drive)
         drive_int = self.drive_ids[tape_id][0]
 
-        ## for every tar advance the tape
-        ## select a random path from the tape
-        ## run md5sum_at_index(tape_index, drive_int=0)
+        ## select a random path from every archive on the tape
         archive_dict = defaultdict(list)
 
         ## build a dictionary of archives
@@ -314,40 +513,61 @@ class Changer(object):
             self.debug.output('item to check: %s' % item)
             archive_dict[item[0]].append(item[-1])
 
+        ## pick the paths to check in every archive, then check them all in one pass over the tape
+        def _sample_count(population):
+            if verify_mode == 'full':
+                return population
+            elif verify_mode == 'stratified':
+                return stratified_sample_size(population, confidence=confidence, defect_rate=defect_rate)
+            return min(population, 1)
+
+        samples = dict((tape_index, random.sample(archive_dict[tape_index], _sample_count(len(archive_dict[tape_index]))))
+                       for tape_index in archive_dict)
+        self.debug.output('{} verify: {} files of {}'.format(
+            verify_mode, sum(len(sample) for sample in samples.values()), len(catalog_list)))
+        found = self.tape_drives.verify_tape(job_pid, samples, drive_int=drive_int, hash_workers=hash_workers, positions=positions)
+
         for tape_index in archive_dict:
-            directory_path = random.choice(archive_dict[tape_index])
-            ## starting at the beginning of the tape we can advance one at a
-            ## time through each archive and test one directory_path/visdata md5sum
-            self.debug.output('checking md5sum for %s' % directory_path)
-            md5sum = self.tape_drives.md5sum_at_index(job_pid, tape_index, directory_path, drive_int=drive_int)
-            if md5sum != md5_dict[directory_path]:
-                self.debug.output('mdsum does not match: %s, %s' % (md5sum, md5_dict[directory_path]))
-                tape_archive_md5_status = self.status_code.tape_archive_md5_mismatch
-                reference = ":".join([str(tape_index), directory_path])
+            for directory_path in samples[tape_index]:
+                md5sum = found[(int(tape_index), directory_path)]
+                if md5sum != md5_dict[directory_path]:
+                    self.debug.output('mdsum does not match: %s, %s' % (md5sum, md5_dict[directory_path]))
+                    tape_archive_md5_status = self.status_code.tape_archive_md5_mismatch
+                    reference = ":".join([str(tape_index), directory_path])
+                    break
+                else:
+                    self.debug.output('md5 match: %s|%s' % (md5sum, md5_dict[directory_path]), debug_level=250)
+
+            if reference is not None:
                 break
-            else:
-                self.debug.output('md5 match: %s|%s' % (md5sum, md5_dict[directory_path]))
 
         self.unload_tape(tape_id)
         return tape_archive_md5_status, reference
 
     def close_changer(self):
         """cleanup"""
+        self.inventory_report()
         ## TODO(dconover): implement changer locking; remove lock
         pass
 
     def append_to_archive(self, file_path, file_path_rewrite=None):
-        """add data to an open archive"""
+        """add data to an open archive, return the md5 of file_path/visdata hashed on the way in"""
         arcname = file_path if file_path_rewrite is None else file_path_rewrite
         try:
             self.debug.output('file_path={}, arcname={}'.format(file_path, arcname))
-            self.archive_tar.add(file_path, arcname=arcname)
+            digests = add_hashed(self.archive_tar, file_path, arcname)
         except Exception as cept:
             self.debug.output('tarfile exception - {}'.format(cept))
             raise
 
-    def archive_from_list(self, tape_list):
-        """take a tape list, build each archive, write to tapes"""
+        return digests.get('visdata')
+
+    def archive_from_list(self, tape_list, md5_dict=None):
+        """take a tape list, build each archive, write to tapes
+
+        If md5_dict is given, each visdata md5 hashed while building the archive
+        must match it, or the archive fails before it is sent to tape.
+        """
 
         archive_dict = defaultdict(list)
         archive_list_dict = defaultdict(list)
@@ -380,7 +600,9 @@ class Changer(object):
                     data_path = '/'.join([data_dir, item])
                     ## TODO(dconover): remove excess leading paths from archive_path
                     archive_path = '/'.join([archive_prefix, item])
-                    self.append_to_archive(data_path, file_path_rewrite=archive_path )
+                    data_md5 = self.append_to_archive(data_path, file_path_rewrite=archive_path )
+                    if md5_dict is not None:
+                        check_hashed(item, data_md5, md5_dict, self.debug)
 
                 ## close the file
                 self.archive_tar.close()
@@ -388,6 +610,7 @@ class Changer(object):
                 ## send archive group to both tapes
                 self.debug.output('send data')
                 self.send_archive_to_tape(archive_list, archive_name, archive_file)
+                self.record_positions(tape_index)
 
         else:
             ## I don't think its a good idea to do this since you have to read the data twice
@@ -416,7 +639,7 @@ class ChangerStateCode(Enum):
     changer_active = 1
     changer_idle = 2
 
-class MtxDB(object):
+class MtxDB(PooledDB):
     """db to handle record of label ids
 
     Field     Type    Null    Key     Default Extra
@@ -440,8 +663,6 @@ class MtxDB(object):
         self.connection_timeout = 90
         self.connection_time = datetime.timedelta()
         self.credentials = credentials
-        self.connect = ''
-        self.cur = ''
         self.db_connect('init', credentials)
 
         self.mtxdb_state = 0 ## current dump state
@@ -456,32 +677,6 @@ class MtxDB(object):
             self.debug.output("updating: {} with {}={}".format(class_name, attr_name, attr_value))
         super(self.__class__, self).__setattr__(attr_name, attr_value)
 
-    def update_connection_time(self):
-        """refresh database connection"""
-        self.debug.output('updating connection_time')
-        self.connection_time = datetime.datetime.now()
-
-    def connection_time_delta(self):
-        """return connection age"""
-        self.debug.output('connection_time:%s' % self.connection_time)
-        delta = datetime.datetime.now() - self.connection_time
-        return delta.total_seconds()
-
-    def db_connect(self, command=None, credentials=None):
-        """connect to the database or reconnect an old session"""
-        self.debug.output('input:%s %s' % (command, credentials))
-        self.credentials = credentials if credentials is not None else self.credentials
-        time_delta = self.connection_timeout + 1 if command == 'init' else self.connection_time_delta()
-
-        self.debug.output("time_delta:%s, timeout:%s" % (time_delta, self.connection_timeout))
-        if time_delta > self.connection_timeout:
-            self.debug.output("setting connection %s %s" % (credentials, self.connection_timeout))
-            self.connect = pymysql.connect(read_default_file=self.credentials, connect_timeout=self.connection_timeout)
-            self.cur = self.connect.cursor()
-
-        self.update_connection_time()
-        self.debug.output("connection_time:%s" % self.connection_time)
-
     def get_capacity(self, tape_id):
         select_sql = "select capacity from ids where id='%s'" % tape_id
 
@@ -549,6 +744,53 @@ class MtxDB(object):
         return date_ids_status
 
 
+    def ensure_positions_table(self):
+        """create the positions table if it doesn't exist yet"""
+        positions_sql = """create table if not exists positions (
+                label char(8) not null,
+                tape_index int not null,
+                tape_file int,
+                start_block bigint,
+                end_block bigint,
+                block_size int,
+                pid varchar(20),
+                primary key (label, tape_index)
+            )"""
+        self.db_connect()
+        self.cur.execute(positions_sql)
+        self.connect.commit()
+
+    def insert_positions(self, label, positions, block_size):
+        """record where each archive starts and ends on a tape
+
+        :param positions: dict of (tape_file, start_block, end_block) by tape_index
+        """
+        insert_sql = """replace into positions (label, tape_index, tape_file, start_block, end_block, block_size, pid)
+            values (%s, %s, %s, %s, %s, %s, %s)
+        """
+        rows = [(label, int(tape_index), tape_file, start_block, end_block, block_size, str(self.pid))
+                for tape_index, (tape_file, start_block, end_block) in positions.items()]
+
+        self.ensure_positions_table()
+        self.cur.executemany(insert_sql, rows)
+        self.connect.commit()
+        self.debug.output('recorded {} positions for {}'.format(len(rows), label))
+
+    def select_positions(self, label, pid=None):
+        """return the archive positions of a tape
+
+        :param pid: only the positions written by this dump
+        :rtype: dict of (tape_file, start_block, end_block, block_size) by tape_index
+        """
+        self.ensure_positions_table()
+        if pid is None:
+            self.cur.execute("""select tape_index, tape_file, start_block, end_block, block_size
+                from positions where label=%s""", (label,))
+        else:
+            self.cur.execute("""select tape_index, tape_file, start_block, end_block, block_size
+                from positions where label=%s and pid=%s""", (label, str(pid)))
+        return dict((row[0], tuple(row[1:])) for row in self.cur.fetchall())
+
     def write(self, src_directory):
         """take a path like /dev/shm/1003261778 and create a tar archive on two tapes"""
 
@@ -564,7 +806,178 @@ class MtxDB(object):
         """cleanup mtxdb state
         """
         ## TODO(dconover): dependent on self.mtx_state: claim/unclaim tapes; close mtxdb
-        pass
+        self.db_release()
+
+class DriveWriter(Thread):
+    ## init object with the device to write, the bounded queue of chunks it reads from
+    ## and the event set when the stream is aborted
+    def __init__(self, pid, drive_int, device_path, record_size, buffer_chunks, aborted):
+        Thread.__init__(self, daemon=True)
+        self.pid = pid
+        self.drive_int = drive_int
+        self.device_path = device_path
+        self.record_size = record_size
+        self.chunks = Queue(maxsize=buffer_chunks)
+        self.aborted = aborted
+        self.bytes_written = 0
+        self.error = None
+        self.start_block = None
+        self.end_block = None
+
+    def tell(self, device):
+        """return the block position of the device, or None if it can't report one"""
+        try:
+            return device.tell()
+        except OSError:
+            return None
+
+    ## custom run() to write every chunk to the device one record at a time; after
+    ## an error or an abort keep draining the queue so the other drives aren't held up
+    def run(self):
+        try:
+            device = open_tape(self.pid, self.device_path, mode='wb', block_size=self.record_size)
+            self.start_block = self.tell(device)
+        except OSError as device_error:
+            self.error = device_error
+            device = None
+
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+            if self.error is not None or self.aborted.is_set():
+                continue
+
+            try:
+                chunk_view = memoryview(chunk)
+                for offset in range(0, len(chunk_view), self.record_size):
+                    ## stop mid chunk as soon as the stream is aborted
+                    if self.aborted.is_set():
+                        break
+                    record = chunk_view[offset:offset + self.record_size]
+                    device.write_block(record)
+                    self.bytes_written += len(record)
+            except OSError as device_error:
+                self.error = device_error
+
+        if device is not None:
+            self.end_block = self.tell(device)
+            try:
+                device.close()
+            except OSError as device_error:
+                self.error = self.error or device_error
+
+
+class FanOutWriter(object):
+    """file object that writes one stream to several tape drives
+
+    The stream is cut into chunks of whole tape records, and each chunk is handed
+    to a writer thread per drive through a queue of buffer_chunks chunks (a
+    double buffer by default). The same chunk is shared by every drive, so the
+    data is produced (and read from disk) once. A drive that falls behind holds
+    up the stream once its buffer is full; a drive that fails is reported and
+    dropped without stopping the others. An aborted stream stops every drive
+    before its next record.
+    """
+
+    def __init__(self, pid, device_paths, record_size=tarfile.RECORDSIZE, chunk_records=100, buffer_chunks=2, debug=False, debug_threshold=128):
+        """start a writer thread for every device
+        :type device_paths: dict
+        :param device_paths: device path by drive_int
+        :type record_size: int
+        :param record_size: bytes written to the device per write (tape block size)
+        :type chunk_records: int
+        :param chunk_records: records in each buffered chunk
+        :type buffer_chunks: int
+        :param buffer_chunks: chunks buffered per drive
+        """
+        self.pid = pid
+        self.debug = Debug(self.pid, debug=debug, debug_threshold=debug_threshold)
+
+        self.record_size = record_size
+        self.chunk_size = record_size * chunk_records
+        self.buffer = bytearray()
+        self.closed = False
+        self.abort_error = None
+        self.aborted = Event()
+
+        self.writers = {}
+        for drive_int, device_path in device_paths.items():
+            self.writers[drive_int] = DriveWriter(self.pid, drive_int, device_path, record_size, buffer_chunks, self.aborted)
+            self.writers[drive_int].start()
+
+    def live_writers(self):
+        """writers that haven't failed"""
+        return [writer for writer in self.writers.values() if writer.error is None]
+
+    def send(self, chunk):
+        """queue a chunk for every drive"""
+        writers = self.live_writers()
+        if not writers:
+            raise Exception('every drive failed: {}'.format(self.drive_errors()))
+
+        for writer in writers:
+            writer.chunks.put(chunk)
+
+    def write(self, data):
+        """buffer data, sending it to the drives a chunk at a time"""
+        self.buffer += data
+        while len(self.buffer) >= self.chunk_size:
+            self.send(bytes(self.buffer[:self.chunk_size]))
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def drive_errors(self):
+        """return the error of each failed drive by drive_int"""
+        return dict((drive_int, writer.error) for drive_int, writer in self.writers.items() if writer.error is not None)
+
+    def abort(self, error):
+        """give up on the stream; the drives stop writing and close() sends nothing more"""
+        self.debug.output('aborting stream - {}'.format(error))
+        self.abort_error = error
+        self.aborted.set()
+
+    def close(self):
+        """pad the stream to a whole record, flush it to the drives and wait for them
+
+        An aborted stream is not flushed: the buffer and any chunks still queued
+        for a drive are dropped, and the drives only get the end of the stream.
+        Closing the device still writes a filemark, so the tape file of a failed
+        or aborted drive is reported as partial.
+
+        :rtype: dict with the bytes written, start and end block, error (or None) and partial flag of each drive by drive_int
+        """
+        if not self.closed:
+            self.closed = True
+            if self.abort_error is not None:
+                self.buffer = bytearray()
+                for writer in self.writers.values():
+                    try:
+                        while True:
+                            writer.chunks.get_nowait()
+                    except Empty:
+                        pass
+            elif self.buffer:
+                padding = -len(self.buffer) % self.record_size
+                self.buffer += bytes(padding)
+                if self.live_writers():
+                    self.send(bytes(self.buffer))
+                self.buffer = bytearray()
+
+            for writer in self.writers.values():
+                writer.chunks.put(None)
+            for writer in self.writers.values():
+                writer.join()
+
+        drive_report = {}
+        for drive_int, writer in self.writers.items():
+            partial = writer.error is not None or self.aborted.is_set()
+            drive_report[drive_int] = {'bytes': writer.bytes_written, 'error': writer.error, 'partial': partial,
+                                       'start_block': writer.start_block, 'end_block': writer.end_block}
+            self.debug.output('drive {} ({}): {} bytes, error {}, partial {}'.format(
+                drive_int, writer.device_path, writer.bytes_written, writer.error, partial))
+        return drive_report
+
 
 class Drives(object):
     """class to manage low level access directly with tape (equivalient of mt level commands)
@@ -580,57 +993,166 @@ class Drives(object):
         self.debug = Debug(pid, debug=debug, debug_threshold=debug_threshold)
         self.drive_select = drive_select
 
+        ## build each tar stream once and write it to every drive, instead of
+        ## running one tar process (and one read of the data) per drive
+        self.fan_out = True
+        self.drive_report = {}
+
+        ## drives are opened natively (see paper_tape); a device_format naming
+        ## directories runs against file-backed tapes instead
+        self.device_format = tape_device_format
+        self.block_size = 32 * 1024
+        self.hash_chunk_size = 1024 * 1024
+
+        ## archives are written in tar records; block positions count records
+        self.record_size = tarfile.RECORDSIZE
+        self.drive_positions = {} ## (start_block, end_block) of the last tape file written, by drive_int
+
+    def device_path(self, drive_int):
+        """return the device path of a drive"""
+        return self.device_format.format(drive_int)
+
+    def open_drive(self, drive_int, mode='rb', block_size=None):
+        """open a drive as a TapeDevice (or a FileTapeDevice stand-in)"""
+        return open_tape(self.pid, self.device_path(drive_int), mode=mode,
+                         block_size=self.block_size if block_size is None else block_size,
+                         debug=self.debug.debug_state, debug_threshold=self.debug.debug_threshold)
+
+    def tell_drives(self):
+        """return the block position (or None if it can't be read) of each selected drive"""
+        positions = {}
+        for drive_int in range(self.drive_select):
+            try:
+                with self.open_drive(drive_int, block_size=self.record_size) as tape:
+                    positions[drive_int] = tape.tell()
+            except OSError as tell_error:
+                self.debug.output('no position for drive {} - {}'.format(drive_int, tell_error))
+                positions[drive_int] = None
+        return positions
+
+    def fan_out_tar(self, files):
+        """tar the given files once, writing the same stream to every selected drive
+
+        :rtype: dict with the bytes written and the error (or None) of each drive
+        """
+        device_paths = dict((drive_int, self.device_path(drive_int)) for drive_int in range(self.drive_select))
+        writer = FanOutWriter(self.pid, device_paths, record_size=self.record_size,
+                              debug=self.debug.debug_state, debug_threshold=self.debug.debug_threshold)
+
+        try:
+            ## 'w|' writes whole records in order, the same layout as "tar cf"
+            stream_tar = tarfile.open(fileobj=writer, mode='w|', format=tarfile.GNU_FORMAT)
+            for file_name in files:
+                stream_tar.add(file_name)
+            stream_tar.close()
+        except Exception as cept:
+            writer.abort(cept)
+            raise
+        finally:
+            self.drive_report = writer.close()
+            self.drive_positions = complete_positions(self.drive_report)
+
+        drive_errors = writer.drive_errors()
+        if drive_errors:
+            for drive_int, drive_error in drive_errors.items():
+                self.debug.output('write to drive {} failed - {}'.format(drive_int, drive_error))
+            raise Exception('tape write failed on drives {}'.format(sorted(drive_errors)))
+
+        return self.drive_report
+
     ## This method is deprecated because the tape self check runs though every listed archive
     def count_files(self, drive_int):
         """count the number of files on the current tape in the given drive"""
-        drive = "/dev/nst%s" % drive_int
-        bash_to_count_files = """
-            _count_files_on_tape () {  ## count the number of files on tape
-                local _count=0; 
-                while :; do  
-                    mt -f /dev/nst0 fsf 1 ||break
-                    let _count+=1
-                done
-    
-                echo $_count
-            }
- 
-        """
-        output = check_output(bash_to_count_files, shell=True).decode('utf8').split('\n')
-
-        return int(output[0])
+        with self.open_drive(drive_int) as tape:
+            return tape.count_files()
 
     def tar_files(self, files):
         """send files in a file_list to drive(s) with tar"""
+        if self.fan_out:
+            self.fan_out_tar(files)
+            return
+
         commands = []
         for drive_int in range(self.drive_select):
-            commands.append('tar cf /dev/nst%s  %s ' % (drive_int, ' '.join(files)))
-        self.exec_commands(commands)
+            commands.append('tar cf %s  %s ' % (self.device_path(drive_int), ' '.join(files)))
+        start_blocks = self.tell_drives()
+        self.drive_report = self.check_commands(commands)
+        self.drive_positions = self.positions_since(start_blocks)
 
     def tar_fast(self, files):
         """send catalog file and file_list of source files to tape as archive"""
 
     def tar(self, file_name):
         """send the given file_name to a drive(s) with tar"""
+        if self.fan_out:
+            self.fan_out_tar([file_name])
+            return
+
         commands = []
         for drive_int in range(self.drive_select):
-            commands.append('tar cf /dev/nst%s %s ' % (drive_int, file_name))
-        self.exec_commands(commands)
+            commands.append('tar cf %s %s ' % (self.device_path(drive_int), file_name))
+        start_blocks = self.tell_drives()
+        self.drive_report = self.check_commands(commands)
+        self.drive_positions = self.positions_since(start_blocks)
+
+    def positions_since(self, start_blocks):
+        """return (start_block, end_block) by drive_int of the tape file written since start_blocks
+
+        tar ends the tape file with a filemark, so the end block (the filemark) is one before the position after it.
+        """
+        end_blocks = self.tell_drives()
+        positions = {}
+        for drive_int, start_block in start_blocks.items():
+            end_block = end_blocks.get(drive_int)
+            positions[drive_int] = (start_block, None if end_block is None else end_block - 1)
+        return positions
 
     def dd(self, text_file):
-        """write text contents to the first 32k block of a tape"""
-        commands = []
+        """write text contents to the first 32k block(s) of a tape, padding the last block with nulls"""
+        with open(text_file, mode='r') as text_open:
+            text = text_open.read()
+
         for drive_int in range(self.drive_select):
-            commands.append('dd conv=sync,block of=/dev/nst%s if=%s bs=32k' % (drive_int, text_file))
-        self.exec_commands(commands)
+            self.write_text(drive_int, text)
+
+    def write_text(self, drive_int, text):
+        """write text as a tape file of 32k blocks at the current position, padding the last block with nulls"""
+        text = text.encode('utf8')
+        text += bytes(-len(text) % self.block_size)
+
+        with self.open_drive(drive_int, mode='wb') as tape:
+            for offset in range(0, len(text), self.block_size):
+                tape.write_block(text[offset:offset + self.block_size])
+
+    def read_last_file(self, drive_int):
+        """return the lines of the last tape file written by write_text(), or [] if there is none"""
+        with self.open_drive(drive_int) as tape:
+            try:
+                ## from the end of data, back over two filemarks and forward over one
+                tape.eom()
+                tape.bsf(2)
+                tape.fsf(1)
+            except OSError as position_error:
+                self.debug.output('no last file on drive {} - {}'.format(drive_int, position_error))
+                return []
+
+            ## a tape without a text file at the end ends with an archive; don't read it all
+            blocks = tape.read_file()
+            first_block = next(blocks, b'')
+            if not first_block.startswith(b'## '):
+                self.debug.output('last file on drive {} is not text'.format(drive_int))
+                return []
+            text = first_block + b''.join(blocks)
+
+        return text.rstrip(b'\0').decode('utf8').split('\n')
 
     def dd_read(self, drive_int):
         """assuming a loaded tape, read off the first block from the tape and
         return it as a string"""
 
-        command = ['dd', 'conv=sync,block', 'if=/dev/nst%s' % drive_int, 'bs=32k']
-        self.debug.output('%s' % command)
-        output = check_output(command).decode('utf8').split('\n')
+        self.debug.output('reading {}'.format(self.device_path(drive_int)))
+        with self.open_drive(drive_int) as tape:
+            output = b''.join(tape.read_file()).rstrip(b'\0').decode('utf8').split('\n')
 
         return output[:-1]
 
@@ -649,94 +1171,251 @@ class Drives(object):
 
         self.debug.output("getting md5 of file at %s in drive %s" % (tape_index, drive_int))
 
-        commands = []
         ## the index is stored like: [PAPR1001, PAPR2001]-0:1
         ## the first number gives the file on tape
         ## the second number gives the file on tar
         ## but the tar is inside another tar with the full file table
-        ## to get at an indexed file you must do something like:
-        ##
-        bash_to_md5_selected_file = """
-            _block_md5_file_on_tape () {
-
-                local _fsf=1
-                local _job_pid=${1:-030390297}
-                local _tape_index=${2:-1}
-                local _test_path=${3:-data-path}
-                local _tape_dev=${4:-0}
-
-                local _tar_number=$_tape_index
-                local _archive_tar=papertape/shm/paper.$_job_pid.$_tar_number.tar
-                local _test_file=$_test_path/visdata
-
-                ## extract the archive tar, then extract the file to stdout, then run md5 on stdin
-                mt -f /dev/nst$_tape_dev fsf $_fsf &&
-                    tar xOf /dev/nst$_tape_dev $_archive_tar|
-                        tar xOf - paper.$_job_pid.$_tape_index/$_test_file|
-                            md5sum|awk '{print $1}'
-            }
-
-            _block_md5_file_on_tape %s %s %s %s
-        """ % (job_pid, tape_index, directory_path, drive_int)
-
-        #self.debug.output(bash_to_md5_selected_file, debug_level=252)
+        ## so skip to the next tape file, find the archive tar in it and the
+        ## visdata file in the archive, reading both tars as streams
+        archive_tar = 'papertape/shm/paper.{}.{}.tar'.format(job_pid, tape_index)
+        test_file = 'paper.{}.{}/{}/visdata'.format(job_pid, tape_index, directory_path)
         self.debug.output("reading %s" % directory_path)
 
         try:
-            ## check output
-            output = check_output(bash_to_md5_selected_file, shell=True).decode('utf8').split('\n')
-            ## we should check the output
-            self.debug.output('output: %s' % output[0], debug_level=250)
-
-        except CalledProcessError as return_info:
-            self.debug.output('return_info: %s' % return_info)
+            with self.open_drive(drive_int) as tape:
+                tape.fsf(1)
+                tape_tar = tarfile.open(fileobj=TapeFileReader(tape), mode='r|')
+                md5sum = self.md5_member(tape_tar, archive_tar, test_file)
+            self.debug.output('output: %s' % md5sum, debug_level=250)
+
+        except (OSError, tarfile.TarError) as read_error:
+            self.debug.output('return_info: %s' % read_error)
             return False
 
-        return output[0]
+        return md5sum
+
+    def verify_tape(self, job_pid, samples, drive_int=0, hash_workers=4, positions=None):
+        """read the tape once, start to finish, hashing the sampled files as they go by
 
-    def exec_commands(self, cmds):
-        """ Exec commands in parallel in multiple process
-        (as much as we have CPU)
+        Hashing runs on hash_workers threads (see ParallelHasher), so the read of
+        the tape isn't held up by hashing when every file is sampled. Given the
+        start blocks of the archives, only the sampled archives are read, each
+        after a seek straight to it.
+
+        :param samples: dict of the directory_paths to check by tape_index
+        :param positions: dict of start_block (in record_size blocks) by tape_index
+        :rtype: dict of md5sums (or None if not found) by (tape_index, directory_path)
+        """
+        archive_regex = re.compile(r'(?:^|/)paper\.{}\.(\d+)\.tar$'.format(re.escape(str(job_pid))))
+        wanted = dict(((int(tape_index), directory_path), 'paper.{}.{}/{}/visdata'.format(job_pid, tape_index, directory_path))
+                      for tape_index, directory_paths in samples.items() for directory_path in directory_paths)
+        found = dict((sample, None) for sample in wanted)
+        remaining = set(wanted)
+
+        def _archive_files(tape):
+            if positions is None:
+                tape.rewind()
+                ## the first tape file is the catalog
+                tape.fsf(1)
+                for tape_file in tape_files(tape):
+                    yield tape_file
+            else:
+                for tape_index in sorted(samples, key=int):
+                    tape.seek(positions[int(tape_index)])
+                    yield TapeFileReader(tape)
+
+        ## the hasher's workers are stopped even if reading the tape fails
+        with ParallelHasher(workers=hash_workers) as hasher:
+            with self.open_drive(drive_int, block_size=None if positions is None else self.record_size) as tape:
+                for tape_file in _archive_files(tape):
+                    try:
+                        tape_tar = tarfile.open(fileobj=tape_file, mode='r|')
+                        for tape_member in tape_tar:
+                            archive_match = archive_regex.search(tape_member.name)
+                            if not archive_match:
+                                continue
+
+                            tape_index = int(archive_match.group(1))
+                            test_files = dict((wanted[sample], sample) for sample in remaining if sample[0] == tape_index)
+                            if not test_files:
+                                continue
+
+                            archive = tarfile.open(fileobj=tape_tar.extractfile(tape_member), mode='r|')
+                            for archive_member in archive:
+                                if archive_member.name in test_files:
+                                    sample = test_files[archive_member.name]
+                                    member_file = archive.extractfile(archive_member)
+                                    hasher.update(sample, b'')
+                                    for chunk in iter(lambda: member_file.read(self.hash_chunk_size), b''):
+                                        hasher.update(sample, chunk)
+                                    remaining.discard(sample)
+                    except tarfile.TarError as read_error:
+                        self.debug.output('tape file read error {}'.format(read_error))
+
+                    if not remaining:
+                        break
+
+            digests = hasher.close()
+
+        ## a file cut short by a read error is left as not found
+        found.update((sample, md5sum) for sample, md5sum in digests.items() if sample not in remaining)
+
+        self.debug.output('verified {} of {} samples in one pass'.format(len(wanted) - len(remaining), len(wanted)))
+        return found
+
+    def md5_tarfile_member(self, archive, archive_member):
+        """return the md5sum of a member of a tar opened in stream mode"""
+        member_hash = hashlib.md5()
+        member_file = archive.extractfile(archive_member)
+        for chunk in iter(lambda: member_file.read(self.block_size), b''):
+            member_hash.update(chunk)
+        return member_hash.hexdigest()
+
+    def md5_member(self, tape_tar, archive_tar, test_file):
+        """return the md5sum of test_file inside the archive_tar member of tape_tar, or False"""
+        for tape_member in tape_tar:
+            if tape_member.name != archive_tar:
+                continue
+
+            archive = tarfile.open(fileobj=tape_tar.extractfile(tape_member), mode='r|')
+            for archive_member in archive:
+                if archive_member.name == test_file:
+                    return self.md5_tarfile_member(archive, archive_member)
+
+        self.debug.output('{} not found in {}'.format(test_file, archive_tar))
+        return False
+
+    def exit_fd(self, process):
+        """return a file descriptor that becomes readable when process exits
+
+        This is a pidfd where the kernel supports it, otherwise the read end of a
+        pipe that a waiting thread closes when the process exits.
         """
-        if not cmds: return # empty file_list
+        try:
+            return os.pidfd_open(process.pid)
+        except (AttributeError, OSError):
+            read_fd, write_fd = os.pipe()
 
-        def done(proc):
-            self.debug.output('process done')
-            return proc.poll() is not None
+            def _wait():
+                process.wait()
+                os.close(write_fd)
 
-        def success(proc):
-            self.debug.output('process success')
-            return proc.returncode == 0
+            Thread(target=_wait, daemon=True).start()
+            return read_fd
 
-        def fail():
-            self.debug.output('process fail, now what?')
-            return
+    def exec_commands(self, cmds, timeout=None, fail_fast=True):
+        """Exec commands in parallel, one per drive, and wait for them to exit
+
+        Processes are watched with a selector on their exit file descriptors, so
+        this returns as soon as the last one exits. A command running longer than
+        timeout seconds is killed; with fail_fast, one failed command kills the
+        rest.
+
+        :rtype: list of dictionaries (one per command, in order) with the drive,
+            command, returncode, seconds and whether it timed_out or was killed
+        """
+        if not cmds: return [] # empty file_list
+
+        results = []
+        selector = selectors.DefaultSelector()
+        running = {}
+
+        def _kill(result, reason):
+            """kill the command's whole process group (the shell and its children)"""
+            result[reason] = True
+            try:
+                os.killpg(result['process'].pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        for drive_int, command in enumerate(cmds):
+            self.debug.output('{}: {}'.format(drive_int, command))
+            process = Popen(command, shell=True, start_new_session=True)
+            result = {'drive': drive_int, 'command': command, 'returncode': None, 'seconds': None,
+                      'timed_out': False, 'killed': False, 'process': process, 'start': time.time()}
+            exit_fd = self.exit_fd(process)
+            selector.register(exit_fd, selectors.EVENT_READ, result)
+            running[exit_fd] = result
+            results.append(result)
+
+        while running:
+            ## wait for an exit, or the next timeout
+            deadlines = [result['start'] + timeout for result in running.values()
+                         if not result['timed_out']] if timeout is not None else []
+            wait = max(0, min(deadlines) - time.time()) if deadlines else None
+
+            for key, events in selector.select(wait):
+                result = key.data
+                selector.unregister(key.fd)
+                os.close(key.fd)
+                del running[key.fd]
+
+                result['returncode'] = result['process'].wait()
+                result['seconds'] = time.time() - result['start']
+                self.debug.output('process done: {} ({}) in {:.2f}s'.format(
+                    result['command'], result['returncode'], result['seconds']))
+
+                if result['returncode'] != 0 and fail_fast:
+                    for other_result in running.values():
+                        if not other_result['killed']:
+                            self.debug.output('process fail, killing {}'.format(other_result['command']))
+                            _kill(other_result, 'killed')
+
+            if timeout is not None:
+                for result in running.values():
+                    if not result['timed_out'] and time.time() - result['start'] >= timeout:
+                        self.debug.output('process timeout after {}s: {}'.format(timeout, result['command']))
+                        _kill(result, 'timed_out')
+
+        selector.close()
+        for result in results:
+            del result['process'], result['start']
+        return results
+
+    def check_commands(self, cmds, timeout=None):
+        """exec_commands(), raising if any command failed"""
+        results = self.exec_commands(cmds, timeout=timeout)
+        failed = [result for result in results if result['returncode'] != 0]
+        for result in failed:
+            self.debug.output('drive {} failed: {}'.format(result['drive'], result))
+        if failed:
+            raise Exception('commands failed on drives {}'.format([result['drive'] for result in failed]))
+
+        return results
+
+
+class ArchiveBuilder(Thread):
+    ## init object with the (data_path, archive_path, item) members of an archive
+    ## and the ring buffer the archive is written into
+    def __init__(self, members, ring, md5_dict=None, debug=None):
+        Thread.__init__(self, daemon=True)
+        self.members = members
+        self.ring = ring
+        self.md5_dict = md5_dict
+        self.debug = debug
+        self.error = None
+
+    ## custom run() to stream the archive into the ring buffer, hashing as we go
+    def run(self):
+        archive_tar = None
+        try:
+            archive_tar = tarfile.open(fileobj=self.ring, mode='w|')
+            for data_path, archive_path, item in self.members:
+                digests = add_hashed(archive_tar, data_path, archive_path)
+                if self.md5_dict is not None:
+                    check_hashed(item, digests.get('visdata'), self.md5_dict, self.debug)
+            archive_tar.close()
+            self.ring.close()
+        except Exception as build_error:
+            self.error = build_error
+            self.ring.abort(build_error)
+            ## mark the half written stream closed; flushing it would only fail again
+            if archive_tar is not None:
+                try:
+                    archive_tar.fileobj.close()
+                except Exception:
+                    pass
 
-        processes = []
-        while True:
-            while cmds:
-                task = cmds.pop()
-                processes.append(Popen(task, shell=True))
-
-            for process in processes:
-                self.debug.output('{}'.format(process.args))
-                if done(process):
-                    if success(process):
-                        processes.remove(process)
-                    else:
-                        fail()
-                        ## if we don't remove the process it will loop infinitely
-                        ## on the other hand if we proceed without escalating the failure properly,
-                        ## we'll probably keep running into the same problem with subsequent runs
-                        ## TODO(dconover): update return value to terminate dump cleanly
-                        ## processes.remove(process)
-
-            if not processes and not cmds:
-                self.debug.output('break')
-                break
-            else:
-                self.debug.output('sleep', debug_level=250)
-                time.sleep(5)
 
 class RamTar(object):
     """handling python tarfile opened directly against tape devices"""
@@ -756,6 +1435,16 @@ class RamTar(object):
         self.archive_tar = tarfile.open(mode='w:', fileobj=self.archive_bytes)
         self.archive_info = tarfile.TarInfo()
 
+        ## stream each archive through a ring buffer of ring_buffer_mb straight to
+        ## both drives, instead of building the whole archive in archive_bytes
+        self.streaming = True
+        self.ring_buffer_mb = 256
+
+        ## where each archive was written (see add_positions())
+        self.drive_positions = {}
+        self.archive_positions = {}
+        self.device_format = tape_device_format
+
         ## tape opened with tar
         ## this is a dictionary where we will do:
         ## self.tape_drive[drive_int] = tarfile.open(mode='w:')
@@ -797,7 +1486,7 @@ class RamTar(object):
             if int(drive_int) == 2:
                 for _loop_int in 0,1:
                     ## define the actual device path
-                    device_path = '/dev/nst{}'.format(drive_int)
+                    device_path = self.device_format.format(drive_int)
                     if self.drive_state[drive_int] is self.drive_states.drive_init:
                         self.debug.output('open tar on {}'.format(device_path))
                         ## create a filehandle for the device
@@ -809,7 +1498,7 @@ class RamTar(object):
                         self.debug.output('Fail to open {}:{}'.format(device_path, self.drive_state[drive_int]))
             else:
                 self.debug.output('called with drive_int=={}'.format(drive_int))
-                device_path = '/dev/nst{}'.format(drive_int)
+                device_path = self.device_format.format(drive_int)
                 if drive_int in self.drive_state and self.drive_state[drive_int] is self.drive_states.drive_init:
                     self.debug.output('open tar on {}'.format(device_path))
                     ## create a filehandle for the device
@@ -853,8 +1542,12 @@ class RamTar(object):
 
         return action_return
 
-    def archive_from_list(self, tape_list):
-        """take a tape list, build each archive, write to tapes"""
+    def archive_from_list(self, tape_list, md5_dict=None):
+        """take a tape list, build each archive, write to tapes
+
+        If md5_dict is given, each visdata md5 hashed while building the archive
+        must match it, or the archive fails before it is sent to tape.
+        """
 
         archive_dict = defaultdict(list)
         archive_list_dict = defaultdict(list)
@@ -877,6 +1570,13 @@ class RamTar(object):
                 archive_file =  '{}/{}'.format(archive_dir,archive_name)
                 archive_list = '{}/{}.file_list'.format(archive_dir, archive_prefix)
 
+                if self.streaming:
+                    members = [('/'.join([data_dir, item]), '/'.join([archive_prefix, item]), item)
+                               for item in archive_dict[tape_index]]
+                    self.stream_archive_to_tape(members, archive_list, archive_name, archive_file, md5_dict=md5_dict)
+                    add_positions(self.archive_positions, tape_index, self.drive_positions)
+                    continue
+
                 ## rewind the archive to zero to we don't fill up ram
                 self.archive_bytes = BytesIO()
                 self.archive_tar = tarfile.open(mode='w:', fileobj=self.archive_bytes)
@@ -888,7 +1588,9 @@ class RamTar(object):
                     data_path = '/'.join([data_dir, item])
                     ## TODO(dconover): remove excess leading paths from archive_path
                     archive_path = '/'.join([archive_prefix, item])
-                    self.append_to_archive(data_path, file_path_rewrite=archive_path )
+                    data_md5 = self.append_to_archive(data_path, file_path_rewrite=archive_path )
+                    if md5_dict is not None:
+                        check_hashed(item, data_md5, md5_dict, self.debug)
 
                 ## close the file but not the bytestream
                 self.archive_tar.close()
@@ -896,9 +1598,11 @@ class RamTar(object):
                 arc.close()
 
                 ## send archive group to both tapes
+                self.drive_positions = {}
                 for drive in [0,1]:
                     self.debug.output('send data')
                     self.send_archive_to_tape(drive, archive_list, archive_name, archive_file)
+                add_positions(self.archive_positions, tape_index, self.drive_positions)
 
         else:
             ## I don't think its a good idea to do this since you have to read the data twice
@@ -906,19 +1610,95 @@ class RamTar(object):
             pass
 
     def append_to_archive(self, file_path, file_path_rewrite=None):
-        """add data to an open archive"""
+        """add data to an open archive, return the md5 of file_path/visdata hashed on the way in"""
         arcname = file_path if file_path_rewrite is None else file_path_rewrite
         try:
             self.debug.output('file_path={}, arcname={}'.format(file_path, arcname))
-            self.archive_tar.add(file_path, arcname=arcname)
+            digests = add_hashed(self.archive_tar, file_path, arcname)
         except Exception as cept:
             self.debug.output('tarfile exception - {}'.format(cept))
             raise
 
+        return digests.get('visdata')
+
+    def stream_archive_to_tape(self, members, archive_list, archive_name, archive_file, md5_dict=None):
+        """build an archive and write it to both tapes at the same time
+
+        An ArchiveBuilder thread writes the archive into a ring buffer while this
+        thread reads it back into the tape tar, so memory use is bounded by the
+        ring buffer and building overlaps writing. The tape tar needs the archive
+        size up front, so it is computed from the file headers and sizes first.
+        """
+        self.debug.output('{}'.format(archive_name))
+        archive_size = tar_stream_size([(data_path, archive_path) for data_path, archive_path, item in members])
+
+        ## the tape tar gets its member info from an empty placeholder file
+        arc = open(archive_file, mode='w')
+        arc.close()
+
+        ring = RingBuffer(int(self.ring_buffer_mb * 1024 * 1024))
+        builder = ArchiveBuilder(members, ring, md5_dict=md5_dict, debug=self.debug)
+        device_paths = dict((drive_int, self.device_format.format(drive_int)) for drive_int in (0, 1))
+        writer = FanOutWriter(self.pid, device_paths, debug=self.debug.debug_state, debug_threshold=self.debug.debug_threshold)
+
+        builder.start()
+        try:
+            tape_tar = tarfile.open(fileobj=writer, mode='w|')
+            tape_tar.add(archive_list)
+            self.archive_info = tape_tar.gettarinfo(archive_file)
+            self.archive_info.size = archive_size
+            tape_tar.addfile(tarinfo=self.archive_info, fileobj=ring)
+
+            ## the builder must be at the end of the archive before the tape file is
+            ## finished; a longer archive would go to tape truncated (or hold up the
+            ## builder on a full ring buffer)
+            if ring.read(1) or ring.bytes_written != archive_size:
+                self.debug.output('archive size {} does not match the expected {}'.format(ring.bytes_written, archive_size))
+                raise Exception('archive size mismatch {}'.format(archive_name))
+            tape_tar.close()
+        except Exception as cept:
+            self.debug.output('tarfile - {}'.format(cept))
+            ring.abort(cept)
+            writer.abort(cept)
+            raise
+        finally:
+            builder.join()
+            if builder.error is not None:
+                writer.abort(builder.error)
+            drive_report = writer.close()
+            self.drive_positions = complete_positions(drive_report)
+
+        if builder.error is not None:
+            self.debug.output('archive build error - {}'.format(builder.error))
+            raise builder.error
+
+        drive_errors = writer.drive_errors()
+        if drive_errors:
+            for drive_int, drive_error in drive_errors.items():
+                self.debug.output('write to drive {} failed - {}'.format(drive_int, drive_error))
+            raise Exception('tape write failed on drives {}'.format(sorted(drive_errors)))
+
+        return drive_report
+
+    def tell_drive(self, drive_int):
+        """return the block position of a drive, or None if it can't be read"""
+        try:
+            with open_tape(self.pid, self.device_format.format(drive_int), block_size=tarfile.RECORDSIZE) as tape:
+                return tape.tell()
+        except OSError as tell_error:
+            self.debug.output('no position for drive {} - {}'.format(drive_int, tell_error))
+            return None
+
+    def record_drive_position(self, drive_int, start_block):
+        """record the tape file just closed on a drive; closing wrote a filemark after the data"""
+        end_block = self.tell_drive(drive_int)
+        self.drive_positions[drive_int] = (start_block, None if end_block is None else end_block - 1)
+
     def send_archive_to_tape(self, drive_int, archive_list, archive_name, archive_file):
         """send the current archive to tape"""
         try:
             self.debug.output('{}'.format(archive_name))
+            start_block = self.tell_drive(drive_int)
             self.ramtar_tape_drive(drive_int, self.drive_states.drive_open)
             self.debug.output('{}'.format(self.drive_state))
             ## add archive_list
@@ -936,6 +1716,7 @@ class RamTar(object):
             ## write the bytes with info to the tape
             self.tape_drive[drive_int].addfile(tarinfo=self.archive_info, fileobj=self.archive_bytes)
             self.ramtar_tape_drive(drive_int, self.drive_states.drive_close)
+            self.record_drive_position(drive_int, start_block)
             self.archive_bytes.seek(0)
 
         except Exception as cept:
@@ -963,6 +1744,12 @@ class FastTar(RamTar):
         ## we need to track different states
         ## for faster archiving we keep some data in memory instead of queuing to disk
         self.archive_tar = ''
+        self.streaming = False
+
+        ## where each archive was written (see add_positions())
+        self.drive_positions = {}
+        self.archive_positions = {}
+        self.device_format = tape_device_format
 
         ## tape opened with tar
         ## this is a dictionary where we will do:
@@ -979,6 +1766,7 @@ class FastTar(RamTar):
         """send the current archive to tape"""
         try:
             self.debug.output('{}'.format(archive_name))
+            start_block = self.tell_drive(drive_int)
             self.ramtar_tape_drive(drive_int, self.drive_states.drive_open)
             self.debug.output('{}'.format(self.drive_state))
 
@@ -988,6 +1776,7 @@ class FastTar(RamTar):
             ## write the tape
             #self.tape_drive[drive_int].add(archive_file)
             self.ramtar_tape_drive(drive_int, self.drive_states.drive_close)
+            self.record_drive_position(drive_int, start_block)
 
             ## truncate the current archive to save disk space
             archive_open = open(archive_file, 'w')
@@ -0,0 +1,192 @@
+"""Run dump stages as a pipeline
+
+   A Pipeline passes items (batches of a dump) through a list of stages. Each
+stage has its own worker threads and reads from a bounded queue filled by the
+stage before it, so while one batch is written to tape the next ones are
+already being staged and archived. The queues are bounded so the stages can't
+run ahead of the tape by more than a few batches.
+"""
+
+import heapq
+import time
+import threading
+
+from queue import Queue
+from threading import Thread
+
+from paper_debug import Debug
+
+## marks the end of the items on a queue
+end_of_items = None
+
+
+class PipelineStage(object):
+    """one step of a pipeline"""
+
+    def __init__(self, name, action, workers=1, ordered=False):
+        """describe a stage
+        :type name: str
+        :type action: function
+        :param action: called with each item, returns the item passed to the next stage
+        :type workers: int
+        :param workers: number of threads running action
+        :type ordered: bool
+        :param ordered: run items in the order they entered the pipeline (forces one worker)
+        """
+        self.name = name
+        self.action = action
+        self.workers = 1 if ordered else workers
+        self.ordered = ordered
+
+        ## stage statistics
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+
+
+class StageThread(Thread):
+    ## init object with the pipeline and the index of the stage to work on
+    def __init__(self, pipeline, stage_index):
+        Thread.__init__(self, daemon=True)
+        self.pipeline = pipeline
+        self.stage_index = stage_index
+
+    ## custom run() to work on the stage until its queue is done
+    def run(self):
+        self.pipeline.run_stage(self.stage_index)
+
+
+class Pipeline(object):
+    """pass items through stages connected by bounded queues"""
+
+    def __init__(self, pid, stages, queue_size=1, debug=False, debug_threshold=255):
+        """initialize the queues between stages
+        :type pid: basestring
+        :type stages: list
+        :param stages: list of PipelineStage
+        :type queue_size: int
+        :param queue_size: items waiting between two stages
+        """
+        self.pid = pid
+        self.debug = Debug(self.pid, debug=debug, debug_threshold=debug_threshold)
+
+        self.stages = stages
+        self.queues = [Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+
+        self.pipeline_lock = threading.Lock()
+        self.running_workers = [stage.workers for stage in stages]
+        self.stopped = threading.Event()
+        self.error = None
+
+    def fail(self, stage, error):
+        """record the first error and stop every stage from taking new work"""
+        with self.pipeline_lock:
+            if self.error is None:
+                self.debug.output('stage {} failed - {}'.format(stage.name, error))
+                self.error = error
+        self.stopped.set()
+
+    def next_items(self, stage_index):
+        """generator of (sequence, item) from the queue of a stage, in order if the stage is ordered"""
+        stage = self.stages[stage_index]
+        waiting = []
+        next_sequence = 0
+
+        while True:
+            wait_start = time.time()
+            queued = self.queues[stage_index].get()
+            with self.pipeline_lock:
+                stage.wait_seconds += time.time() - wait_start
+
+            if queued is end_of_items:
+                return
+
+            if not stage.ordered:
+                yield queued
+                continue
+
+            heapq.heappush(waiting, queued)
+            while waiting and waiting[0][0] == next_sequence:
+                yield heapq.heappop(waiting)
+                next_sequence += 1
+
+    def run_stage(self, stage_index):
+        """take items from the stage queue, run the stage action and pass the result on
+
+        After an error items are still taken from the queue, but not worked on, so
+        no stage is left blocked on a full queue.
+        """
+        stage = self.stages[stage_index]
+
+        for sequence, item in self.next_items(stage_index):
+            if self.stopped.is_set():
+                continue
+
+            busy_start = time.time()
+            try:
+                result = stage.action(item)
+            except Exception as error:
+                self.fail(stage, error)
+                continue
+            finally:
+                with self.pipeline_lock:
+                    stage.busy_seconds += time.time() - busy_start
+
+            with self.pipeline_lock:
+                stage.items += 1
+            self.queues[stage_index + 1].put((sequence, result))
+
+        ## the last worker of a stage tells every worker of the next stage to finish
+        with self.pipeline_lock:
+            self.running_workers[stage_index] -= 1
+            last_worker = self.running_workers[stage_index] == 0
+
+        if last_worker:
+            next_workers = self.stages[stage_index + 1].workers if stage_index + 1 < len(self.stages) else 1
+            for _ in range(next_workers):
+                self.queues[stage_index + 1].put(end_of_items)
+
+    def run(self, items):
+        """pass every item through the pipeline
+
+        :rtype: list of the results of the last stage, in the order of items
+        """
+        start_time = time.time()
+        workers = [StageThread(self, stage_index)
+                   for stage_index, stage in enumerate(self.stages) for _ in range(stage.workers)]
+        for worker in workers:
+            worker.start()
+
+        def _feed():
+            for sequence, item in enumerate(items):
+                if self.stopped.is_set():
+                    break
+                self.queues[0].put((sequence, item))
+            for _ in range(self.stages[0].workers):
+                self.queues[0].put(end_of_items)
+
+        feeder = Thread(target=_feed, daemon=True)
+        feeder.start()
+
+        results = []
+        while True:
+            queued = self.queues[-1].get()
+            if queued is end_of_items:
+                break
+            results.append(queued)
+
+        feeder.join()
+        for worker in workers:
+            worker.join()
+
+        self.report(time.time() - start_time)
+        if self.error is not None:
+            raise self.error
+
+        return [result for sequence, result in sorted(results, key=lambda queued: queued[0])]
+
+    def report(self, elapsed):
+        """output the busy and waiting time of every stage"""
+        for stage in self.stages:
+            self.debug.output('stage {}: {} items, busy {:.2f}s, waiting {:.2f}s of {:.2f}s'.format(
+                stage.name, stage.items, stage.busy_seconds, stage.wait_seconds, elapsed))
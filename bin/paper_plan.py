@@ -0,0 +1,145 @@
+"""Plan tape batches
+
+   BatchPlanner takes the candidate (source, filesize) pairs for a dump and packs
+them into batches, and batches into tapes, with first-fit-decreasing. Files from
+the same night (zen.$julian_date.*) are packed as one unit whenever the night fits
+in a single batch.
+"""
+
+import re
+
+import numpy as np
+
+from paper_debug import Debug
+
+## zen.2455933.55758.uv -> 2455933
+night_regex = re.compile(r'zen\.(\d+)\.')
+
+
+class BatchPlanner(object):
+    """pack candidate files into batches and tapes"""
+
+    def __init__(self, pid, batch_size_mb, tape_size_mb, debug=False, debug_threshold=255):
+        """initialize with batch and tape capacities
+        :type pid: basestring
+        :type batch_size_mb: float
+        :param batch_size_mb: capacity of a single batch (archive) in MB
+        :type tape_size_mb: float
+        :param tape_size_mb: capacity of a single tape in MB
+        """
+        self.pid = pid
+        self.debug = Debug(self.pid, debug=debug, debug_threshold=debug_threshold)
+
+        self.batch_size_mb = batch_size_mb
+        self.tape_size_mb = tape_size_mb
+        self.plan_window = 1.1 ## tapes worth of candidate files considered per planned tape
+
+    def night_keys(self, sources):
+        """return an array of night (integer julian date) keys; -1 if there is no date in the source"""
+        def _night(source):
+            night_match = night_regex.search(source)
+            return int(night_match.group(1)) if night_match else -1
+
+        return np.fromiter((_night(source) for source in sources), dtype=np.int64, count=len(sources))
+
+    def pack_units(self, unit_sizes, capacity, bin_count=None):
+        """first-fit-decreasing of unit_sizes into bins of the given capacity
+
+        Each unit depends on where the units before it went, so this is a plain
+        python loop over the units; only the search for the first bin with room
+        is done with numpy, and only over the bins in use plus one new bin.
+
+        :param unit_sizes: array of sizes
+        :param capacity: float
+        :param bin_count: int, limit the number of bins; units that don't fit are left out
+        :rtype: (array, array) bin index of every unit (-1 if not packed), and the fill of every bin
+        """
+        unit_sizes = np.asarray(unit_sizes, dtype=np.float64)
+        unit_bins = np.full(len(unit_sizes), -1, dtype=np.int64)
+        max_bins = len(unit_sizes) if bin_count is None else bin_count
+        remaining = np.full(max(max_bins, 1), float(capacity))
+        used_bins = 0
+
+        for unit in np.argsort(-unit_sizes, kind='stable'):
+            unit_size = unit_sizes[unit]
+            if unit_size > capacity:
+                self.debug.output('unit_size (%s) larger than capacity (%s)' % (unit_size, capacity), debug_level=254)
+                continue
+
+            ## unused bins are still empty, so the first bin with room is either
+            ## a bin already in use or the next new bin
+            open_bins = remaining[:min(used_bins + 1, len(remaining))]
+            bin_index = int((open_bins >= unit_size).argmax())
+            if open_bins[bin_index] < unit_size:
+                continue
+
+            unit_bins[unit] = bin_index
+            remaining[bin_index] -= unit_size
+            used_bins = max(used_bins, bin_index + 1)
+
+        return unit_bins, capacity - remaining[:used_bins]
+
+    def plan_batches(self, sources, sizes, batch_count=None, nights=None):
+        """pack files into batches of batch_size_mb, keeping nights together where they fit
+
+        :param sources: list of sources
+        :param sizes: list of sizes in MB
+        :param batch_count: int, limit the number of batches
+        :param nights: array of night keys, if already known
+        :rtype: (list, array) list of batches (each a list of indices into sources), and the fill of each batch
+        """
+        sizes = np.asarray(sizes, dtype=np.float64)
+        nights = self.night_keys(sources) if nights is None else nights
+
+        ## whole nights that fit in a batch are packed as one unit
+        night_values, night_index = np.unique(nights, return_inverse=True)
+        night_index = night_index.reshape(-1)
+        night_sizes = np.bincount(night_index, weights=sizes, minlength=len(night_values))
+        whole_night = (night_sizes[night_index] <= self.batch_size_mb) & (nights >= 0)
+
+        ## group whole nights by sorting on the night index, every other file is packed on its own
+        night_files = np.flatnonzero(whole_night)
+        night_files = night_files[np.argsort(night_index[night_files], kind='stable')]
+        night_starts = np.flatnonzero(np.diff(night_index[night_files])) + 1
+        night_units = np.cumsum(np.r_[0, np.diff(night_index[night_files]) != 0]) if len(night_files) else np.zeros(0, dtype=np.int64)
+        single_files = np.flatnonzero(~whole_night)
+
+        unit_sizes = np.concatenate([
+            night_sizes[night_index[night_files[np.r_[0, night_starts]]]] if len(night_files) else np.zeros(0),
+            sizes[single_files],
+        ])
+        unit_bins, batch_fill = self.pack_units(unit_sizes, self.batch_size_mb, bin_count=batch_count)
+
+        ## map units back to files; files stay in source order inside each batch
+        file_bins = np.full(len(sizes), -1, dtype=np.int64)
+        file_bins[night_files] = unit_bins[night_units]
+        file_bins[single_files] = unit_bins[len(night_starts) + 1 if len(night_files) else 0:]
+
+        batched_files = np.flatnonzero(file_bins >= 0)
+        batched_files = batched_files[np.argsort(file_bins[batched_files], kind='stable')]
+        batch_starts = np.searchsorted(file_bins[batched_files], np.arange(len(batch_fill)))
+        batches = [batch.tolist() for batch in np.split(batched_files, batch_starts[1:])] if len(batch_fill) else []
+
+        return batches, batch_fill
+
+    def plan_tape(self, sources, sizes, nights=None, report=True):
+        """plan a single tape out of the candidate files
+
+        Only as many batches as fit on one tape are packed, so files that are
+        left over stay unclaimed for the next dump.
+
+        :rtype: dictionary with the batches of the tape and the planned fill ratio
+        """
+        batch_count = int(self.tape_size_mb // self.batch_size_mb)
+        batches, batch_fill = self.plan_batches(sources, sizes, batch_count=batch_count, nights=nights)
+
+        tape = {'batches': batches, 'size_mb': float(batch_fill.sum()), 'fill_ratio': float(batch_fill.sum()) / self.tape_size_mb}
+        if report:
+            self.report([tape])
+        return tape
+
+    def report(self, tapes):
+        """output the planned fill of each tape"""
+        for tape_number, tape in enumerate(tapes):
+            self.debug.output('planned tape {}: {} batches, {:.2f} MB, fill_ratio {:.4f}'.format(
+                tape_number, len(tape['batches']), tape['size_mb'], tape['fill_ratio']))
@@ -0,0 +1,259 @@
+"""Shared database connections
+
+PaperDB and MtxDB both get their mysql connections from a ConnectionPool. There
+is one pool per credentials file, and each PaperDB or MtxDB (the owner) is handed
+its own connection and cursor in each thread that uses it, so threads like
+VerifyThread never share a cursor, and two owners in one thread never share a
+transaction.
+
+Connections are checked with a ping before they are handed out, instead of
+assuming they have gone away after a fixed timeout.
+"""
+
+import threading
+import time
+
+import pymysql
+import pymysql.cursors
+
+from datetime import datetime
+
+from paper_debug import Debug
+
+## one pool per credentials file
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(credentials, pid, connection_timeout=90, pool_size=4, debug=False, debug_threshold=255):
+    """return the shared ConnectionPool for the given credentials file, creating it if necessary"""
+    with _pools_lock:
+        if credentials not in _pools:
+            _pools[credentials] = ConnectionPool(credentials, pid, connection_timeout=connection_timeout,
+                                                 pool_size=pool_size, debug=debug, debug_threshold=debug_threshold)
+        return _pools[credentials]
+
+
+class ConnectionPool(object):
+    """pool of mysql connections handed out one per thread and owner"""
+
+    def __init__(self, credentials, pid, connection_timeout=90, pool_size=4, debug=False, debug_threshold=255):
+        """initialize an empty pool
+        :type credentials: str
+        :param credentials: mysql defaults file
+        :type pid: basestring
+        :type connection_timeout: int
+        :param connection_timeout: connect timeout in seconds
+        :type pool_size: int
+        :param pool_size: number of idle connections to keep for reuse
+        """
+        self.pid = pid
+        self.debug = Debug(self.pid, debug=debug, debug_threshold=debug_threshold)
+
+        self.credentials = credentials
+        self.connection_timeout = connection_timeout
+        self.pool_size = pool_size
+
+        self.idle_connections = []
+        self.pool_lock = threading.Lock()
+        self.thread_local = threading.local()
+
+        ## connection statistics
+        self.connect_count = 0
+        self.connect_seconds = 0.0
+        self.reconnect_count = 0
+        self.ping_count = 0
+        self.ping_seconds = 0.0
+
+    def _open(self):
+        """open a new connection"""
+        start_time = time.time()
+        connection = pymysql.connect(read_default_file=self.credentials, connect_timeout=self.connection_timeout)
+        elapsed = time.time() - start_time
+
+        with self.pool_lock:
+            self.connect_count += 1
+            self.connect_seconds += elapsed
+
+        self.debug.output('opened connection {} in {:.3f}s'.format(self.credentials, elapsed))
+        return connection
+
+    def _alive(self, connection):
+        """return true if the connection answers a ping"""
+        alive = True
+        start_time = time.time()
+        try:
+            connection.ping(reconnect=False)
+        except Exception as mysql_error:
+            self.debug.output('ping failed {}'.format(mysql_error))
+            alive = False
+        elapsed = time.time() - start_time
+
+        with self.pool_lock:
+            self.ping_count += 1
+            self.ping_seconds += elapsed
+
+        return alive
+
+    def _discard(self, connection):
+        """close a connection, ignoring errors from connections that are already gone"""
+        try:
+            connection.close()
+        except Exception as mysql_error:
+            self.debug.output('close error {}'.format(mysql_error), debug_level=250)
+
+    def checkouts(self):
+        """the calling thread's [connection, cursor] by owner"""
+        if not hasattr(self.thread_local, 'checkouts'):
+            self.thread_local.checkouts = {}
+        return self.thread_local.checkouts
+
+    def connection(self, owner=None):
+        """return a live connection for the calling thread and owner"""
+        checkout = self.checkouts().setdefault(owner, [None, None])
+        connection = checkout[0]
+
+        ## take an idle connection from the pool or open a new one
+        if connection is None:
+            with self.pool_lock:
+                connection = self.idle_connections.pop() if self.idle_connections else None
+            if connection is None:
+                connection = self._open()
+            checkout[1] = None
+
+        ## replace connections that have gone away
+        if not self._alive(connection):
+            self._discard(connection)
+            connection = self._open()
+            checkout[1] = None
+            with self.pool_lock:
+                self.reconnect_count += 1
+
+        checkout[0] = connection
+        return connection
+
+    def cursor(self, owner=None):
+        """return a cursor on the calling thread's connection for owner"""
+        connection = self.connection(owner)
+        checkout = self.checkouts()[owner]
+        cursor = checkout[1]
+        if cursor is None or cursor.connection is not connection:
+            cursor = connection.cursor()
+            checkout[1] = cursor
+
+        return cursor
+
+    def current_connection(self, owner=None):
+        """return the calling thread's connection for owner without checking it"""
+        return self.checkouts().get(owner, [None, None])[0]
+
+    def current_cursor(self, owner=None):
+        """return the calling thread's cursor for owner without checking it"""
+        return self.checkouts().get(owner, [None, None])[1]
+
+    def release(self, owner=None):
+        """return the calling thread's connection for owner to the pool"""
+        connection, cursor = self.checkouts().pop(owner, [None, None])
+        if connection is None:
+            return
+
+        if cursor is not None:
+            cursor.close()
+
+        with self.pool_lock:
+            if len(self.idle_connections) < self.pool_size:
+                self.idle_connections.append(connection)
+                connection = None
+
+        if connection is not None:
+            self._discard(connection)
+
+    def close(self, owner=None):
+        """close the calling thread's connection for owner and every idle connection"""
+        self.release(owner)
+        with self.pool_lock:
+            idle_connections, self.idle_connections = self.idle_connections, []
+
+        for connection in idle_connections:
+            self._discard(connection)
+
+    def stats(self):
+        """return a dictionary of connection statistics"""
+        with self.pool_lock:
+            return {
+                'connects': self.connect_count,
+                'connect_seconds': self.connect_seconds,
+                'reconnects': self.reconnect_count,
+                'pings': self.ping_count,
+                'ping_seconds': self.ping_seconds,
+                'idle': len(self.idle_connections),
+            }
+
+
+class PooledDB(object):
+    """database connection handling shared by PaperDB and MtxDB
+
+    Subclasses set self.pid, self.debug, self.credentials and self.connection_timeout
+    before calling db_connect('init', credentials).
+    """
+
+    @property
+    def connect(self):
+        """the calling thread's connection"""
+        return self.pool.current_connection(self)
+
+    @property
+    def cur(self):
+        """the calling thread's cursor"""
+        return self.pool.current_cursor(self)
+
+    def update_connection_time(self):
+        """refresh database connection time"""
+        self.debug.output('updating connection_time')
+        self.connection_time = datetime.now()
+
+    def connection_time_delta(self):
+        """return connection age"""
+        self.debug.output('connection_time:%s' % self.connection_time)
+        delta = datetime.now() - self.connection_time
+        return delta.total_seconds()
+
+    def db_connect(self, command=None, credentials=None):
+        """get a live connection for the calling thread from the shared pool"""
+        self.debug.output('input:%s %s' % (command, credentials))
+        self.credentials = credentials if credentials is not None else self.credentials
+
+        if command == 'init' or self.pool.credentials != self.credentials:
+            self.debug.output("setting pool %s %s" % (self.credentials, self.connection_timeout))
+            self.pool = get_pool(self.credentials, self.pid, connection_timeout=self.connection_timeout,
+                                 debug=self.debug.debug_state, debug_threshold=self.debug.debug_threshold)
+
+        self.pool.cursor(self)
+        self.update_connection_time()
+        self.debug.output("connection_time:%s" % self.connection_time)
+
+    def stream_rows(self, select_sql, select_args=None, fetch_size=1000):
+        """generator of rows from an unbuffered (server side) cursor
+
+        Rows are fetched fetch_size at a time, so large scans run in flat memory.
+        The connection can't run other queries until the generator is exhausted
+        or closed.
+        """
+        self.db_connect()
+        stream_cursor = self.connect.cursor(pymysql.cursors.SSCursor)
+        try:
+            stream_cursor.execute(select_sql, select_args)
+            while True:
+                rows = stream_cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            stream_cursor.close()
+            self.update_connection_time()
+
+    def db_release(self):
+        """return the calling thread's connection to the shared pool"""
+        self.debug.output('pool stats: {}'.format(self.pool.stats()))
+        self.pool.release(self)
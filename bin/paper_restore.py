@@ -0,0 +1,336 @@
+"""Restore files from tape
+
+   Restore takes a list of sources (the directory paths written by a dump),
+looks up their copies in the local CatalogIndex and reads them back from tape.
+One copy of each source is picked so that as few tapes as possible are loaded,
+and the archives of each tape are read in tape order, in one forward pass. If
+the block positions of the archives were recorded (see Changer.write_positions())
+the drive seeks straight to each archive; otherwise it reads through the tape
+from the catalog on. Only the requested sources are extracted.
+
+   One RestoreThread per drive takes tapes from a shared list, starting with
+the tape already loaded in its drive, so two tapes are read at once.
+"""
+
+import hashlib
+import os
+import re
+import tarfile
+import threading
+import time
+
+from random import randint
+from threading import Thread
+
+from paper_catalog import CatalogIndex
+from paper_debug import Debug
+from paper_mtx import Changer
+from paper_status_code import StatusCode
+from paper_tape import tape_files, TapeFileReader
+
+## member of a tape file holding an archive: papertape/queue/$pid/paper.$pid.$tape_index.tar
+archive_regex = re.compile(r'(?:^|/)paper\.([0-9]+)\.([0-9]+)\.tar$')
+
+
+def choose_labels(locations, loaded_labels=()):
+    """pick one copy of every source, using as few tapes as possible
+
+    Tapes already loaded are used first, then the tape holding the most of the
+    remaining sources is picked until every source is covered (a greedy set cover).
+
+    :param locations: dict of the location dictionaries (see CatalogIndex.locate()) of each source
+    :param loaded_labels: labels of the tapes in the drives
+    :rtype: dict of {tape_index: [location]} by label
+    """
+    sources_by_label = {}
+    for source, source_locations in locations.items():
+        for location in source_locations:
+            sources_by_label.setdefault(location['label'], {})[source] = location
+
+    remaining = set(locations)
+    chosen = {}
+    while remaining:
+        label = max(sources_by_label, key=lambda label: (
+            label in loaded_labels, len(remaining.intersection(sources_by_label[label])), label))
+        covered = remaining.intersection(sources_by_label[label])
+        for source in sorted(covered):
+            location = sources_by_label[label][source]
+            chosen.setdefault(label, {}).setdefault(location['tape_index'], []).append(location)
+        remaining -= covered
+        del sources_by_label[label]
+
+    return chosen
+
+
+def source_of(relative_name, sources):
+    """return the source that relative_name is, or is under, or None"""
+    path = relative_name.rstrip('/')
+    while path:
+        if path in sources:
+            return path
+        path = os.path.dirname(path)
+    return None
+
+
+class RestoreThread(Thread):
+    ## init object with the restore to take tapes from and the drive to read them with
+    def __init__(self, restore, drive_int):
+        Thread.__init__(self)
+        self.restore = restore
+        self.drive_int = drive_int
+
+    ## custom run() to read tapes in this drive until none are left
+    def run(self):
+        self.restore.run_drive(self.drive_int)
+
+
+class Restore(object):
+    """read sources back from tape"""
+
+    def __init__(self, version, pid=None, destination='/papertape/restore', catalog_db='/papertape/catalog/paper.catalog.sqlite', drive_select=2, debug=False, debug_threshold=255):
+        """initialize
+        :type destination: str
+        :param destination: directory the sources are restored under
+        :type catalog_db: str
+        :param catalog_db: local index of tape locations (see CatalogIndex)
+        :type drive_select: int
+        :param drive_select: number of drives to read with
+        """
+        self.version = version
+        self.pid = "%0.6d%0.3d" % (os.getpid(), randint(1, 999)) if pid is None else pid
+        self.debug = Debug(self.pid, debug=debug, debug_threshold=debug_threshold)
+        self.status_code = StatusCode
+
+        self.destination = destination
+        self.drive_select = drive_select
+        self.chunk_size = 1024 * 1024
+
+        self.catalog = CatalogIndex(self.pid, catalog_db=catalog_db, debug=debug, debug_threshold=debug_threshold)
+        self.tape = Changer(self.version, self.pid, 0, drive_select=drive_select, debug=debug, debug_threshold=debug_threshold)
+
+        ## the changer and the restore report are shared by the drive threads
+        self.changer_lock = threading.Lock()
+        self.restore_lock = threading.Lock()
+        self.tape_plan = {}
+        self.pending_labels = []
+        self.restored = {}
+        self.md5_mismatch = []
+        self.tape_report = {}
+
+    def plan(self, sources):
+        """group the sources by tape, each tape's archives in the order they are on tape
+
+        :rtype: tuple of (dict of [(position, tape_index, locations)] by label, list of sources not in the catalog)
+        """
+        locations = {}
+        missing = []
+        for source in sources:
+            source_locations = self.catalog.locate(source)
+            if source_locations:
+                locations[source] = source_locations
+            else:
+                missing.append(source)
+
+        loaded_labels = list(self.tape.label_in_drive.values())
+        tape_plan = {}
+        for label, archives in choose_labels(locations, loaded_labels=loaded_labels).items():
+            tape_plan[label] = sorted(((self.catalog.position(label, tape_index), tape_index, archive_locations)
+                                       for tape_index, archive_locations in archives.items()),
+                                      key=lambda archive: (archive[0]['start_block'] if archive[0] else -1, archive[1]))
+
+        self.debug.output('{} sources on {} tapes, {} not in the catalog'.format(len(locations), len(tape_plan), len(missing)))
+        return tape_plan, missing
+
+    def next_label(self, drive_int):
+        """take the next tape for a drive, preferring the one already in it
+
+        Tapes loaded in the other drives we read with are left for those drives.
+        """
+        with self.restore_lock:
+            loaded_label = self.tape.label_in_drive.get(str(drive_int))
+            if loaded_label in self.pending_labels:
+                self.pending_labels.remove(loaded_label)
+                return loaded_label
+
+            other_labels = [self.tape.label_in_drive.get(str(other_drive)) for other_drive in range(self.drive_select)
+                            if other_drive != drive_int]
+            for label in self.pending_labels:
+                if label not in other_labels:
+                    self.pending_labels.remove(label)
+                    return label
+
+            return None
+
+    def run_drive(self, drive_int):
+        """read tapes with a drive until every tape is read"""
+        while True:
+            label = self.next_label(drive_int)
+            if label is None:
+                break
+
+            start_time = time.time()
+            self.tape_report[label] = {'drive': drive_int, 'archives': len(self.tape_plan[label]), 'seeks': 0, 'bytes': 0, 'error': None}
+            try:
+                self.read_tape(label, drive_int, self.tape_plan[label])
+            except Exception as restore_error:
+                self.debug.output('restore from {} failed - {}'.format(label, restore_error))
+                self.tape_report[label]['error'] = restore_error
+            self.tape_report[label]['seconds'] = time.time() - start_time
+
+    def read_tape(self, label, drive_int, archives):
+        """load a tape and extract the sources of its archives
+
+        :param archives: list of (position, tape_index, locations) in tape order
+        """
+        with self.changer_lock:
+            ## a tape left in a drive we don't read with goes back to its slot first
+            loaded_drive = self.tape.drive_ids.get(label)
+            if loaded_drive and loaded_drive[0] != str(drive_int):
+                self.tape.unload_tape(label)
+            if not self.tape.load_tape_drive(label, drive=drive_int):
+                self.debug.output('could not load {}'.format(label))
+                raise Exception('could not load {}'.format(label))
+
+        ## seek to each archive if every position is known, otherwise read through the tape
+        seekable = all(position is not None for position, tape_index, locations in archives)
+        block_size = archives[0][0]['block_size'] if seekable else None
+        report = self.tape_report[label]
+
+        with self.tape.tape_drives.open_drive(drive_int, block_size=block_size) as tape:
+            if seekable:
+                for position, tape_index, locations in archives:
+                    if tape.tell() != position['start_block']:
+                        tape.seek(position['start_block'])
+                        report['seeks'] += 1
+                    self.read_archives(TapeFileReader(tape), {tape_index: locations}, report)
+            else:
+                remaining = dict((tape_index, locations) for position, tape_index, locations in archives)
+                tape.rewind()
+                ## the first tape file is the catalog
+                tape.fsf(1)
+                for tape_file in tape_files(tape):
+                    for tape_index in self.read_archives(tape_file, remaining, report):
+                        del remaining[tape_index]
+                    if not remaining:
+                        break
+
+    def read_archives(self, tape_file, archives, report):
+        """extract the sources of any of the archives found in a tape file
+
+        :param archives: dict of locations by tape_index
+        :rtype: list of the tape_indexes read
+        """
+        archives_read = []
+        tape_tar = tarfile.open(fileobj=tape_file, mode='r|')
+        for tape_member in tape_tar:
+            archive_match = archive_regex.search(tape_member.name)
+            if not archive_match or int(archive_match.group(2)) not in archives:
+                continue
+
+            tape_index = int(archive_match.group(2))
+            archive = tarfile.open(fileobj=tape_tar.extractfile(tape_member), mode='r|')
+            self.extract_sources(archive, archives[tape_index], report)
+            archives_read.append(tape_index)
+
+            if len(archives_read) == len(archives):
+                break
+
+        return archives_read
+
+    def extract_sources(self, archive, locations, report):
+        """extract the members of an archive under the sources of locations
+
+        The members of each source are together in the archive, so reading stops
+        once every source has been seen and the archive has moved past them.
+        """
+        sources = dict((location['source'], location) for location in locations)
+        seen = set()
+
+        for member in archive:
+            ## members are named paper.$pid.$tape_index/$source/...
+            relative_name = member.name.partition('/')[2]
+            source = source_of(relative_name, sources)
+            if source is None:
+                if len(seen) == len(sources):
+                    break
+                continue
+
+            seen.add(source)
+            md5sum = self.extract_member(archive, member, relative_name, report)
+            expected_md5 = sources[source]['md5']
+            if relative_name == '/'.join([source, 'visdata']) and expected_md5 is not None and md5sum != expected_md5:
+                self.debug.output('md5 does not match: {} {} {}'.format(source, md5sum, expected_md5))
+                with self.restore_lock:
+                    self.md5_mismatch.append(source)
+
+        with self.restore_lock:
+            for source in seen:
+                self.restored[source] = os.path.join(self.destination, source)
+
+    def extract_member(self, archive, member, relative_name, report):
+        """write a member under the destination directory
+
+        :rtype: md5sum of a regular file, or None
+        """
+        if os.path.isabs(relative_name) or '..' in relative_name.split('/'):
+            self.debug.output('skipping unsafe member {}'.format(member.name))
+            return None
+
+        target_path = os.path.join(self.destination, relative_name)
+        if member.isdir():
+            os.makedirs(target_path, exist_ok=True)
+            return None
+        if not member.isfile():
+            self.debug.output('skipping {} (not a regular file)'.format(member.name))
+            return None
+
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        member_hash = hashlib.md5()
+        member_file = archive.extractfile(member)
+        with open(target_path, mode='wb') as target_file:
+            for chunk in iter(lambda: member_file.read(self.chunk_size), b''):
+                member_hash.update(chunk)
+                target_file.write(chunk)
+        os.utime(target_path, (member.mtime, member.mtime))
+
+        report['bytes'] += member.size
+        return member_hash.hexdigest()
+
+    def restore(self, sources):
+        """restore the given sources under the destination directory
+
+        :rtype: StatusCode
+        """
+        restore_status = self.status_code.OK
+        start_time = time.time()
+
+        self.tape_plan, missing = self.plan(sources)
+        self.pending_labels = sorted(self.tape_plan)
+
+        drive_threads = [RestoreThread(self, drive_int) for drive_int in range(self.drive_select)]
+        for drive_thread in drive_threads:
+            drive_thread.start()
+        for drive_thread in drive_threads:
+            drive_thread.join()
+
+        with self.changer_lock:
+            self.tape.unload_tape_pair()
+
+        missing.extend(source for source in sources if source not in self.restored and source not in missing)
+        for label, report in sorted(self.tape_report.items()):
+            self.debug.output('{}: {}'.format(label, report))
+        self.debug.output('restored {} of {} sources in {:.2f}s'.format(len(self.restored), len(sources), time.time() - start_time))
+
+        if self.md5_mismatch:
+            self.debug.output('md5 mismatch: {}'.format(self.md5_mismatch))
+            restore_status = self.status_code.md5_mismatch
+        elif missing:
+            self.debug.output('not restored: {}'.format(missing))
+            restore_status = self.status_code.file_missing
+
+        return restore_status
+
+    def close_restore(self):
+        """cleanup"""
+        self.catalog.close_catalog()
+        self.tape.close_changer()
@@ -0,0 +1,258 @@
+"""Simulated tape library
+
+   SimLibrary stands in for the tape library and its drives, so dumps,
+verifies and restores can be run (and timed) on a machine without one:
+
+    root/library.json   slots, drives and pending faults of the library
+    root/tapes/LABEL/   one FileTapeDevice directory per tape (see paper_tape)
+    root/drives/nstN    symlink to the directory of the tape loaded in drive N
+    root/bin/mtx        fake mtx answering status, load and unload from library.json
+
+Drives open root/drives/nst{} (see attach()) natively through open_tape(), so
+no fake mt, dd or tar is needed. Each robot move takes move_seconds, and a
+tape loaded in a drive gets a settings file limiting it to the drive's
+mb_per_second and the tape's capacity_mb.
+
+   Faults are injected with add_fault(): a load or unload of a label can fail
+a number of times, and reads or writes of a label can fail with EIO past a
+byte of the tape.
+
+   To run a dump against the library (the databases and the /papertape
+working directories are still needed):
+
+    library = SimLibrary('/tmp/library')
+    library.create(['PAPR1001', 'PAPR2001'])
+    library.activate()              ## put the fake mtx first on the PATH
+    dump = DumpFaster(...)
+    library.attach(dump.tape)       ## point the Changer's drives at the library
+    dump.fast_batch()
+"""
+
+import fcntl
+import json
+import os
+import sys
+import time
+
+from contextlib import contextmanager
+
+## mtx status lines read by paper_mtx.split_mtx_output()
+status_header = '  Storage Changer /dev/changer:{} Drives, {} Slots ( 0 Import/Export )'
+drive_empty_line = 'Data Transfer Element {}:Empty'
+drive_full_line = 'Data Transfer Element {}:Full (Storage Element {} Loaded):VolumeTag = {}'
+slot_empty_line = '      Storage Element {}:Empty'
+slot_full_line = '      Storage Element {}:Full :VolumeTag={}'
+
+
+class SimLibrary(object):
+    """a tape library made of directories"""
+
+    def __init__(self, root, drives=2, move_seconds=0.0, drive_mb_per_second=None, tape_capacity_mb=None):
+        """describe the library; create() builds it
+        :type root: str
+        :param root: directory holding the library
+        :type drives: int
+        :type move_seconds: float
+        :param move_seconds: time the robot takes to load or unload a tape
+        :type drive_mb_per_second: float
+        :param drive_mb_per_second: read and write rate of the drives (None for as fast as the disk)
+        :type tape_capacity_mb: float
+        :param tape_capacity_mb: bytes a tape holds, in MB (None for no limit)
+        """
+        self.root = os.path.abspath(root)
+        self.drives = drives
+        self.move_seconds = move_seconds
+        self.drive_mb_per_second = drive_mb_per_second
+        self.tape_capacity_mb = tape_capacity_mb
+
+        self.state_path = os.path.join(self.root, 'library.json')
+        self.bin_dir = os.path.join(self.root, 'bin')
+        self.device_format = os.path.join(self.root, 'drives', 'nst{}')
+
+    def tape_dir(self, label):
+        """directory of a tape"""
+        return os.path.join(self.root, 'tapes', label)
+
+    @contextmanager
+    def state(self):
+        """lock, read and (on the way out) save the library state"""
+        with open(os.path.join(self.root, 'library.lock'), mode='w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            with open(self.state_path, mode='r') as state_file:
+                library_state = json.load(state_file)
+            yield library_state
+            with open(self.state_path + '.new', mode='w') as state_file:
+                json.dump(library_state, state_file, indent=1, sort_keys=True)
+            os.rename(self.state_path + '.new', self.state_path)
+
+    def create(self, labels, slots=None):
+        """build an empty library with the given tapes in slots 1, 2, ...
+
+        :param slots: number of slots (at least one per tape)
+        """
+        slots = len(labels) if slots is None else max(slots, len(labels))
+        for sub_dir in ('tapes', 'drives', 'bin'):
+            os.makedirs(os.path.join(self.root, sub_dir), exist_ok=True)
+        for label in labels:
+            os.makedirs(self.tape_dir(label), exist_ok=True)
+
+        library_state = {
+            'settings': {
+                'move_seconds': self.move_seconds,
+                'drive_mb_per_second': self.drive_mb_per_second,
+                'tape_capacity_mb': self.tape_capacity_mb,
+            },
+            'slots': dict((str(slot), labels[slot - 1] if slot <= len(labels) else None) for slot in range(1, slots + 1)),
+            'drives': dict((str(drive), None) for drive in range(self.drives)),
+            'faults': [],
+        }
+        with open(self.state_path, mode='w') as state_file:
+            json.dump(library_state, state_file, indent=1, sort_keys=True)
+
+        self.install()
+
+    def install(self):
+        """write the fake mtx"""
+        mtx_path = os.path.join(self.bin_dir, 'mtx')
+        with open(mtx_path, mode='w') as mtx_file:
+            mtx_file.write('#!/bin/sh\nexec "{}" "{}" "{}" mtx "$@"\n'.format(sys.executable, os.path.abspath(__file__), self.root))
+        os.chmod(mtx_path, 0o755)
+
+    def activate(self):
+        """put the fake mtx first on the PATH of this process (and its children)"""
+        os.environ['PATH'] = os.pathsep.join([self.bin_dir, os.environ.get('PATH', '')])
+
+    def attach(self, changer):
+        """point a Changer (and its Drives and RamTar) at the library drives"""
+        changer.tape_drives.device_format = self.device_format
+        if hasattr(changer, 'ramtar'):
+            changer.ramtar.device_format = self.device_format
+        changer.check_inventory(refresh=True)
+
+    def add_fault(self, operation, label, count=1, offset=None):
+        """inject a fault
+
+        :param operation: 'load' or 'unload' fail count times; 'read' or 'write' fail past byte offset of the tape
+        """
+        with self.state() as library_state:
+            library_state['faults'].append({'operation': operation, 'label': label, 'count': count, 'offset': offset})
+
+    def take_fault(self, library_state, operation, label):
+        """use up a load or unload fault, return true if the move should fail"""
+        for fault in library_state['faults']:
+            if fault['operation'] == operation and fault['label'] == label and fault['count'] > 0:
+                fault['count'] -= 1
+                return True
+        return False
+
+    def status(self):
+        """mtx status output"""
+        with self.state() as library_state:
+            lines = [status_header.format(len(library_state['drives']), len(library_state['slots']))]
+            for drive in sorted(library_state['drives'], key=int):
+                loaded = library_state['drives'][drive]
+                lines.append(drive_empty_line.format(drive) if loaded is None else drive_full_line.format(drive, loaded[1], loaded[0]))
+            for slot in sorted(library_state['slots'], key=int):
+                label = library_state['slots'][slot]
+                lines.append(slot_empty_line.format(slot) if label is None else slot_full_line.format(slot, label))
+        return '\n'.join(lines) + '\n'
+
+    def tape_settings(self, library_state, label):
+        """the FileTapeDevice settings of a loaded tape"""
+        settings = library_state['settings']
+        tape_settings = {}
+        if settings['drive_mb_per_second']:
+            tape_settings['mb_per_second'] = settings['drive_mb_per_second']
+        if settings['tape_capacity_mb']:
+            tape_settings['capacity_bytes'] = int(settings['tape_capacity_mb'] * 1000 * 1000)
+        for fault in library_state['faults']:
+            if fault['label'] == label and fault['operation'] in ('read', 'write'):
+                tape_settings['{}_error_offset'.format(fault['operation'])] = fault['offset']
+        return tape_settings
+
+    def load(self, slot, drive):
+        """move a tape from a slot to a drive
+
+        :rtype: str error message, or None
+        """
+        with self.state() as library_state:
+            label = library_state['slots'].get(slot)
+            if label is None:
+                return 'Source Element Address {} is Empty'.format(slot)
+            if drive not in library_state['drives']:
+                return 'Invalid Data Transfer Element {}'.format(drive)
+            if library_state['drives'][drive] is not None:
+                return 'Drive {} Full (Storage Element {} Loaded)'.format(drive, library_state['drives'][drive][1])
+            if self.take_fault(library_state, 'load', label):
+                return 'Load of {} failed (injected fault)'.format(label)
+
+            time.sleep(library_state['settings']['move_seconds'])
+            library_state['slots'][slot] = None
+            library_state['drives'][drive] = [label, slot]
+
+            ## a freshly loaded tape is at the beginning
+            tape_dir = self.tape_dir(label)
+            with open(os.path.join(tape_dir, 'position'), mode='w') as position_file:
+                position_file.write('0 0\n')
+            with open(os.path.join(tape_dir, 'settings'), mode='w') as settings_file:
+                json.dump(self.tape_settings(library_state, label), settings_file)
+
+            drive_path = self.device_format.format(drive)
+            if os.path.lexists(drive_path):
+                os.remove(drive_path)
+            os.symlink(tape_dir, drive_path)
+
+        return None
+
+    def unload(self, slot, drive):
+        """move a tape from a drive back to a slot
+
+        :rtype: str error message, or None
+        """
+        with self.state() as library_state:
+            loaded = library_state['drives'].get(drive)
+            if loaded is None:
+                return 'Data Transfer Element {} is Empty'.format(drive)
+            if library_state['slots'].get(slot) is not None:
+                return 'Storage Element {} is Already Full'.format(slot)
+            if self.take_fault(library_state, 'unload', loaded[0]):
+                return 'Unload of {} failed (injected fault)'.format(loaded[0])
+
+            time.sleep(library_state['settings']['move_seconds'])
+            drive_path = self.device_format.format(drive)
+            if os.path.lexists(drive_path):
+                os.remove(drive_path)
+            library_state['drives'][drive] = None
+            library_state['slots'][slot] = loaded[0]
+
+        return None
+
+
+def mtx(root, arguments):
+    """run a fake mtx command against the library in root
+
+    :rtype: int exit status
+    """
+    library = SimLibrary(root)
+    if arguments[:1] == ['status']:
+        sys.stdout.write(library.status())
+        return 0
+
+    if len(arguments) >= 2 and arguments[0] in ('load', 'unload'):
+        slot = arguments[1]
+        drive = arguments[2] if len(arguments) > 2 else '0'
+        error = library.load(slot, drive) if arguments[0] == 'load' else library.unload(slot, drive)
+        if error is not None:
+            sys.stderr.write('mtx: {}\n'.format(error))
+            return 1
+        return 0
+
+    sys.stderr.write('usage: mtx status | load slot [drive] | unload slot [drive]\n')
+    return 1
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[2] == 'mtx':
+        sys.exit(mtx(sys.argv[1], sys.argv[3:]))
+    sys.stderr.write('usage: paper_sim.py root mtx arguments...\n')
+    sys.exit(1)
@@ -29,4 +29,8 @@ class StatusCode(Enum):
     claim_files_sql_commit = 19
     unclaim_files_sql_build = 20
     unclaim_files_sql_commit = 21
+    claim_lost = 22
+    write_positions = 23
+    log_positions_mysql = 24
+    update_catalog_index = 25
     UNKNOWN = 9999
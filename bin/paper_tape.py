@@ -0,0 +1,432 @@
+"""Native tape device access
+
+    TapeDevice: position and read a tape drive with MTIOCTOP/MTIOCPOS ioctls
+    FileTapeDevice: file-backed stand-in for a tape drive, for testing without hardware
+
+   Both behave like a non-rewinding st device (/dev/nstN): a tape is a sequence
+of tape files separated by filemarks, a read returns one block, and a read at a
+filemark returns nothing and moves past it. open_tape() returns a
+FileTapeDevice when the device path is a directory, so any code that opens
+drives through it can run against a directory of tape files.
+"""
+
+import bisect
+import errno
+import fcntl
+import json
+import os
+import struct
+import time
+
+from paper_debug import Debug
+
+## non-rewinding tape devices by drive_int
+tape_device_format = '/dev/nst{}'
+
+## struct mtop {short mt_op; int mt_count;} and struct mtpos {long mt_blkno;} from linux/mtio.h
+mtop_format = 'hi'
+mtpos_format = 'l'
+
+
+def _ioc(direction, number, size):
+    """linux _IOC() for the 'm' (magnetic tape) ioctls"""
+    return (direction << 30) | (size << 16) | (ord('m') << 8) | number
+
+
+MTIOCTOP = _ioc(1, 1, struct.calcsize(mtop_format))  ## _IOW('m', 1, struct mtop)
+MTIOCPOS = _ioc(2, 3, struct.calcsize(mtpos_format)) ## _IOR('m', 3, struct mtpos)
+
+## mt_op codes
+MTFSF = 1     ## forward space over filemarks
+MTBSF = 2     ## backward space over filemarks
+MTWEOF = 5    ## write filemarks
+MTREW = 6     ## rewind
+MTEOM = 12    ## go to the end of recorded data
+MTSEEK = 22   ## seek to a block
+
+
+def open_tape(pid, device_path, mode='rb', block_size=32 * 1024, debug=False, debug_threshold=255):
+    """open a tape drive, or a FileTapeDevice if device_path is a directory"""
+    tape_class = FileTapeDevice if os.path.isdir(device_path) else TapeDevice
+    return tape_class(pid, device_path, mode=mode, block_size=block_size, debug=debug, debug_threshold=debug_threshold)
+
+
+class TapeDevice(object):
+    """a non-rewinding tape device driven with ioctls"""
+
+    def __init__(self, pid, device_path, mode='rb', block_size=32 * 1024, debug=False, debug_threshold=255):
+        """open the device
+        :type device_path: str
+        :param device_path: non-rewinding tape device (/dev/nstN)
+        :type mode: str
+        :param mode: 'rb' to read and position, 'wb' to write
+        :type block_size: int
+        :param block_size: bytes requested by each read_block()
+        """
+        self.pid = pid
+        self.debug = Debug(self.pid, debug=debug, debug_threshold=debug_threshold)
+
+        self.device_path = device_path
+        self.block_size = block_size
+        self.fd = os.open(device_path, os.O_WRONLY if 'w' in mode else os.O_RDONLY)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def mt(self, mt_op, count=1):
+        """run an MTIOCTOP operation"""
+        self.debug.output('{} op={} count={}'.format(self.device_path, mt_op, count), debug_level=250)
+        fcntl.ioctl(self.fd, MTIOCTOP, struct.pack(mtop_format, mt_op, count))
+
+    def rewind(self):
+        """rewind to the start of the tape"""
+        self.mt(MTREW)
+
+    def fsf(self, count=1):
+        """move forward past count filemarks, to the start of a later tape file"""
+        self.mt(MTFSF, count)
+
+    def bsf(self, count=1):
+        """move backward past count filemarks, to the end of an earlier tape file"""
+        self.mt(MTBSF, count)
+
+    def eom(self):
+        """move to the end of recorded data"""
+        self.mt(MTEOM)
+
+    def weof(self, count=1):
+        """write count filemarks"""
+        self.mt(MTWEOF, count)
+
+    def tell(self):
+        """return the current block number"""
+        position = fcntl.ioctl(self.fd, MTIOCPOS, struct.pack(mtpos_format, 0))
+        return struct.unpack(mtpos_format, position)[0]
+
+    def seek(self, block_number):
+        """move to the given block number"""
+        self.mt(MTSEEK, block_number)
+
+    def read_block(self):
+        """read one block; an empty result means a filemark was passed"""
+        return os.read(self.fd, self.block_size)
+
+    def write_block(self, data):
+        """write data as one block"""
+        return os.write(self.fd, data)
+
+    def read_file(self):
+        """generator of the blocks up to the next filemark"""
+        while True:
+            block = self.read_block()
+            if not block:
+                return
+            yield block
+
+    def count_files(self):
+        """count the tape files from the current position to the end of data"""
+        count = 0
+        while True:
+            try:
+                self.fsf(1)
+            except OSError:
+                break
+            count += 1
+        return count
+
+    def close(self):
+        """close the device; after a write the driver ends the tape file with a filemark"""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class FileTapeDevice(TapeDevice):
+    """a directory of tape files that behaves like a tape drive
+
+    The tape files are device_path/file.0, file.1, ... and the position is kept
+    in device_path/position, so it survives close() and open like a real tape.
+    The size of every block written to file.N is kept in file.N.blocks, so a
+    read returns one written block (failing with ENOMEM if it is larger than
+    block_size, like st in variable block mode), and block numbers count the
+    blocks written to earlier files plus one per filemark, as on LTO drives.
+
+    An optional device_path/settings json file makes the stand-in behave more
+    like a real drive and medium (see paper_sim):
+        mb_per_second: reads and writes are slowed down to this rate
+        capacity_bytes: writes past this byte of the tape fail with ENOSPC (end of medium)
+        write_error_offset: writes past this byte of the tape fail with EIO
+        read_error_offset: reads past this byte of the tape fail with EIO
+    """
+
+    def __init__(self, pid, device_path, mode='rb', block_size=32 * 1024, debug=False, debug_threshold=255):
+        """open the stand-in"""
+        self.pid = pid
+        self.debug = Debug(self.pid, debug=debug, debug_threshold=debug_threshold)
+
+        self.device_path = device_path
+        self.block_size = block_size
+        self.mode = mode
+        self.fd = None
+        self.written = False
+        self.file_number, self.offset = self.load_position()
+        self.settings = self.load_settings()
+        self.tape_offset = None ## byte of the tape at the position, kept while writing
+        self.block_ends = {}    ## end offsets of the blocks of each tape file, by file_number
+
+    def load_settings(self):
+        """read the optional drive and medium settings"""
+        try:
+            with open(os.path.join(self.device_path, 'settings'), mode='r') as settings_file:
+                return json.load(settings_file)
+        except (OSError, ValueError):
+            return {}
+
+    def file_start(self, file_number):
+        """byte of the tape where a tape file starts"""
+        return sum(os.path.getsize(self.file_path(earlier_file)) for earlier_file in range(file_number))
+
+    def throttle(self, size):
+        """take as long as the drive would to move size bytes"""
+        mb_per_second = self.settings.get('mb_per_second')
+        if mb_per_second:
+            time.sleep(size / (mb_per_second * 1000.0 * 1000.0))
+
+    def check_offset(self, end_offset, limit_name, error_number):
+        """fail like the drive would if the tape has a limit before end_offset"""
+        limit = self.settings.get(limit_name)
+        if limit is not None and end_offset > limit:
+            raise OSError(error_number, '{} ({} {})'.format(os.strerror(error_number), limit_name, limit), self.device_path)
+
+    def file_path(self, file_number):
+        """path of a tape file"""
+        return os.path.join(self.device_path, 'file.{}'.format(file_number))
+
+    def file_count(self):
+        """number of tape files written"""
+        file_number = 0
+        while os.path.exists(self.file_path(file_number)):
+            file_number += 1
+        return file_number
+
+    def blocks_path(self, file_number):
+        """path of the block sizes of a tape file"""
+        return self.file_path(file_number) + '.blocks'
+
+    def file_block_ends(self, file_number):
+        """end offsets of the blocks written to a tape file
+
+        :rtype: list of int
+        """
+        if file_number not in self.block_ends:
+            try:
+                with open(self.blocks_path(file_number), mode='r') as blocks_file:
+                    block_sizes = [int(line) for line in blocks_file]
+            except OSError:
+                ## a tape file without block sizes is read in blocks of block_size
+                file_size = os.path.getsize(self.file_path(file_number))
+                block_sizes = [min(self.block_size, file_size - offset) for offset in range(0, file_size, self.block_size)]
+
+            offset = 0
+            block_ends = []
+            for block_size in block_sizes:
+                offset += block_size
+                block_ends.append(offset)
+            self.block_ends[file_number] = block_ends
+        return self.block_ends[file_number]
+
+    def file_blocks(self, file_number):
+        """number of blocks in a tape file"""
+        return len(self.file_block_ends(file_number))
+
+    def load_position(self):
+        """read the saved (file_number, offset)"""
+        try:
+            with open(os.path.join(self.device_path, 'position'), mode='r') as position_file:
+                file_number, offset = position_file.read().split()
+                return int(file_number), int(offset)
+        except (OSError, ValueError):
+            return 0, 0
+
+    def save_position(self):
+        """remember the position for the next open"""
+        with open(os.path.join(self.device_path, 'position'), mode='w') as position_file:
+            position_file.write('{} {}\n'.format(self.file_number, self.offset))
+
+    def mt(self, mt_op, count=1):
+        """emulate an MTIOCTOP operation"""
+        self.debug.output('{} op={} count={}'.format(self.device_path, mt_op, count), debug_level=250)
+        file_count = self.file_count()
+
+        if mt_op == MTREW:
+            self.file_number, self.offset = 0, 0
+        elif mt_op == MTFSF:
+            if self.file_number + count > file_count:
+                self.file_number, self.offset = file_count, 0
+                self.save_position()
+                raise OSError(5, 'Input/output error (end of data)', self.device_path)
+            self.file_number, self.offset = self.file_number + count, 0
+        elif mt_op == MTBSF:
+            if self.file_number - count < 0:
+                self.file_number, self.offset = 0, 0
+                self.save_position()
+                raise OSError(5, 'Input/output error (beginning of tape)', self.device_path)
+            ## like st, stop on the tape side of the filemark: the end of the earlier file
+            self.file_number -= count
+            block_ends = self.file_block_ends(self.file_number)
+            self.offset = block_ends[-1] if block_ends else 0
+        elif mt_op == MTEOM:
+            self.file_number, self.offset = file_count, 0
+        elif mt_op == MTWEOF:
+            for _ in range(count):
+                open(self.file_path(self.file_number), mode='ab').close()
+                open(self.blocks_path(self.file_number), mode='a').close()
+                self.block_ends.pop(self.file_number, None)
+                self.file_number, self.offset = self.file_number + 1, 0
+        elif mt_op == MTSEEK:
+            self.file_number, self.offset = self.block_position(count)
+        else:
+            raise OSError(22, 'Invalid argument', self.device_path)
+
+        self.save_position()
+
+    def block_position(self, block_number):
+        """(file_number, offset) of a block number"""
+        for file_number in range(self.file_count()):
+            blocks = self.file_blocks(file_number)
+            if block_number <= blocks:
+                return file_number, self.file_block_ends(file_number)[block_number - 1] if block_number else 0
+            block_number -= blocks + 1
+        return self.file_count(), 0
+
+    def tell(self):
+        """return the current block number"""
+        earlier_blocks = sum(self.file_blocks(file_number) + 1 for file_number in range(self.file_number))
+        if self.file_number >= self.file_count():
+            return earlier_blocks
+        return earlier_blocks + bisect.bisect_right(self.file_block_ends(self.file_number), self.offset)
+
+    def read_block(self):
+        """read one block; an empty result means a filemark was passed"""
+        if self.file_number >= self.file_count():
+            raise OSError(5, 'Input/output error (end of data)', self.device_path)
+
+        block_ends = self.file_block_ends(self.file_number)
+        block_index = bisect.bisect_right(block_ends, self.offset)
+        block_length = block_ends[block_index] - self.offset if block_index < len(block_ends) else 0
+        if block_length > self.block_size:
+            raise OSError(errno.ENOMEM, '{} (block of {} bytes)'.format(os.strerror(errno.ENOMEM), block_length), self.device_path)
+
+        with open(self.file_path(self.file_number), mode='rb') as tape_file:
+            tape_file.seek(self.offset)
+            block = tape_file.read(block_length)
+
+        if block and 'read_error_offset' in self.settings:
+            self.check_offset(self.file_start(self.file_number) + self.offset + len(block), 'read_error_offset', errno.EIO)
+        self.throttle(len(block))
+
+        if block:
+            self.offset += len(block)
+        else:
+            self.file_number, self.offset = self.file_number + 1, 0
+        self.save_position()
+        return block
+
+    def write_block(self, data):
+        """write data as one block; the first write replaces the tape from here on"""
+        if not self.written:
+            ## like a tape, writing ends the recorded data at the current position
+            for file_number in range(self.file_number + 1, self.file_count()):
+                os.remove(self.file_path(file_number))
+                if os.path.exists(self.blocks_path(file_number)):
+                    os.remove(self.blocks_path(file_number))
+                self.block_ends.pop(file_number, None)
+            with open(self.file_path(self.file_number), mode='ab') as tape_file:
+                tape_file.truncate(self.offset)
+            block_ends = [block_end for block_end in self.file_block_ends(self.file_number) if block_end <= self.offset]
+            with open(self.blocks_path(self.file_number), mode='w') as blocks_file:
+                blocks_file.writelines('{}\n'.format(block_end - block_start)
+                                       for block_start, block_end in zip([0] + block_ends, block_ends))
+            self.block_ends[self.file_number] = block_ends
+            self.written = True
+            self.tape_offset = self.file_start(self.file_number) + self.offset
+
+        self.check_offset(self.tape_offset + len(data), 'capacity_bytes', errno.ENOSPC)
+        self.check_offset(self.tape_offset + len(data), 'write_error_offset', errno.EIO)
+        self.throttle(len(data))
+
+        with open(self.file_path(self.file_number), mode='ab') as tape_file:
+            tape_file.write(data)
+        with open(self.blocks_path(self.file_number), mode='a') as blocks_file:
+            blocks_file.write('{}\n'.format(len(data)))
+        self.offset += len(data)
+        self.block_ends[self.file_number].append(self.offset)
+        self.tape_offset += len(data)
+        self.save_position()
+        return len(data)
+
+    def close(self):
+        """after a write, end the tape file with a filemark"""
+        if self.written:
+            self.file_number, self.offset = self.file_number + 1, 0
+            self.written = False
+            self.save_position()
+
+
+class TapeFileReader(object):
+    """file object reading a tape file block by block, for tarfile stream mode"""
+
+    def __init__(self, tape):
+        """read from the current position of an open TapeDevice"""
+        self.tape = tape
+        self.buffer = b''
+        self.at_filemark = False
+
+    def empty(self):
+        """return true if the tape file has no data (end of recorded data)"""
+        if not self.buffer and not self.at_filemark:
+            try:
+                block = self.tape.read_block()
+            except OSError:
+                block = b''
+            if block:
+                self.buffer = block
+            else:
+                self.at_filemark = True
+        return not self.buffer
+
+    def skip(self):
+        """read to the end of the tape file, leaving the tape at the start of the next one"""
+        self.buffer = b''
+        while not self.at_filemark:
+            if not self.tape.read_block():
+                self.at_filemark = True
+
+    def read(self, size=-1):
+        """return up to size bytes of the current tape file"""
+        while not self.at_filemark and (size < 0 or len(self.buffer) < size):
+            block = self.tape.read_block()
+            if not block:
+                self.at_filemark = True
+                break
+            self.buffer += block
+
+        if size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def tape_files(tape):
+    """generator of a TapeFileReader for each tape file from the current position to
+    the end of recorded data, reading the tape once in order"""
+    while True:
+        reader = TapeFileReader(tape)
+        if reader.empty():
+            return
+        yield reader
+        reader.skip()
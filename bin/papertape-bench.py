@@ -0,0 +1,22 @@
+"""time a dump of synthetic data to a simulated library; append the results to the given file
+and compare them with the last run of the results file"""
+
+from sys import argv, exit
+
+from paper_dump import __version__
+from paper_bench import DumpBench, read_results, compare_results
+
+results_file = argv[1] if len(argv) > 1 else '/papertape/bench/paper.bench.jsonl'
+
+x = DumpBench(__version__, files=16, file_mb=256, batch_mb=1024, verify_mode='sample', debug=True, debug_threshold=128)
+bench_status = x.run(results_file)
+
+runs = read_results(results_file)
+for stage in runs[-1]['stages']:
+    print('{stage:20s} {seconds:10.2f}s {mb:10.1f} MB'.format(**stage))
+if len(runs) > 1:
+    print('version {} against {}:'.format(runs[-1]['version'], runs[-2]['version']))
+    for stage, ratio in sorted(compare_results(runs[-2], runs[-1]).items()):
+        print('{:20s} {:10.2f}x'.format(stage, ratio))
+
+exit(bench_status.value)
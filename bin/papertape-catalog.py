@@ -0,0 +1,24 @@
+"""build the local tape catalog index from the tape_index values already in paperdata.File
+
+run once before the first restore; later dumps add their own files to the index"""
+
+import os
+from random import randint
+from sys import argv, exit
+
+from paper_dump import __version__
+from paper_db import PaperDB
+from paper_catalog import CatalogIndex
+
+credentials = argv[1] if len(argv) > 1 else '/home2/obs/.my.papertape-prod.cnf'
+catalog_db = argv[2] if len(argv) > 2 else '/papertape/catalog/paper.catalog.sqlite'
+pid = "%0.6d%0.3d" % (os.getpid(), randint(1, 999))
+
+x = PaperDB(__version__, credentials, pid, debug=True, debug_threshold=128)
+catalog = CatalogIndex(pid, catalog_db=catalog_db, debug=True, debug_threshold=128)
+location_count = catalog.add_file_rows(x.tape_index_rows())
+catalog.close_catalog()
+x.db_release()
+
+print('indexed {} locations in {}'.format(location_count, catalog_db))
+exit(0 if location_count else 1)
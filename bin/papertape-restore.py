@@ -0,0 +1,13 @@
+"""restore the sources listed (one per line) in the given file from tape"""
+
+from sys import argv, exit
+
+from paper_dump import __version__
+from paper_restore import Restore
+
+x = Restore(__version__, destination='/papertape/restore', drive_select=2, debug=True, debug_threshold=128)
+with open(argv[1], mode='r') as source_file:
+    sources = [line.strip() for line in source_file if line.strip()]
+restore_status = x.restore(sources)
+x.close_restore()
+exit(restore_status.value)
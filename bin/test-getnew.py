@@ -12,6 +12,7 @@ x = PaperDB('201611',  cred, 1, debug=False)
 ## print size in MB
 #print(b)
 
+## print the file count and size in MB of each base path
 b = x.enumerate_paths()
 for path in b:
-    print(path,b[path])
+    print(path, *b[path])
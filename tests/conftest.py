@@ -0,0 +1,20 @@
+"""pytest setup: the modules in bin import each other by name"""
+
+import os
+import sys
+
+import pytest
+
+bin_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bin')
+sys.path.insert(0, bin_dir)
+
+from paper_sim import SimLibrary
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    """a two drive SimLibrary holding PAPR1001 and PAPR2001, with its fake mtx on the PATH"""
+    sim_library = SimLibrary(str(tmp_path / 'library'))
+    sim_library.create(['PAPR1001', 'PAPR2001'], slots=4)
+    monkeypatch.setenv('PATH', os.pathsep.join([sim_library.bin_dir, os.environ.get('PATH', '')]))
+    return sim_library
@@ -0,0 +1,80 @@
+"""positions files, tape_index strings and the sqlite CatalogIndex"""
+
+from paper_catalog import positions_lines, parse_positions, parse_tape_index, CatalogIndex
+
+catalog_lines = [
+    '## Paper dump catalog:123456001 (version: 20150103 on 20161016-1200)',
+    '## This tape contains files as listed below:',
+    '## item_index:tape_index:archive_index:md5sum:data_path',
+    '1:1:0:0123456789abcdef0123456789abcdef:host:/data/zen.2456000.10000.uv',
+    '2:1:1:11111111111111111111111111111111:host:/data/zen.2456000.10139.uv',
+    '3:2:0:22222222222222222222222222222222:host:/data/zen.2456001.10000.uv',
+]
+
+
+def test_positions_round_trip():
+    positions = {2: (2, 206, 409), 1: (1, 2, 205), 10: (10, 1900, 1950)}
+    lines = positions_lines('123456001', positions, 10240)
+
+    assert lines[0] == '## Paper dump positions:123456001 (block size: 10240)'
+    assert [line.split(':')[0] for line in lines[3:]] == ['1', '2', '10']
+    assert parse_positions(lines) == ('123456001', 10240, positions)
+
+
+def test_parse_positions_rejects_other_files():
+    assert parse_positions([]) is None
+    assert parse_positions(catalog_lines) is None
+    assert parse_positions(['\x00\x01 binary']) is None
+
+
+def test_parse_tape_index():
+    assert parse_tape_index('20150103[PAPR1007,PAPR2007]-3:12') == {
+        'version': 20150103, 'labels': ['PAPR1007', 'PAPR2007'], 'tape_index': 3, 'archive_index': 12}
+    assert parse_tape_index('1123456001') is None
+    assert parse_tape_index(None) is None
+
+
+def test_catalog_index_add_catalog(tmp_path):
+    catalog = CatalogIndex('test', catalog_db=str(tmp_path / 'catalog' / 'paper.catalog.sqlite'))
+    assert catalog.add_catalog(catalog_lines, ['PAPR1007', 'PAPR2007']) == 6
+
+    copies = catalog.locate('host:/data/zen.2456000.10139.uv')
+    assert [copy['label'] for copy in copies] == ['PAPR1007', 'PAPR2007']
+    assert copies[0]['tape_index'] == 1
+    assert copies[0]['archive_index'] == 1
+    assert copies[0]['version'] == 20150103
+    assert copies[0]['dump_pid'] == '123456001'
+
+    assert len(catalog.by_night(2456000)) == 4
+    assert len(catalog.by_night(2456000, 2456001)) == 6
+    assert [copy['source'] for copy in catalog.by_md5('22222222222222222222222222222222')] == ['host:/data/zen.2456001.10000.uv'] * 2
+    assert len(catalog.by_label('PAPR1007')) == 3
+    assert len(catalog.by_label('PAPR1007', tape_index=2)) == 1
+
+    ## a second dump of the same file to the same tape replaces the row
+    catalog.add_catalog(catalog_lines[:1] + catalog_lines[5:], ['PAPR1007'])
+    assert len(catalog.by_label('PAPR1007')) == 3
+    catalog.close_catalog()
+
+
+def test_catalog_index_add_file_rows_skips_claims(tmp_path):
+    catalog = CatalogIndex('test', catalog_db=str(tmp_path / 'paper.catalog.sqlite'))
+    file_rows = [
+        ('host:/data/zen.2456000.10000.uv', 1, 'a' * 32, '20150103[PAPR1007,PAPR2007]-1:0'),
+        ('host:/data/zen.2456000.10139.uv', 2, 'b' * 32, '1123456001'),
+        ('host:/data/zen.2456000.10278.uv', 3, 'c' * 32, None),
+    ]
+    assert catalog.add_file_rows(file_rows) == 2
+
+    assert [copy['obsnum'] for copy in catalog.by_obsnum(1, 3)] == [1, 1]
+    catalog.close_catalog()
+
+
+def test_catalog_index_positions(tmp_path):
+    catalog = CatalogIndex('test', catalog_db=str(tmp_path / 'paper.catalog.sqlite'))
+    catalog.add_positions('PAPR1007', {1: (1, 2, 205), 2: (2, 206, 409)}, 10240, dump_pid='123456001')
+
+    assert catalog.position('PAPR1007', 2) == {'tape_file': 2, 'start_block': 206, 'end_block': 409, 'block_size': 10240}
+    assert catalog.position('PAPR1007', 3) is None
+    assert catalog.position('PAPR2007', 1) is None
+    catalog.close_catalog()
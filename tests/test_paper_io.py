@@ -0,0 +1,269 @@
+"""staging, hashing, tar sizing and the ring buffer"""
+
+import errno
+import hashlib
+import io
+import os
+import tarfile
+import threading
+import time
+
+import pytest
+
+from paper_io import Stager, CopySelector, copy_buffered, copy_hardlink, md5_file, md5_files, add_hashed, tar_stream_size, RingBuffer, ParallelHasher
+
+
+def make_zen(zen_path, sizes):
+    """a directory of files of the given sizes by name"""
+    os.makedirs(zen_path)
+    for file_name, size in sizes.items():
+        with open(os.path.join(zen_path, file_name), mode='wb') as zen_file:
+            zen_file.write(os.urandom(size))
+    return zen_path
+
+
+@pytest.fixture
+def stage_dir(tmp_path):
+    tmp_path.joinpath('stage').mkdir()
+    return str(tmp_path / 'stage')
+
+
+def test_stager_copies_a_batch(tmp_path, stage_dir):
+    copy_list = [(make_zen(str(tmp_path / 'source' / 'zen.2456000.{}.uv'.format(obsid)), {'visdata': 50000, 'flags': 1000}),
+                  os.path.join(stage_dir, 'zen.2456000.{}.uv'.format(obsid))) for obsid in (10000, 10139, 10278)]
+    stager = Stager('test', workers=2, budget_mb=1)
+    stage_report = stager.stage(copy_list, stage_dir)
+
+    assert sorted(file_report[0] for file_report in stage_report['files']) == [destination_path for source_path, destination_path in copy_list]
+    assert stage_report['mb'] == pytest.approx(3 * 51000 / 1000 / 1000)
+    for source_path, destination_path in copy_list:
+        with open(os.path.join(source_path, 'visdata'), mode='rb') as source_file, \
+                open(os.path.join(destination_path, 'visdata'), mode='rb') as destination_file:
+            assert source_file.read() == destination_file.read()
+
+    ## staged bytes count against the budget until they are released
+    assert sum(stager.staged_bytes.values()) == 3 * 51000
+    for source_path, destination_path in copy_list:
+        stager.release(destination_path)
+    assert stager.staged_bytes == {}
+
+
+def test_stager_fails_a_file_larger_than_the_budget(tmp_path, stage_dir):
+    source_path = make_zen(str(tmp_path / 'source' / 'zen.2456000.10000.uv'), {'visdata': 20000})
+    stager = Stager('test', budget_mb=0.01)
+
+    with pytest.raises(Exception, match='smaller than'):
+        stager.stage([(source_path, os.path.join(stage_dir, 'zen.2456000.10000.uv'))], stage_dir)
+    assert not os.path.exists(os.path.join(stage_dir, 'zen.2456000.10000.uv'))
+
+
+def test_md5_files_hashes_in_chunks(tmp_path):
+    file_paths = []
+    for size in (0, 1, 4095, 4096, 10000):
+        file_path = tmp_path / 'file.{}'.format(size)
+        file_path.write_bytes(os.urandom(size))
+        file_paths.append(str(file_path))
+
+    digests = md5_files(file_paths, workers=3, chunk_size=4096)
+
+    assert digests == dict((file_path, hashlib.md5(open(file_path, mode='rb').read()).hexdigest()) for file_path in file_paths)
+    assert md5_file(file_paths[-1], chunk_size=7) == digests[file_paths[-1]]
+
+
+def test_md5_files_fails_on_a_missing_file(tmp_path):
+    with pytest.raises(OSError):
+        md5_files([str(tmp_path / 'missing')])
+
+
+def test_add_hashed_hashes_visdata_while_archiving(tmp_path):
+    zen_path = make_zen(str(tmp_path / 'zen.2456000.10000.uv'), {'visdata': 70000, 'flags': 1093})
+
+    tar_bytes = io.BytesIO()
+    with tarfile.open(fileobj=tar_bytes, mode='w') as archive_tar:
+        digests = add_hashed(archive_tar, zen_path, 'paper.1.1/zen.2456000.10000.uv')
+
+    assert digests == {'visdata': md5_file(os.path.join(zen_path, 'visdata'))}
+
+    tar_bytes.seek(0)
+    with tarfile.open(fileobj=tar_bytes, mode='r') as archive_tar:
+        assert archive_tar.getnames() == ['paper.1.1/zen.2456000.10000.uv', 'paper.1.1/zen.2456000.10000.uv/flags',
+                                          'paper.1.1/zen.2456000.10000.uv/visdata']
+        visdata = archive_tar.extractfile('paper.1.1/zen.2456000.10000.uv/visdata').read()
+    assert hashlib.md5(visdata).hexdigest() == digests['visdata']
+
+
+def unsupported_copy(calls):
+    """a copy strategy that fails like a reflink across filesystems"""
+    def _copy(source_path, destination_path):
+        calls.append(source_path)
+        open(destination_path, mode='wb').close()
+        raise OSError(errno.EOPNOTSUPP, 'Operation not supported')
+    return _copy
+
+
+def test_copy_selector_remembers_the_first_strategy_that_works(tmp_path):
+    calls = []
+    selector = CopySelector('test')
+    selector.strategies = [('unsupported', unsupported_copy(calls), False), ('buffered', copy_buffered, False)]
+
+    for name in ('a', 'b'):
+        (tmp_path / name).write_bytes(os.urandom(5000))
+        selector.copy(str(tmp_path / name), str(tmp_path / (name + '.copy')))
+        assert (tmp_path / (name + '.copy')).read_bytes() == (tmp_path / name).read_bytes()
+
+    ## the unsupported strategy is tried once per mount, and its partial copy is removed first
+    assert calls == [str(tmp_path / 'a')]
+    assert list(selector.strategy_report().values()) == ['buffered']
+
+
+def test_copy_selector_raises_real_copy_errors(tmp_path):
+    selector = CopySelector('test', strategies=['buffered'])
+    (tmp_path / 'a').write_bytes(b'a')
+    (tmp_path / 'destination').mkdir()
+
+    with pytest.raises(OSError):
+        selector.copy(str(tmp_path / 'a'), str(tmp_path / 'destination'))
+    assert selector.strategy_report() == {}
+
+
+def test_copy_selector_links_only_inside_one_filesystem(tmp_path, monkeypatch):
+    selector = CopySelector('test', strategies=['hardlink', 'buffered'])
+    assert [strategy[1] for strategy in selector.strategies] == [copy_hardlink, copy_buffered]
+    (tmp_path / 'a').write_bytes(b'a')
+
+    selector.copy(str(tmp_path / 'a'), str(tmp_path / 'a.link'))
+    assert os.stat(str(tmp_path / 'a')).st_nlink == 2
+
+    ## another destination device never gets a link
+    monkeypatch.setattr(selector, 'mount_key', lambda source_path, destination_path: (1, 2))
+    selector.copy(str(tmp_path / 'a'), str(tmp_path / 'a.copy'))
+    assert os.stat(str(tmp_path / 'a.copy')).st_nlink == 1
+    assert selector.strategy_report()[(1, 2)] == 'buffered'
+
+
+def test_tar_stream_size_matches_written_tar(tmp_path):
+    members = [
+        (make_zen(str(tmp_path / 'zen.2456000.10000.uv'), {'visdata': 70000, 'flags': 1093, 'header': 0}), 'paper.1.1/zen.2456000.10000.uv'),
+        (make_zen(str(tmp_path / 'zen.2456000.10139.uv'), {'visdata': 10240, 'vartable': 47}), 'paper.1.1/' + 'x' * 120 + '/zen.2456000.10139.uv'),
+    ]
+
+    tar_bytes = io.BytesIO()
+    archive_tar = tarfile.open(fileobj=tar_bytes, mode='w')
+    for file_path, arcname in members:
+        add_hashed(archive_tar, file_path, arcname)
+    archive_tar.close()
+
+    assert tar_stream_size(members) == len(tar_bytes.getvalue())
+    assert tar_stream_size(members) % tarfile.RECORDSIZE == 0
+
+
+def test_ring_buffer_passes_a_stream_through_a_small_buffer():
+    data = os.urandom(1000003)
+    ring = RingBuffer(4096)
+
+    def _write():
+        for offset in range(0, len(data), 7777):
+            ring.write(data[offset:offset + 7777])
+        ring.close()
+
+    writer = threading.Thread(target=_write)
+    writer.start()
+    chunks = []
+    while True:
+        chunk = ring.read(3000)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    writer.join()
+
+    assert b''.join(chunks) == data
+    assert ring.bytes_written == len(data)
+
+
+def test_ring_buffer_abort_fails_a_blocked_writer():
+    ring = RingBuffer(16)
+    ring.write(b'x' * 16)
+    errors = []
+
+    def _write():
+        try:
+            ring.write(b'y')
+        except Exception as write_error:
+            errors.append(write_error)
+
+    writer = threading.Thread(target=_write)
+    writer.start()
+    time.sleep(0.05)
+    ring.abort('reader failed')
+    writer.join(timeout=5)
+
+    assert not writer.is_alive()
+    assert errors
+    with pytest.raises(Exception):
+        ring.read(1)
+
+
+def test_stager_reserves_a_batch_whole():
+    stager = Stager('test')
+    stager.reserve([('/stage/1/a', 300), ('/stage/1/b', 300)], 1000)
+
+    ## outside a pipeline a full budget fails at once, and reserves nothing
+    with pytest.raises(Exception, match='exceeded'):
+        stager.reserve([('/stage/2/a', 300), ('/stage/2/b', 300)], 1000)
+    assert sorted(stager.staged_bytes) == ['/stage/1/a', '/stage/1/b']
+
+    with pytest.raises(Exception, match='smaller than'):
+        stager.reserve([('/stage/2/a', 600), ('/stage/2/b', 600)], 1000, wait=True)
+
+
+def test_stager_batch_waits_for_release_without_holding_room():
+    stager = Stager('test')
+    stager.reserve([('/stage/1/a', 400), ('/stage/1/b', 400)], 1000)
+
+    waiter = threading.Thread(target=stager.reserve, args=([('/stage/2/a', 400), ('/stage/2/b', 400)], 1000), kwargs={'wait': True})
+    waiter.start()
+    time.sleep(0.05)
+    ## the waiting batch holds no part of the budget
+    assert sorted(stager.staged_bytes) == ['/stage/1/a', '/stage/1/b']
+
+    stager.release('/stage/1/a')
+    time.sleep(0.05)
+    assert waiter.is_alive()
+
+    stager.release('/stage/1/b')
+    waiter.join(timeout=5)
+    assert not waiter.is_alive()
+    assert stager.staged_bytes == {'/stage/2/a': 400, '/stage/2/b': 400}
+
+
+def test_stager_wait_times_out():
+    stager = Stager('test')
+    stager.reserve_timeout = 0.1
+    stager.reserve([('/stage/1/a', 600)], 1000)
+
+    with pytest.raises(Exception, match='no staging room'):
+        stager.reserve([('/stage/2/a', 600)], 1000, wait=True)
+    assert stager.staged_bytes == {'/stage/1/a': 600}
+
+
+def test_parallel_hasher_matches_md5():
+    streams = dict(('stream{}'.format(index), [os.urandom(1000 + index) for _ in range(20)]) for index in range(6))
+
+    with ParallelHasher(workers=3, queue_chunks=2) as hasher:
+        for chunk_index in range(20):
+            for key, chunks in streams.items():
+                hasher.update(key, chunks[chunk_index])
+        digests = hasher.close()
+
+    assert digests == dict((key, hashlib.md5(b''.join(chunks)).hexdigest()) for key, chunks in streams.items())
+    assert hasher.close() == digests
+    assert not any(worker.is_alive() for worker in hasher.workers)
+
+
+def test_parallel_hasher_stops_workers_on_error():
+    with pytest.raises(ValueError):
+        with ParallelHasher(workers=2) as hasher:
+            hasher.update('stream', b'data')
+            raise ValueError('read failed')
+
+    assert not any(worker.is_alive() for worker in hasher.workers)
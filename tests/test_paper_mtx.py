@@ -0,0 +1,296 @@
+"""Changer and Drives against a SimLibrary"""
+
+import hashlib
+import json
+import os
+import tarfile
+import threading
+import time
+from subprocess import CalledProcessError
+
+import pytest
+
+import paper_mtx
+from paper_mtx import Changer, Drives, FanOutWriter, RamTar, complete_positions, split_mtx_output, stratified_sample_size, add_positions
+
+pid = '123456001'
+
+
+def test_stratified_sample_size():
+    ## 59 files find one of 5% bad files 95% of the time
+    assert stratified_sample_size(1000) == 59
+    assert stratified_sample_size(1000, confidence=0.99, defect_rate=0.01) == 459
+    assert stratified_sample_size(10) == 10
+    assert stratified_sample_size(0) == 0
+    assert stratified_sample_size(1000, defect_rate=1) == 1
+
+
+def test_add_positions_numbers_tape_files_after_the_catalog():
+    archive_positions = {}
+    add_positions(archive_positions, '1', {0: (2, 205), 1: (2, 205)})
+    add_positions(archive_positions, '2', {0: (206, 409), 1: (206, 409)})
+
+    assert archive_positions[0] == {1: (1, 2, 205), 2: (2, 206, 409)}
+    assert archive_positions[1] == archive_positions[0]
+
+
+def test_split_mtx_output(library):
+    library.load('2', '1')
+    drive_ids, tape_ids, label_in_drive = split_mtx_output(library.status())
+
+    assert drive_ids == {'PAPR2001': ('1', '2')}
+    assert tape_ids == {'PAPR1001': '1'}
+    assert label_in_drive == {'1': 'PAPR2001'}
+
+
+@pytest.fixture
+def changer(library):
+    tape_changer = Changer('test', pid, 1000, drive_select=2)
+    library.attach(tape_changer)
+    return tape_changer
+
+
+def test_changer_loads_and_unloads(library, changer):
+    mtx_status = changer.inventory_stats['mtx_status']
+    assert changer.load_tape_pair(['PAPR1001', 'PAPR2001'])
+    assert changer.label_in_drive == {'0': 'PAPR1001', '1': 'PAPR2001'}
+    assert os.path.realpath(library.device_format.format(0)) == library.tape_dir('PAPR1001')
+
+    ## loading a tape that is already in the drive only rewinds it
+    assert changer.load_tape_drive('PAPR1001', drive=0)
+
+    ## loading another tape swaps it out
+    changer.unload_tape('PAPR2001')
+    assert changer.load_tape_drive('PAPR2001', drive=0)
+    assert changer.label_in_drive == {'0': 'PAPR2001'}
+
+    changer.unload_tape_pair()
+    assert changer.drives_empty()
+    assert split_mtx_output(library.status())[1] == {'PAPR1001': '1', 'PAPR2001': '2'}
+    ## every move kept the inventory up to date without another mtx status
+    assert changer.inventory_stats['mtx_status'] == mtx_status
+
+
+def test_changer_invalidates_inventory_on_failed_load(library, changer):
+    library.add_fault('load', 'PAPR1001')
+
+    with pytest.raises(CalledProcessError):
+        changer.load_tape_drive('PAPR1001', drive=0)
+    assert not changer.inventory_valid
+
+    assert changer.load_tape_drive('PAPR1001', drive=0)
+    assert changer.inventory_valid
+    assert changer.label_in_drive == {'0': 'PAPR1001'}
+
+
+def test_exec_commands_runs_drive_commands_together(library):
+    start_time = time.time()
+    results = Drives(pid).exec_commands(['sleep 0.3; mtx load 1 0', 'sleep 0.3; mtx load 2 1'])
+
+    assert time.time() - start_time < 0.55
+    assert [result['returncode'] for result in results] == [0, 0]
+    assert split_mtx_output(library.status())[2] == {'0': 'PAPR1001', '1': 'PAPR2001'}
+
+
+def test_exec_commands_fail_fast_kills_the_other_drive():
+    start_time = time.time()
+    results = Drives(pid).exec_commands(['sleep 10', 'sleep 0.1; false'])
+
+    assert time.time() - start_time < 5
+    assert results[1]['returncode'] == 1
+    assert results[0]['killed']
+    assert results[0]['returncode'] != 0
+
+    ## without fail_fast the other drive finishes
+    results = Drives(pid).exec_commands(['sleep 0.3', 'false'], fail_fast=False)
+    assert [result['returncode'] for result in results] == [0, 1]
+    assert not results[0]['killed']
+
+
+def test_exec_commands_kills_commands_past_the_timeout():
+    drives = Drives(pid)
+    start_time = time.time()
+    results = drives.exec_commands(['sleep 10', 'true'], timeout=0.2)
+
+    assert time.time() - start_time < 5
+    assert results[0]['timed_out']
+    assert results[1] == dict(results[1], returncode=0, timed_out=False)
+
+    with pytest.raises(Exception, match='drives \\[0\\]'):
+        drives.check_commands(['sleep 10', 'true'], timeout=0.2)
+
+
+def make_archive(tmp_path, tape_index, directory_paths):
+    """an archive as built by archive_from_list(): paper.$pid.$tape_index.tar of directory_path/visdata
+
+    :rtype: (archive path, dict of visdata md5 by directory_path)
+    """
+    archive_prefix = 'paper.{}.{}'.format(pid, tape_index)
+    archive_file = str(tmp_path / '{}.tar'.format(archive_prefix))
+    md5_dict = {}
+    with tarfile.open(archive_file, mode='w') as archive_tar:
+        for directory_path in directory_paths:
+            visdata_path = tmp_path / 'visdata'
+            visdata_path.write_bytes(os.urandom(50000))
+            md5_dict[directory_path] = hashlib.md5(visdata_path.read_bytes()).hexdigest()
+            archive_tar.add(str(visdata_path), arcname='/'.join([archive_prefix, directory_path, 'visdata']))
+    return archive_file, md5_dict
+
+
+def test_fan_out_write_error_fails_the_write(tmp_path, library, changer):
+    library.add_fault('write', 'PAPR2001', offset=20000)
+    changer.load_tape_pair(['PAPR1001', 'PAPR2001'])
+    archive_file, md5_dict = make_archive(tmp_path, 1, ['host:/data/zen.2456000.10000.uv'])
+
+    with pytest.raises(Exception, match='drives \\[1\\]'):
+        changer.tape_drives.fan_out_tar([archive_file])
+
+    ## the partial tape file of the failed drive gets no position
+    assert changer.tape_drives.drive_report[1]['partial']
+    assert list(changer.tape_drives.drive_positions) == [0]
+
+
+def test_aborted_fan_out_stops_the_drives_mid_chunk(tmp_path):
+    device_paths = {}
+    for drive_int in range(2):
+        tape_dir = tmp_path / 'drive{}'.format(drive_int)
+        tape_dir.mkdir()
+        ## a record takes 0.1s to write, a chunk of 100 records 10s
+        (tape_dir / 'settings').write_text(json.dumps({'mb_per_second': 0.1}))
+        device_paths[drive_int] = str(tape_dir)
+
+    writer = FanOutWriter(pid, device_paths, chunk_records=100)
+    writer.write(bytes(writer.chunk_size))
+    time.sleep(0.05)
+    writer.abort(Exception('archive build failed'))
+
+    start_time = time.time()
+    drive_report = writer.close()
+    assert time.time() - start_time < 5
+
+    for report in drive_report.values():
+        assert report['partial']
+        assert report['bytes'] < writer.chunk_size
+    assert complete_positions(drive_report) == {}
+
+
+@pytest.fixture
+def ramtar(tmp_path):
+    """a streaming RamTar writing to two file-backed drives"""
+    for drive_int in range(2):
+        tmp_path.joinpath('drive{}'.format(drive_int)).mkdir()
+    stream_ramtar = RamTar(pid, drive_select=2)
+    stream_ramtar.device_format = str(tmp_path / 'drive{}')
+    stream_ramtar.ring_buffer_mb = 0.0625
+    return stream_ramtar
+
+
+def stream_archive(tmp_path, stream_ramtar):
+    """stream one archive of a 300k visdata file; return the exception raised, if any"""
+    zen_path = tmp_path / 'data' / 'zen.2456000.10000.uv'
+    zen_path.mkdir(parents=True)
+    (zen_path / 'visdata').write_bytes(os.urandom(300000))
+    archive_prefix = 'paper.{}.1'.format(pid)
+    archive_list = tmp_path / '{}.file_list'.format(archive_prefix)
+    archive_list.write_text('zen.2456000.10000.uv\n')
+    members = [(str(zen_path), '{}/zen.2456000.10000.uv'.format(archive_prefix), 'zen.2456000.10000.uv')]
+
+    errors = []
+
+    def _stream():
+        try:
+            stream_ramtar.stream_archive_to_tape(members, str(archive_list), archive_prefix + '.tar', str(tmp_path / (archive_prefix + '.tar')))
+        except Exception as stream_error:
+            errors.append(stream_error)
+
+    streamer = threading.Thread(target=_stream, daemon=True)
+    streamer.start()
+    streamer.join(timeout=30)
+    assert not streamer.is_alive()
+    return errors[0] if errors else None
+
+
+def test_stream_archive_to_tape_records_positions(tmp_path, ramtar):
+    assert stream_archive(tmp_path, ramtar) is None
+    assert sorted(ramtar.drive_positions) == [0, 1]
+
+
+@pytest.mark.parametrize('missing_bytes', [tarfile.RECORDSIZE, 200000])
+def test_stream_archive_larger_than_expected_fails_before_the_filemark(tmp_path, ramtar, monkeypatch, missing_bytes):
+    ## the first fits in the ring buffer, the second holds up the builder on a full ring
+    tar_stream_size = paper_mtx.tar_stream_size
+    monkeypatch.setattr(paper_mtx, 'tar_stream_size', lambda members: tar_stream_size(members) - missing_bytes)
+
+    stream_error = stream_archive(tmp_path, ramtar)
+    assert 'archive size mismatch' in str(stream_error)
+    assert ramtar.drive_positions == {}
+
+
+@pytest.fixture
+def written_drives(tmp_path, library, changer):
+    """both tapes written with a catalog, two archives and a positions file
+
+    :rtype: (Drives, dict of samples by tape_index, md5_dict, dict of positions by drive_int)
+    """
+    changer.load_tape_pair(['PAPR1001', 'PAPR2001'])
+    drives = changer.tape_drives
+    for drive_int in range(2):
+        drives.write_text(drive_int, '## Paper dump catalog:{} (version: 1 on 20161016-1200)\n'.format(pid))
+
+    samples = {1: ['host:/data/zen.2456000.10000.uv', 'host:/data/zen.2456000.10139.uv'],
+               2: ['host:/data/zen.2456001.10000.uv']}
+    md5_dict = {}
+    for tape_index in sorted(samples):
+        archive_file, archive_md5 = make_archive(tmp_path, tape_index, samples[tape_index])
+        md5_dict.update(archive_md5)
+        drives.fan_out_tar([archive_file])
+        add_positions(changer.archive_positions, tape_index, drives.drive_positions)
+
+    label_positions = changer.write_positions()
+    return drives, samples, md5_dict, label_positions
+
+
+def test_fan_out_positions_match_the_tape(written_drives):
+    drives, samples, md5_dict, label_positions = written_drives
+
+    ## the 32k catalog block and its filemark come first
+    assert label_positions['PAPR1001'][1][1] == 2
+    assert label_positions['PAPR1001'] == label_positions['PAPR2001']
+    assert drives.read_last_file(0)[0] == '## Paper dump positions:{} (block size: 10240)'.format(pid)
+
+
+def test_verify_tape_reads_forward_or_seeks(written_drives, changer):
+    drives, samples, md5_dict, label_positions = written_drives
+    expected = dict(((tape_index, directory_path), md5_dict[directory_path])
+                    for tape_index in samples for directory_path in samples[tape_index])
+
+    assert drives.verify_tape(pid, samples, drive_int=0) == expected
+
+    start_blocks = changer.archive_start_blocks('PAPR2001', pid, samples)
+    assert start_blocks == dict((tape_index, position[1]) for tape_index, position in label_positions['PAPR2001'].items())
+    assert drives.verify_tape(pid, {2: samples[2]}, drive_int=1, positions=start_blocks) == \
+        dict((sample, md5sum) for sample, md5sum in expected.items() if sample[0] == 2)
+
+
+def test_archive_start_blocks_needs_the_dump_positions(written_drives, changer):
+    drives, samples, md5_dict, label_positions = written_drives
+
+    ## positions written by another dump are not used
+    assert changer.archive_start_blocks('PAPR1001', '999', samples) is None
+
+    ## positions from the mtx db are used when the tape has none of ours
+    stored = dict((tape_index, position + (10240,)) for tape_index, position in label_positions['PAPR1001'].items())
+    assert changer.archive_start_blocks('PAPR1001', '999', samples, stored_positions=stored) == {1: 2, 2: stored[2][1]}
+
+    ## but not if they were counted in another block size
+    stored[2] = stored[2][:3] + (32768,)
+    assert changer.archive_start_blocks('PAPR1001', '999', samples, stored_positions=stored) is None
+
+
+def test_read_last_file_skips_archives(tmp_path, library, changer):
+    changer.load_tape_pair(['PAPR1001', 'PAPR2001'])
+    archive_file, md5_dict = make_archive(tmp_path, 1, ['host:/data/zen.2456000.10000.uv'])
+    changer.tape_drives.fan_out_tar([archive_file])
+
+    assert changer.tape_drives.read_last_file(0) == []
+    assert changer.read_tape_positions('PAPR1001') is None
@@ -0,0 +1,81 @@
+"""Pipeline stages and the tape loading of DumpPipeline"""
+
+import threading
+import time
+from subprocess import CalledProcessError
+
+import pytest
+
+from paper_debug import Debug
+from paper_dump import DumpPipeline
+from paper_mtx import Changer
+from paper_pipeline import Pipeline, PipelineStage
+
+
+def test_pipeline_passes_items_through_every_stage():
+    seen = []
+
+    def _slow_first(item):
+        ## the first item finishes last in the unordered stage
+        time.sleep(0.1 if item == 0 else 0)
+        return item
+
+    pipeline = Pipeline('test', [
+        PipelineStage('square', lambda item: item * item, workers=3),
+        PipelineStage('shuffle', _slow_first, workers=3),
+        PipelineStage('record', lambda item: seen.append(item) or item + 1, ordered=True),
+    ])
+
+    assert pipeline.run(range(6)) == [1, 2, 5, 10, 17, 26]
+    ## the ordered stage still saw the items in order
+    assert seen == [0, 1, 4, 9, 16, 25]
+    assert [stage.items for stage in pipeline.stages] == [6, 6, 6]
+
+
+def test_pipeline_stops_on_the_first_error():
+    written = []
+
+    def _stage(item):
+        if item == 2:
+            raise ValueError('stage failed')
+        return item
+
+    pipeline = Pipeline('test', [
+        PipelineStage('stage', _stage, workers=2),
+        PipelineStage('write', written.append, ordered=True),
+    ])
+
+    with pytest.raises(ValueError):
+        pipeline.run(range(20))
+    assert 2 not in written
+    assert len(written) < 19
+
+
+@pytest.fixture
+def dump_pipeline(library, tmp_path):
+    """the tape side of a DumpPipeline, on a SimLibrary"""
+    dump = DumpPipeline.__new__(DumpPipeline)
+    dump.debug = Debug('123456001')
+    dump.tapes_ready = threading.Event()
+    dump.load_error = None
+    dump.tape = Changer('test', '123456001', 1000, drive_select=2)
+    library.attach(dump.tape)
+    return dump
+
+
+def test_write_batch_fails_when_the_tapes_did_not_load(library, dump_pipeline):
+    library.add_fault('load', 'PAPR1001')
+
+    dump_pipeline.load_tapes(['PAPR1001', 'PAPR2001'])
+    assert dump_pipeline.tapes_ready.is_set()
+    assert isinstance(dump_pipeline.load_error, CalledProcessError)
+
+    with pytest.raises(Exception, match='tape pair not ready'):
+        dump_pipeline.write_batch((1, ['host:/data/zen.2456000.10000.uv']))
+
+
+def test_load_tapes_fails_on_a_short_tape_pair(dump_pipeline):
+    dump_pipeline.load_tapes(['PAPR1001'])
+
+    assert dump_pipeline.tapes_ready.is_set()
+    assert 'failed to load tape pair' in str(dump_pipeline.load_error)
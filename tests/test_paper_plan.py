@@ -0,0 +1,93 @@
+"""BatchPlanner packing"""
+
+import numpy as np
+
+from paper_debug import Debug
+from paper_dump import DumpFast
+from paper_plan import BatchPlanner
+
+
+def test_pack_units_first_fit_decreasing():
+    planner = BatchPlanner('test', batch_size_mb=10, tape_size_mb=100)
+    unit_bins, fill = planner.pack_units([5, 4, 3, 3, 2, 2, 1], 10)
+
+    assert unit_bins.tolist() == [0, 0, 1, 1, 1, 1, 0]
+    assert fill.tolist() == [10, 10]
+
+
+def test_pack_units_leaves_out_what_does_not_fit():
+    planner = BatchPlanner('test', batch_size_mb=10, tape_size_mb=100)
+
+    ## too large for any bin
+    unit_bins, fill = planner.pack_units([12, 3], 10)
+    assert unit_bins.tolist() == [-1, 0]
+    assert fill.tolist() == [3]
+
+    ## more bins needed than allowed
+    unit_bins, fill = planner.pack_units([6, 6, 6], 10, bin_count=2)
+    assert unit_bins.tolist() == [0, 1, -1]
+    assert fill.tolist() == [6, 6]
+
+
+def test_pack_units_fill_matches_units():
+    planner = BatchPlanner('test', batch_size_mb=100, tape_size_mb=1000)
+    unit_sizes = np.random.RandomState(7).uniform(1, 60, size=500)
+    unit_bins, fill = planner.pack_units(unit_sizes, 100)
+
+    assert (unit_bins >= 0).all()
+    assert (fill <= 100).all()
+    assert np.allclose(np.bincount(unit_bins, weights=unit_sizes), fill)
+    ## first-fit-decreasing is never worse than 11/9 OPT + 1
+    assert len(fill) <= 11.0 / 9 * unit_sizes.sum() / 100 + 1
+
+
+def test_plan_batches_keeps_nights_together():
+    planner = BatchPlanner('test', batch_size_mb=10, tape_size_mb=100)
+    sources = ['host:/data/zen.2456000.{}.uv'.format(obs) for obs in range(3)] + \
+              ['host:/data/zen.2456001.{}.uv'.format(obs) for obs in range(2)]
+    batches, fill = planner.plan_batches(sources, [2, 2, 2, 4, 4])
+
+    assert sorted(batches) == [[0, 1, 2], [3, 4]]
+    assert sorted(fill.tolist()) == [6, 8]
+
+
+def test_plan_batches_splits_a_night_too_large_for_a_batch():
+    planner = BatchPlanner('test', batch_size_mb=10, tape_size_mb=100)
+    sources = ['host:/data/zen.2456000.{}.uv'.format(obs) for obs in range(4)]
+    batches, fill = planner.plan_batches(sources, [4, 4, 4, 4])
+
+    assert sorted(index for batch in batches for index in batch) == [0, 1, 2, 3]
+    assert fill.tolist() == [8, 8]
+
+
+def test_plan_tape_limits_batches_to_the_tape():
+    planner = BatchPlanner('test', batch_size_mb=10, tape_size_mb=20)
+    sources = ['host:/data/file{}'.format(index) for index in range(5)]
+    tape = planner.plan_tape(sources, [9, 9, 9, 9, 9], report=False)
+
+    assert len(tape['batches']) == 2
+    assert tape['size_mb'] == 18
+
+
+class ClaimingPaperDB(object):
+    """claims every file except the ones another dump holds"""
+
+    def __init__(self, taken):
+        self.taken = taken
+        self.unclaimed = []
+
+    def claim_listed_files(self, file_list):
+        return 'OK', [source for source in file_list if source not in self.taken]
+
+    def unclaim_files(self, file_list=None):
+        self.unclaimed.extend(file_list)
+
+
+def test_partly_claimed_batches_are_dropped():
+    dump = DumpFast.__new__(DumpFast)
+    dump.debug = Debug('test')
+    dump.paperdb = ClaimingPaperDB(taken={'b2'})
+
+    assert dump.claim_planned_batches([['a1', 'a2'], ['b1', 'b2', 'b3'], ['c1']]) == [['a1', 'a2'], ['c1']]
+    ## the files we did get from the dropped batch are released
+    assert dump.paperdb.unclaimed == ['b1', 'b3']
@@ -0,0 +1,91 @@
+"""ConnectionPool hands out one connection per thread and owner"""
+
+import threading
+
+import pytest
+
+from paper_pool import ConnectionPool
+
+
+class FakeConnection(object):
+    """enough of a pymysql connection for the pool"""
+
+    def __init__(self):
+        self.alive = True
+        self.closed = False
+
+    def ping(self, reconnect=False):
+        if not self.alive:
+            raise Exception('MySQL server has gone away')
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeCursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    connection_pool = ConnectionPool('/papertape/etc/my.papertape-test.cnf', 'test', pool_size=1)
+    monkeypatch.setattr(connection_pool, '_open', FakeConnection)
+    return connection_pool
+
+
+def test_owners_in_one_thread_get_their_own_connection(pool):
+    first_owner, second_owner = object(), object()
+    first_cursor = pool.cursor(first_owner)
+    second_cursor = pool.cursor(second_owner)
+
+    assert first_cursor.connection is not second_cursor.connection
+    assert pool.current_cursor(first_owner) is first_cursor
+
+    ## releasing one owner leaves the other one's connection (and transaction) alone
+    pool.release(first_owner)
+    assert pool.current_connection(first_owner) is None
+    assert pool.current_connection(second_owner) is second_cursor.connection
+    assert pool.cursor(second_owner) is second_cursor
+
+
+def test_threads_get_their_own_connection(pool):
+    owner = object()
+    main_connection = pool.connection(owner)
+    thread_connections = []
+
+    thread = threading.Thread(target=lambda: thread_connections.append(pool.connection(owner)))
+    thread.start()
+    thread.join()
+
+    assert thread_connections[0] is not main_connection
+
+
+def test_released_connections_are_reused_up_to_pool_size(pool):
+    first_owner, second_owner = object(), object()
+    first_connection = pool.connection(first_owner)
+    second_connection = pool.connection(second_owner)
+    pool.release(first_owner)
+    pool.release(second_owner)
+
+    ## only pool_size idle connections are kept
+    assert pool.stats()['idle'] == 1
+    assert second_connection.closed
+    assert pool.connection(object()) is first_connection
+
+
+def test_dead_connections_are_replaced(pool):
+    owner = object()
+    connection = pool.connection(owner)
+    connection.alive = False
+
+    assert pool.connection(owner) is not connection
+    assert connection.closed
+    assert pool.stats()['reconnects'] == 1
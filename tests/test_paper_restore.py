@@ -0,0 +1,143 @@
+"""choosing tapes and restoring sources from a SimLibrary"""
+
+import hashlib
+import os
+import tarfile
+
+import pytest
+
+from paper_catalog import CatalogIndex
+from paper_mtx import Changer, add_positions, split_mtx_output
+from paper_restore import Restore, choose_labels
+from paper_status_code import StatusCode
+
+pid = '123456001'
+
+## sources by tape_index, as a dump would have batched them
+archives = {1: ['host:/data/zen.2456000.10000.uv', 'host:/data/zen.2456000.10139.uv'],
+            2: ['host:/data/zen.2456001.10000.uv']}
+
+
+def location(source, label, tape_index):
+    return {'source': source, 'label': label, 'tape_index': tape_index}
+
+
+def test_choose_labels_covers_every_source_with_few_tapes():
+    locations = {
+        'a': [location('a', 'PAPR1001', 1), location('a', 'PAPR2001', 1)],
+        'b': [location('b', 'PAPR1001', 2), location('b', 'PAPR2001', 2)],
+        'c': [location('c', 'PAPR2001', 3), location('c', 'PAPR1003', 1)],
+    }
+
+    ## PAPR2001 holds every source
+    chosen = choose_labels(locations)
+    assert sorted(chosen) == ['PAPR2001']
+    assert sorted(chosen['PAPR2001']) == [1, 2, 3]
+
+    ## a loaded tape is used first, the rest comes from the next best tape
+    chosen = choose_labels(locations, loaded_labels=['PAPR1003'])
+    assert sorted(chosen) == ['PAPR1003', 'PAPR2001']
+    assert [archive_location['source'] for archive_location in chosen['PAPR1003'][1]] == ['c']
+    assert sorted(chosen['PAPR2001']) == [1, 2]
+
+
+@pytest.fixture
+def dumped(tmp_path, library):
+    """both tapes written the way a dump writes them, and the sqlite catalog of the dump
+
+    :rtype: (catalog_db, dict of visdata md5 by source, dict of positions by label)
+    """
+    changer = Changer('test', pid, 1000, drive_select=2)
+    library.attach(changer)
+    changer.load_tape_pair(['PAPR1001', 'PAPR2001'])
+    drives = changer.tape_drives
+
+    catalog_lines = ['## Paper dump catalog:{} (version: 1 on 20161016-1200)'.format(pid)]
+    for drive_int in range(2):
+        drives.write_text(drive_int, '\n'.join(catalog_lines) + '\n')
+
+    md5_dict = {}
+    for tape_index, sources in sorted(archives.items()):
+        archive_prefix = 'paper.{}.{}'.format(pid, tape_index)
+        archive_file = str(tmp_path / '{}.tar'.format(archive_prefix))
+        with tarfile.open(archive_file, mode='w') as archive_tar:
+            for archive_index, source in enumerate(sources):
+                visdata_path = tmp_path / 'visdata'
+                visdata_path.write_bytes(os.urandom(50000))
+                md5_dict[source] = hashlib.md5(visdata_path.read_bytes()).hexdigest()
+                archive_tar.add(str(visdata_path), arcname='/'.join([archive_prefix, source, 'visdata']))
+                catalog_lines.append('{}:{}:{}:{}:{}'.format(len(catalog_lines), tape_index, archive_index, md5_dict[source], source))
+        drives.fan_out_tar([archive_file])
+        add_positions(changer.archive_positions, tape_index, drives.drive_positions)
+
+    label_positions = changer.write_positions()
+    changer.unload_tape_pair()
+
+    catalog_db = str(tmp_path / 'paper.catalog.sqlite')
+    catalog = CatalogIndex(pid, catalog_db=catalog_db)
+    catalog.add_catalog(catalog_lines, ['PAPR1001', 'PAPR2001'])
+    catalog.close_catalog()
+    return catalog_db, md5_dict, label_positions
+
+
+def restore_from(tmp_path, library, catalog_db):
+    restore = Restore('test', pid=pid, destination=str(tmp_path / 'restore'), catalog_db=catalog_db, drive_select=2)
+    library.attach(restore.tape)
+    return restore
+
+
+def restored_md5(tmp_path, source):
+    with open(os.path.join(str(tmp_path / 'restore'), source, 'visdata'), mode='rb') as visdata_file:
+        return hashlib.md5(visdata_file.read()).hexdigest()
+
+
+def test_restore_seeks_to_recorded_positions(tmp_path, library, dumped):
+    catalog_db, md5_dict, label_positions = dumped
+    catalog = CatalogIndex(pid, catalog_db=catalog_db)
+    for label, positions in label_positions.items():
+        catalog.add_positions(label, positions, 10240, dump_pid=pid)
+    catalog.close_catalog()
+
+    restore = restore_from(tmp_path, library, catalog_db)
+    sources = ['host:/data/zen.2456001.10000.uv', 'host:/data/zen.2456000.10139.uv']
+    assert restore.restore(sources) is StatusCode.OK
+    restore.close_restore()
+
+    for source in sources:
+        assert restored_md5(tmp_path, source) == md5_dict[source]
+    assert not os.path.exists(os.path.join(str(tmp_path / 'restore'), 'host:/data/zen.2456000.10000.uv'))
+
+    ## one tape is enough, and it is read by seeking to the archives
+    assert len(restore.tape_report) == 1
+    tape_report = list(restore.tape_report.values())[0]
+    assert tape_report['error'] is None
+    assert tape_report['seeks'] == 2
+    assert split_mtx_output(library.status())[1] == {'PAPR1001': '1', 'PAPR2001': '2'}
+
+
+def test_restore_reads_through_a_tape_without_positions(tmp_path, library, dumped):
+    catalog_db, md5_dict, label_positions = dumped
+
+    restore = restore_from(tmp_path, library, catalog_db)
+    assert restore.restore(['host:/data/zen.2456001.10000.uv']) is StatusCode.OK
+    restore.close_restore()
+
+    assert restored_md5(tmp_path, 'host:/data/zen.2456001.10000.uv') == md5_dict['host:/data/zen.2456001.10000.uv']
+    assert list(restore.tape_report.values())[0]['seeks'] == 0
+
+
+def test_restore_reports_missing_and_mismatched_sources(tmp_path, library, dumped):
+    catalog_db, md5_dict, label_positions = dumped
+
+    restore = restore_from(tmp_path, library, catalog_db)
+    assert restore.restore(['host:/data/zen.2456000.10000.uv', 'host:/data/zen.2456002.10000.uv']) is StatusCode.file_missing
+    restore.close_restore()
+
+    catalog = CatalogIndex(pid, catalog_db=catalog_db)
+    catalog.add_file_rows([('host:/data/zen.2456000.10000.uv', None, '0' * 32, '1[PAPR1001,PAPR2001]-1:0')])
+    catalog.close_catalog()
+
+    restore = restore_from(tmp_path, library, catalog_db)
+    assert restore.restore(['host:/data/zen.2456000.10000.uv']) is StatusCode.md5_mismatch
+    assert restore.md5_mismatch == ['host:/data/zen.2456000.10000.uv']
+    restore.close_restore()
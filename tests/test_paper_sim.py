@@ -0,0 +1,45 @@
+"""the simulated library and its fake mtx"""
+
+import json
+import os
+import subprocess
+
+from paper_sim import SimLibrary
+
+
+def test_fake_mtx_moves_tapes(library):
+    assert subprocess.call(['mtx', 'load', '1', '0']) == 0
+    assert 'Data Transfer Element 0:Full (Storage Element 1 Loaded):VolumeTag = PAPR1001' in \
+        subprocess.check_output(['mtx', 'status']).decode()
+    assert os.path.realpath(library.device_format.format(0)) == library.tape_dir('PAPR1001')
+
+    assert subprocess.call(['mtx', 'unload', '1', '0']) == 0
+    assert not os.path.lexists(library.device_format.format(0))
+
+
+def test_moves_that_cannot_happen_fail(library):
+    assert library.load('3', '0') == 'Source Element Address 3 is Empty'
+    assert library.load('1', '5') == 'Invalid Data Transfer Element 5'
+    assert library.load('1', '0') is None
+    assert library.load('2', '0') == 'Drive 0 Full (Storage Element 1 Loaded)'
+    assert library.unload('1', '1') == 'Data Transfer Element 1 is Empty'
+    assert library.unload('2', '0') == 'Storage Element 2 is Already Full'
+
+
+def test_faults_are_used_up(library):
+    library.add_fault('unload', 'PAPR1001', count=2)
+    library.load('1', '0')
+
+    assert subprocess.call(['mtx', 'unload', '1', '0'], stderr=subprocess.DEVNULL) == 1
+    assert subprocess.call(['mtx', 'unload', '1', '0'], stderr=subprocess.DEVNULL) == 1
+    assert subprocess.call(['mtx', 'unload', '1', '0']) == 0
+
+
+def test_loaded_tape_gets_drive_and_fault_settings(tmp_path):
+    sim_library = SimLibrary(str(tmp_path / 'library'), drive_mb_per_second=160, tape_capacity_mb=2.5)
+    sim_library.create(['PAPR1001'])
+    sim_library.add_fault('read', 'PAPR1001', offset=4096)
+    sim_library.load('1', '0')
+
+    with open(os.path.join(sim_library.tape_dir('PAPR1001'), 'settings'), mode='r') as settings_file:
+        assert json.load(settings_file) == {'mb_per_second': 160, 'capacity_bytes': 2500000, 'read_error_offset': 4096}
@@ -0,0 +1,170 @@
+"""FileTapeDevice behaves like a non-rewinding st device"""
+
+import errno
+import json
+
+import pytest
+
+from paper_tape import FileTapeDevice, TapeFileReader, open_tape, tape_files
+
+
+def write_file(tape_dir, blocks, block_size=10240):
+    """write blocks as one tape file at the saved position"""
+    with FileTapeDevice('test', tape_dir, mode='wb', block_size=block_size) as tape:
+        for block in blocks:
+            tape.write_block(block)
+
+
+@pytest.fixture
+def tape_dir(tmp_path):
+    """a tape with a 32k catalog block, then two archives of 10240 byte records"""
+    tape_dir = str(tmp_path / 'PAPR1001')
+    tmp_path.joinpath('PAPR1001').mkdir()
+    write_file(tape_dir, [b'c' * 32768], block_size=32768)
+    write_file(tape_dir, [b'a' * 10240] * 3)
+    write_file(tape_dir, [b'b' * 10240] * 2)
+    return tape_dir
+
+
+def test_open_tape_uses_a_directory_as_a_tape(tape_dir):
+    with open_tape('test', tape_dir) as tape:
+        assert isinstance(tape, FileTapeDevice)
+
+
+def test_tell_counts_blocks_as_written(tape_dir):
+    with FileTapeDevice('test', tape_dir, block_size=10240) as tape:
+        ## the position is kept from the last close, after the last filemark
+        assert tape.tell() == 9
+
+        tape.rewind()
+        assert tape.tell() == 0
+        tape.fsf(1)
+        ## one 32k catalog block and its filemark, whatever the block size opened with
+        assert tape.tell() == 2
+        tape.fsf(1)
+        assert tape.tell() == 6
+
+
+def test_seek_and_read_blocks(tape_dir):
+    with FileTapeDevice('test', tape_dir, block_size=10240) as tape:
+        tape.seek(3)
+        assert tape.read_block() == b'a' * 10240
+        assert tape.tell() == 4
+        assert tape.read_block() == b'a' * 10240
+        ## the filemark at the end of the tape file
+        assert tape.read_block() == b''
+        assert tape.tell() == 6
+        assert b''.join(tape.read_file()) == b'b' * 20480
+
+        tape.seek(6)
+        assert tape.read_block() == b'b' * 10240
+
+
+def test_read_smaller_than_block_fails(tape_dir):
+    with FileTapeDevice('test', tape_dir, block_size=10240) as tape:
+        tape.rewind()
+        with pytest.raises(OSError) as read_error:
+            tape.read_block()
+        assert read_error.value.errno == errno.ENOMEM
+
+    with FileTapeDevice('test', tape_dir, block_size=32768) as tape:
+        tape.rewind()
+        assert tape.read_block() == b'c' * 32768
+        tape.fsf(1)
+        ## a larger read returns one written block
+        assert tape.read_block() == b'a' * 10240
+
+
+def test_filemark_moves(tape_dir):
+    with FileTapeDevice('test', tape_dir, block_size=10240) as tape:
+        tape.eom()
+        assert tape.tell() == 9
+        tape.bsf(2)
+        ## on the tape side of the filemark: the end of the first archive
+        assert tape.tell() == 5
+        tape.fsf(1)
+        assert tape.tell() == 6
+        assert tape.count_files() == 1
+
+        with pytest.raises(OSError):
+            tape.fsf(1)
+        tape.rewind()
+        with pytest.raises(OSError):
+            tape.bsf(1)
+
+
+def test_read_at_end_of_data_fails(tape_dir):
+    with FileTapeDevice('test', tape_dir, block_size=10240) as tape:
+        tape.eom()
+        with pytest.raises(OSError):
+            tape.read_block()
+
+
+def test_write_replaces_the_rest_of_the_tape(tape_dir):
+    with FileTapeDevice('test', tape_dir, block_size=10240) as tape:
+        tape.rewind()
+        tape.fsf(1)
+    write_file(tape_dir, [b'd' * 512])
+
+    with FileTapeDevice('test', tape_dir, block_size=10240) as tape:
+        assert tape.tell() == 4
+        tape.rewind()
+        tape.fsf(1)
+        assert b''.join(tape.read_file()) == b'd' * 512
+        tape.eom()
+        assert tape.tell() == 4
+
+    with FileTapeDevice('test', tape_dir, block_size=10240) as tape:
+        tape.rewind()
+        tape.fsf(1)
+        assert [reader.read() for reader in tape_files(tape)] == [b'd' * 512]
+
+
+def test_weof_writes_empty_files(tape_dir):
+    with FileTapeDevice('test', tape_dir, block_size=10240) as tape:
+        tape.weof(2)
+        assert tape.tell() == 11
+        tape.bsf(1)
+        assert tape.read_block() == b''
+
+
+def test_tape_file_reader_reads_a_tape_file(tape_dir):
+    with FileTapeDevice('test', tape_dir, block_size=10240) as tape:
+        tape.seek(6)
+        reader = TapeFileReader(tape)
+        assert reader.read(15000) == b'b' * 15000
+        assert reader.read() == b'b' * 5480
+        assert reader.read() == b''
+
+
+def set_settings(tape_dir, settings):
+    with open(tape_dir + '/settings', mode='w') as settings_file:
+        json.dump(settings, settings_file)
+
+
+def test_capacity_ends_the_medium(tape_dir):
+    ## the tape holds 32768 + 5 * 10240 bytes so far
+    set_settings(tape_dir, {'capacity_bytes': 32768 + 6 * 10240})
+
+    with FileTapeDevice('test', tape_dir, mode='wb', block_size=10240) as tape:
+        tape.write_block(b'e' * 10240)
+        with pytest.raises(OSError) as write_error:
+            tape.write_block(b'e' * 10240)
+        assert write_error.value.errno == errno.ENOSPC
+
+
+def test_injected_read_and_write_errors(tape_dir):
+    set_settings(tape_dir, {'read_error_offset': 32768 + 10240, 'write_error_offset': 32768 + 5 * 10240})
+
+    with FileTapeDevice('test', tape_dir, block_size=10240) as tape:
+        tape.seek(2)
+        tape.read_block()
+        with pytest.raises(OSError) as read_error:
+            tape.read_block()
+        assert read_error.value.errno == errno.EIO
+
+    with FileTapeDevice('test', tape_dir, mode='wb', block_size=10240) as tape:
+        tape.eom()
+        with pytest.raises(OSError) as write_error:
+            tape.write_block(b'e' * 10240)
+        assert write_error.value.errno == errno.EIO